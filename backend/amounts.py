@@ -0,0 +1,344 @@
+# amounts.py
+# Batch normalization of the amounts in merged invoices. The LLM returns amounts as loosely
+# formatted strings as often as numbers — "₹ 1,23,456.50", "1.234,56", "(500)", "12,50",
+# "2.5 lakh", "1,500/-" — so every amount field of a batch (header totals and taxes, item
+# quantities, prices and amounts) is parsed into a float column first. Parsing is done
+# with NumPy string operations over the batch's distinct strings, and everything after that
+# is NumPy over whole columns:
+#   - conversion to INR at the rate in force on each invoice's date, from a local
+#     exchange-rate table (EXCHANGE_RATES_FILE) held in memory;
+#   - the arithmetic checks: items sum to the pre-tax total, and pre-tax + taxes - discount
+#     + round-off to the invoice total.
+# A month of invoices reconciles in milliseconds.
+#
+# The rate table is a CSV of `currency,date,rate` rows, rate being INR per unit of the
+# currency from that date (ISO yyyy-mm-dd) on. Invoices dated before a currency's first
+# row use that row; undated invoices use its latest.
+import csv
+import os
+import re
+from datetime import datetime
+from functools import lru_cache
+from itertools import compress
+from operator import methodcaller
+
+import numpy as np
+
+BASE_CURRENCY = "INR"
+EXCHANGE_RATES_FILE = os.getenv("EXCHANGE_RATES_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "exchange_rates.csv"))
+# Totals within this much of each other are considered equal (paise rounding, round-off)
+TOTAL_TOLERANCE = 1.0
+
+TAX_FIELDS = ("cgst", "sgst", "igst", "ugst", "tcs")
+# Amount fields of the invoice header and of each item
+HEADER_FIELDS = TAX_FIELDS + ("totalTax", "totalAmountPreTax", "preTaxTotal", "invoiceTotalAmount", "discount", "roundOff")
+ITEM_FIELDS = ("quantity", "pricePerUnit", "amount", "itemLevelGst", "itemLevelDiscount")
+
+# Digits with grouping and decimal separators: "," "." and the apostrophes and spaces some
+# locales group with (a plain space only before a group of three digits). A number may start
+# at its decimal separator (".50"), unless that is the end of a word ("Rs.50").
+NUMBER = re.compile(r"(?:(?<![A-Za-z])[.,](?=\d))?(?:\d(?:[\d,.'\u00a0\u202f]| (?=\d{3}\b))*\d|\d)")
+# Written-out multipliers, also abbreviated ("5 Cr") and run into the number ("2.5lakh")
+MULTIPLIERS = ((re.compile(r"(?<![A-Za-z])(?:crores?|cr)\b", re.I), 1e7),
+               (re.compile(r"(?<![A-Za-z])(?:lakhs?|lacs?)\b", re.I), 1e5))
+# Signs a negative amount is written with: a hyphen or the Unicode minus
+MINUS_SIGNS = ("-", "\u2212")
+CURRENCY_ALIASES = {
+    "₹": "INR", "RS": "INR", "RS.": "INR", "RUPEE": "INR", "RUPEES": "INR", "INDIAN RUPEE": "INR",
+    "$": "USD", "US$": "USD", "DOLLAR": "USD", "DOLLARS": "USD", "US DOLLAR": "USD",
+    "€": "EUR", "EURO": "EUR", "EUROS": "EUR", "£": "GBP", "POUND": "GBP", "POUNDS": "GBP", "¥": "JPY"
+}
+CURRENCY_SYMBOLS = re.compile(r"₹|US\$|\$|€|£|¥")
+# Date formats invoices are read in, day first
+DATE_FORMATS = ('%d/%m/%Y', '%d-%m-%Y', '%d.%m.%Y', '%Y-%m-%d')
+
+# Function to read one amount string, Indian ("1,23,456.50") or Western ("123,456.50") grouping,
+# or a decimal comma ("1.234,56", "12,50"); None when it holds no number
+def parse_amount(text):
+    text = text.replace("/-", "")  # "1,500/-": Indian for "and no paise"
+    match = NUMBER.search(text)
+    if match is None:
+        return None
+    digits = re.sub(r"['\u00a0\u202f ]", "", match.group())
+    last_comma, last_dot = digits.rfind(","), digits.rfind(".")
+    if last_comma >= 0 and last_dot >= 0:
+        decimal = "," if last_comma > last_dot else "."
+    elif last_comma >= 0:
+        # A single comma before one or two digits is a decimal comma; otherwise commas group thousands or lakhs
+        decimal = "," if digits.count(",") == 1 and len(digits) - last_comma - 1 <= 2 else None
+    elif last_dot >= 0:
+        decimal = "." if digits.count(".") == 1 else None
+    else:
+        decimal = None
+    integer, fraction = digits.rsplit(decimal, 1) if decimal else (digits, "")
+    try:
+        number = float(re.sub(r"[,.]", "", integer) + "." + (fraction or "0"))
+    except ValueError:
+        return None
+    for pattern, factor in MULTIPLIERS:
+        if pattern.search(text):
+            number *= factor
+            break
+    prefix = text[:match.start()]
+    if any(sign in prefix for sign in MINUS_SIGNS) or (prefix.strip().startswith("(") and text.rstrip().endswith(")")):
+        number = -number
+    return number
+
+# Currency symbols and codes dropped before an amount string is read as a plain number;
+# other spellings fall back to parse_amount
+AMOUNT_NOISE = ("/-", "₹", "Rs.", "Rs", "RS.", "RS", "INR", "US$", "$", "USD", "€", "EUR", "£", "GBP", "'", "\u00a0", "\u202f")
+
+# Function to read an array of distinct amount strings with NumPy string operations: the
+# separators are resolved as in parse_amount, for all strings at once. Strings that aren't
+# just a number once symbols are dropped (words, "lakh", spaces inside) go to parse_amount.
+def parse_strings(texts):
+    text = texts
+    for token in AMOUNT_NOISE:
+        # Most batches hold a few of these; finding is cheaper than replacing
+        if (np.char.find(text, token) >= 0).any():
+            text = np.char.replace(text, token, "")
+    text = np.char.strip(text)
+    negative = np.char.startswith(text, "(") & np.char.endswith(text, ")")
+    text = np.where(negative, np.char.strip(text, "()"), text)
+
+    commas, dots = np.char.count(text, ","), np.char.count(text, ".")
+    last_comma, last_dot = np.char.rfind(text, ","), np.char.rfind(text, ".")
+    decimal_comma = (((commas > 0) & (dots > 0) & (last_comma > last_dot))
+                     | ((dots == 0) & (commas == 1) & (np.char.str_len(text) - last_comma - 1 <= 2)))
+    without_commas = np.char.replace(text, ",", "")
+    text = np.where(decimal_comma, np.char.replace(np.char.replace(text, ".", ""), ",", "."),
+                    np.where((commas == 0) & (dots > 1), np.char.replace(without_commas, ".", ""), without_commas))
+
+    # What is left must be digits with at most one decimal point and a leading minus
+    unsigned = np.char.lstrip(text, "-")
+    signs = np.char.str_len(text) - np.char.str_len(unsigned)
+    valid = np.char.isdigit(np.char.replace(unsigned, ".", "", 1)) & (signs <= 1) & (np.char.count(text, "-") == signs)
+    numbers = np.full(len(texts), np.nan)
+    try:
+        numbers[valid] = text[valid].astype(np.float64)
+    except ValueError:  # Digits float() doesn't take (superscripts and the like)
+        valid[:] = False
+    numbers[negative & valid] *= -1
+    for index in np.flatnonzero(~valid):
+        number = parse_amount(str(texts[index]))
+        numbers[index] = np.nan if number is None else number
+    return numbers
+
+# Cell types read as numbers and as amount strings (JSON values, so bools are neither)
+NUMBER_TYPES = frozenset((int, float))
+STRING_TYPES = frozenset((str,))
+
+# Function to parse a column of amounts (numbers, strings or None) into floats, NaN where
+# there is no number; returns (column, mask of the cells that were strings)
+def parse_column(values):
+    kinds = list(map(type, values))
+    numbers = np.fromiter(map(NUMBER_TYPES.__contains__, kinds), dtype=bool, count=len(kinds))
+    texts = np.fromiter(map(STRING_TYPES.__contains__, kinds), dtype=bool, count=len(kinds))
+    column = np.full(len(values), np.nan)
+    column[numbers] = np.fromiter(compress(values, numbers), dtype=np.float64, count=int(numbers.sum()))
+    if texts.any():
+        # Each distinct string is read once
+        strings = list(compress(values, texts))
+        distinct = list(dict.fromkeys(strings))
+        parsed = dict(zip(distinct, parse_strings(np.array(distinct)).tolist()))
+        column[texts] = list(map(parsed.__getitem__, strings))
+    return column, texts
+
+# Function to read an invoice's currency from its currency field, or the symbol on its total; INR by default
+def currency_code(currency, total=None):
+    text = str(currency or "").strip().upper()
+    if text in CURRENCY_ALIASES:
+        return CURRENCY_ALIASES[text]
+    if re.fullmatch(r"[A-Z]{3}", text):
+        return text
+    symbol = CURRENCY_SYMBOLS.search(text) or (CURRENCY_SYMBOLS.search(total) if isinstance(total, str) else None)
+    return CURRENCY_ALIASES[symbol.group()] if symbol else BASE_CURRENCY
+
+# Function to read an invoice date into ISO yyyy-mm-dd; None when it isn't one. The one date
+# parser for amounts, duplicate keys and anything else comparing dates across invoices.
+def parse_date(value):
+    text = str(value or "").strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).strftime('%Y-%m-%d')
+        except ValueError:
+            continue
+    return None
+
+# Function to parse a column of dates into datetime64[D], NaT where there is no date
+def date_column(values):
+    parsed = {}
+    for value in values:
+        if value not in parsed:
+            parsed[value] = parse_date(value) if isinstance(value, str) else None
+    return np.array([parsed[value] or "NaT" for value in values], dtype="datetime64[D]")
+
+class RateTable:
+    # rows: [(currency, "yyyy-mm-dd", INR per unit)]
+    def __init__(self, rows):
+        by_currency = {}
+        for currency, date, rate in rows:
+            by_currency.setdefault(currency.upper(), []).append((np.datetime64(date, "D"), float(rate)))
+        self.currencies = {}
+        for currency, entries in by_currency.items():
+            entries.sort()
+            self.currencies[currency] = (np.array([d for d, _ in entries], dtype="datetime64[D]"),
+                                         np.array([r for _, r in entries], dtype=np.float64))
+
+    # Function to look up the rate of every invoice at once. `currencies` are codes, `dates`
+    # datetime64[D] (NaT for undated). Returns (rates, rate dates); NaN/NaT for unknown currencies.
+    def rates(self, currencies, dates):
+        currencies = np.asarray(currencies, dtype=object)
+        dates = np.asarray(dates, dtype="datetime64[D]")
+        rates = np.full(len(currencies), np.nan)
+        rate_dates = np.full(len(currencies), np.datetime64("NaT"), dtype="datetime64[D]")
+        rates[currencies == BASE_CURRENCY] = 1.0
+        for currency in set(currencies.tolist()) & self.currencies.keys():
+            table_dates, table_rates = self.currencies[currency]
+            mask = currencies == currency
+            # The last row on or before the date; NaT sorts last, so undated invoices get the latest row
+            index = np.clip(np.searchsorted(table_dates, dates[mask], side="right") - 1, 0, None)
+            rates[mask] = table_rates[index]
+            rate_dates[mask] = table_dates[index]
+        return rates, rate_dates
+
+@lru_cache(maxsize=4)
+def _load_rates(path, mtime_ns):
+    if mtime_ns is None:
+        print(f"No exchange-rate table at {path}; only {BASE_CURRENCY} amounts will be converted")
+        return RateTable([])
+    with open(path, newline="") as f:
+        return RateTable([(row["currency"], row["date"], row["rate"]) for row in csv.DictReader(f)])
+
+# Function to get the exchange-rate table, read once and again only when the file changes
+def rate_table(path=None):
+    path = path or EXCHANGE_RATES_FILE
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        mtime_ns = None
+    return _load_rates(path, mtime_ns)
+
+# Function to convert amounts in `currency` to INR at the rates of their dates (strings; None for the latest rate)
+def to_inr(values, currency, dates=None, table=None):
+    values = np.asarray(values, dtype=np.float64)
+    dates = date_column(dates if dates is not None else [None] * len(values))
+    rates, _ = (table or rate_table()).rates(np.full(len(values), currency, dtype=object), dates)
+    return values * rates
+
+# Function to collect the amounts of merged invoices into columns: {"header": {field: (n,)},
+# "items": {field: (m,)}, "item_invoice": (m,) index of each item's invoice, "item_count": (n,),
+# "currency": (n,), "date": (n,) datetime64[D]}, plus the dicts the columns were read from
+# ("headers", "item_rows") and which of their cells held strings ("header_text", "item_text")
+def amount_columns(invoices):
+    headers = [invoice.get("structured_data") or {} for invoice in invoices]
+    items = [[item for item in header.get("items") or [] if isinstance(item, dict)] for header in headers]
+    flat_items = [item for invoice_items in items for item in invoice_items]
+    # Every field of the batch in one column, so its strings go through parse_strings once
+    values = []
+    for field in HEADER_FIELDS:
+        values.extend(map(methodcaller("get", field), headers))
+    for field in ITEM_FIELDS:
+        values.extend(map(methodcaller("get", field), flat_items))
+    column, texts = parse_column(values)
+    split = len(HEADER_FIELDS) * len(headers)
+    return {
+        "header": dict(zip(HEADER_FIELDS, np.split(column[:split], len(HEADER_FIELDS)))),
+        "items": dict(zip(ITEM_FIELDS, np.split(column[split:], len(ITEM_FIELDS)))),
+        "header_text": dict(zip(HEADER_FIELDS, np.split(texts[:split], len(HEADER_FIELDS)))),
+        "item_text": dict(zip(ITEM_FIELDS, np.split(texts[split:], len(ITEM_FIELDS)))),
+        "headers": headers,
+        "item_rows": flat_items,
+        "item_invoice": np.repeat(np.arange(len(headers)), [len(invoice_items) for invoice_items in items]),
+        "item_count": np.array([len(invoice_items) for invoice_items in items], dtype=np.int64),
+        "currency": np.array([currency_code(header.get("currency"), header.get("invoiceTotalAmount"))
+                              for header in headers], dtype=object),
+        "date": date_column([header.get("invoiceDate") for header in headers])
+    }
+
+# Function to check the arithmetic of a whole batch of invoices at once, filling missing
+# subtotals from the items and taxes. Returns columns: the totals compared, each check
+# (1.0 pass, 0.0 fail, NaN when there was nothing to compare) and the filled subtotals.
+def reconcile_columns(columns):
+    header, count = columns["header"], len(columns["item_count"])
+    has_items = columns["item_count"] > 0
+    items_total = np.round(np.bincount(columns["item_invoice"], weights=np.nan_to_num(columns["items"]["amount"]),
+                                       minlength=count), 2)
+    pre_tax = np.where(has_items & np.isnan(header["totalAmountPreTax"]), items_total, header["totalAmountPreTax"])
+
+    taxes = np.vstack([header[field] for field in TAX_FIELDS]) if count else np.empty((len(TAX_FIELDS), 0))
+    tax_sum = np.round(np.nansum(taxes, axis=0), 2)
+    total_tax = np.where(~np.isnan(taxes).all(axis=0) & np.isnan(header["totalTax"]), tax_sum, header["totalTax"])
+
+    compared_pre_tax = np.where(np.isnan(pre_tax), header["preTaxTotal"], pre_tax)
+    invoice_total = header["invoiceTotalAmount"]
+    expected_total = np.round(compared_pre_tax + np.nan_to_num(total_tax) - np.nan_to_num(header["discount"])
+                              + np.nan_to_num(header["roundOff"]), 2)
+
+    items_check = np.where(np.isnan(compared_pre_tax) | ~has_items, np.nan,
+                           np.abs(items_total - compared_pre_tax) <= TOTAL_TOLERANCE)
+    total_check = np.where(np.isnan(expected_total) | np.isnan(invoice_total), np.nan,
+                           np.abs(expected_total - invoice_total) <= TOTAL_TOLERANCE)
+    return {
+        "items_total": items_total, "pre_tax_total": compared_pre_tax, "tax_total": total_tax,
+        "expected_total": expected_total, "invoice_total": invoice_total,
+        "items_match_pre_tax": items_check, "total_matches": total_check,
+        "filled_pre_tax": pre_tax, "filled_total_tax": total_tax
+    }
+
+def optional(values):
+    return [None if value != value else value for value in values.tolist()]
+
+def optional_bool(values):
+    return [None if value != value else bool(value) for value in values.tolist()]
+
+# Function to write the parsed values back over the strings they were read from, and
+# the filled values into empty cells; returns how many strings held no number
+def write_back(rows, columns, texts, filled=()):
+    unparsed = 0
+    for field, column in columns.items():
+        parsed = ~np.isnan(column)
+        unparsed += int((texts[field] & ~parsed).sum())
+        write = texts[field] & parsed
+        if field in filled:
+            write |= filled[field]
+        for index in np.flatnonzero(write).tolist():
+            rows[index][field] = float(column[index])
+    return unparsed
+
+# Function to normalize the amounts of merged invoices (merge_invoice_data values) in place:
+# amount strings become numbers, missing subtotals are filled, "reconciliation" gets the
+# checks and "amounts" the invoice's currency, exchange rate and INR totals.
+# Returns counts for the stage record.
+def normalize_invoices(merged_data, table=None):
+    invoices = list(merged_data.values())
+    columns = amount_columns(invoices)
+    checks = reconcile_columns(columns)
+    rates, rate_dates = (table or rate_table()).rates(columns["currency"], columns["date"])
+    header = columns["header"]
+    filled = {field: np.isnan(header[field]) & ~np.isnan(checks[name])
+              for field, name in (("totalAmountPreTax", "filled_pre_tax"), ("totalTax", "filled_total_tax"))}
+    header["totalAmountPreTax"], header["totalTax"] = checks["filled_pre_tax"], checks["filled_total_tax"]
+    # A field keeps its original text when it held no number
+    unparsed = write_back(columns["headers"], header, columns["header_text"], filled)
+    unparsed += write_back(columns["item_rows"], columns["items"], columns["item_text"])
+
+    reconciliation = {name: (optional_bool if name in ("items_match_pre_tax", "total_matches") else optional)(checks[name])
+                      for name in ("items_total", "pre_tax_total", "tax_total", "expected_total", "invoice_total",
+                                   "items_match_pre_tax", "total_matches")}
+    inr = {name: optional(np.round(column * rates, 2)) for name, column in
+           (("pre_tax_inr", checks["pre_tax_total"]), ("tax_inr", checks["tax_total"]), ("total_inr", header["invoiceTotalAmount"]))}
+    rate_list, rate_date_list = optional(rates), [None if np.isnat(d) else str(d) for d in rate_dates]
+    for n, invoice in enumerate(invoices):
+        invoice["reconciliation"] = {**invoice.get("reconciliation", {}),
+                                     **{name: values[n] for name, values in reconciliation.items()}}
+        invoice["amounts"] = {"currency": columns["currency"][n], "exchange_rate": rate_list[n],
+                              "rate_date": rate_date_list[n], **{name: values[n] for name, values in inr.items()}}
+
+    return {
+        "items": len(columns["item_rows"]),
+        "unparsed_amounts": unparsed,
+        "unconverted": int(np.isnan(rates).sum()),
+        "total_mismatches": int((checks["total_matches"] == 0).sum()),
+        "item_mismatches": int((checks["items_match_pre_tax"] == 0).sum())
+    }
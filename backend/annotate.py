@@ -0,0 +1,107 @@
+# annotate.py
+# On-demand rendering of OCR annotations (boxes + recognised text coloured by
+# confidence). Extraction only stores the OCR boxes next to its results; the
+# annotated image is drawn when the UI asks for it, optionally at preview size,
+# and the rendered file is reused until the OCR data changes.
+import json
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+from PIL import Image, ImageDraw, ImageFont
+
+from workspace import atomic_write_json
+
+# Confidence at or above which boxes are drawn green rather than red
+HIGH_CONFIDENCE = 0.97
+RENDER_CACHE_SIZE = 256
+
+_rendered = OrderedDict()  # (ocr_path, max_size, ocr mtime) -> annotated image path
+_rendered_lock = threading.Lock()
+
+# Function to load the annotation font once per size
+@lru_cache(maxsize=8)
+def get_font(size=14):
+    for name in ('arial.ttf', 'DejaVuSans.ttf'):
+        try:
+            return ImageFont.truetype(name, size=size)
+        except OSError:
+            continue
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:  # Pillow < 10.1
+        return ImageFont.load_default()
+
+# Function to write the OCR boxes a page was extracted from, so it can be annotated later
+def save_ocr_data(path, boxes, texts, scores, width, height, source_path=None, page_number=None):
+    atomic_write_json(path, {
+        "source_path": os.path.abspath(source_path) if source_path else None,
+        "page_number": page_number,
+        "width": width,
+        "height": height,
+        "boxes": boxes,
+        "texts": texts,
+        "scores": scores
+    })
+
+# Function to draw OCR boxes onto an image in place; `scale` maps OCR coordinates to the image
+def draw_annotations(image, boxes, texts, scores, scale=1.0):
+    draw = ImageDraw.Draw(image)
+    font = get_font(max(8, int(round(14 * scale))))
+    for box, text, score in zip(boxes, texts, scores):
+        text_color = (0, 255, 0) if score >= HIGH_CONFIDENCE else (255, 0, 0)
+        points = [(x * scale, y * scale) for x, y in box]
+        draw.polygon(points, outline=text_color)
+        draw.text((points[0][0], points[0][1] - 10 * scale), f"{text} ({score:.2f})", font=font, fill=text_color)
+    return image
+
+# Function to load the page an OCR data file refers to, at most max_size pixels on its long side
+def load_source_image(ocr_data, max_size=None):
+    source_path = ocr_data["source_path"]
+    if source_path.lower().endswith('.pdf'):
+        from pdf2image import convert_from_path
+        # Rasterize straight at preview size instead of rendering full size and shrinking
+        image = convert_from_path(
+            source_path,
+            first_page=ocr_data["page_number"],
+            last_page=ocr_data["page_number"],
+            size=max_size
+        )[0]
+    else:
+        image = Image.open(source_path)
+        if max_size:
+            image.draft('RGB', (max_size, max_size))
+            image.thumbnail((max_size, max_size))
+    return image.convert('RGB')
+
+# Function to render (or reuse) the annotated image for an OCR data file; returns its path
+def render_annotated_image(ocr_path, max_size=None):
+    ocr_mtime = os.path.getmtime(ocr_path)
+    cache_key = (os.path.abspath(ocr_path), max_size, ocr_mtime)
+    with _rendered_lock:
+        cached = _rendered.get(cache_key)
+        if cached and os.path.exists(cached):
+            _rendered.move_to_end(cache_key)
+            return cached
+
+    stem = ocr_path[:-len("_ocr.json")] if ocr_path.endswith("_ocr.json") else os.path.splitext(ocr_path)[0]
+    output_path = f"{stem}_annotated.jpg" if not max_size else f"{stem}_annotated_{max_size}.jpg"
+
+    # A file rendered from the current OCR data (e.g. by an earlier worker) is still valid
+    if not (os.path.exists(output_path) and os.path.getmtime(output_path) >= ocr_mtime):
+        with open(ocr_path, 'r', encoding='utf-8') as f:
+            ocr_data = json.load(f)
+        image = load_source_image(ocr_data, max_size)
+        scale = image.size[0] / ocr_data["width"] if ocr_data.get("width") else 1.0
+        draw_annotations(image, ocr_data["boxes"], ocr_data["texts"], ocr_data["scores"], scale)
+        # Unique temp name so two workers rendering the same page don't collide
+        tmp_path = f"{output_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        image.save(tmp_path, 'JPEG', quality=85)
+        os.replace(tmp_path, output_path)
+
+    with _rendered_lock:
+        _rendered[cache_key] = output_path
+        while len(_rendered) > RENDER_CACHE_SIZE:
+            _rendered.popitem(last=False)
+    return output_path
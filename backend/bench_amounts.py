@@ -0,0 +1,165 @@
+# bench_amounts.py
+# Time to normalize and reconcile a month of merged invoices (see amounts.py), against
+# doing the same one invoice and one field at a time. Invoices are synthetic: a share of
+# them in USD or EUR, a few with totals that don't add up, and amounts either as numbers
+# (what validation.py leaves after coercing the LLM's output) or, as the worst case, as
+# strings in Indian, Western and decimal-comma formats. The arithmetic checks and currency
+# conversion on their own (given the parsed columns) are timed separately. Before anything is
+# timed, PARSE_CASES are read by both parse_amount and the vectorized parse_strings, which
+# must agree with each other and with the expected number.
+#
+# Usage: python bench_amounts.py [--invoices 3000] [--items 8] [--runs 5] [--output report.json]
+import argparse
+import copy
+import json
+import math
+import random
+import sys
+import statistics
+import time
+
+import numpy as np
+
+import amounts
+from merging import to_number
+
+FORMATS = (
+    lambda x: round(x, 2),
+    lambda x: f"{x:,.2f}",
+    lambda x: f"₹ {indian(x)}",
+    lambda x: f"{x:,.2f}".replace(",", " ").replace(".", ",").replace(" ", "."),
+    lambda x: f"Rs. {x:.2f}"
+)
+
+# Amount strings and the number each must read as (None: no number)
+PARSE_CASES = [
+    ("1,23,456.50", 123456.5), ("123,456.50", 123456.5), ("1.234,56", 1234.56), ("12,50", 12.5),
+    ("1 234 567,89", 1234567.89), ("1'234.50", 1234.5), ("₹ 1,23,456.50", 123456.5), ("Rs. 500", 500.0),
+    ("Rs.50", 50.0), ("$ 1,200", 1200.0), ("1,500/-", 1500.0), ("(500)", -500.0), ("-500", -500.0),
+    ("\u2212500", -500.0), ("\u2212 1,200.50", -1200.5), (".50", 0.5), (",50", 0.5), ("Total: .75", 0.75),
+    ("2.5 lakh", 250000.0), ("3 lacs", 300000.0), ("1.5 crore", 15000000.0), ("5 Cr", 50000000.0),
+    ("5cr", 50000000.0), ("Credit 500", 500.0), ("1.234", 1.234), ("1.234.567", 1234567.0), ("nil", None), ("", None)
+]
+
+# Function to read PARSE_CASES one at a time and as one batch; returns the cases either got wrong
+def check_parsing():
+    batch = amounts.parse_strings(np.array([text for text, _ in PARSE_CASES])).tolist()
+    failures = []
+    for (text, expected), vectorized in zip(PARSE_CASES, batch):
+        scalar = amounts.parse_amount(text)
+        vectorized = None if math.isnan(vectorized) else vectorized
+        if scalar != expected or vectorized != expected:
+            failures.append({"text": text, "expected": expected, "parse_amount": scalar, "parse_strings": vectorized})
+    return failures
+
+# Function to format an amount with Indian grouping ("12,34,567.50")
+def indian(x):
+    whole, fraction = f"{x:.2f}".split(".")
+    head, tail = whole[:-3], whole[-3:]
+    groups = []
+    while head:
+        groups.insert(0, head[-2:])
+        head = head[:-2]
+    return ",".join(groups + [tail]) + "." + fraction
+
+# Function to make a month of merged invoices, keyed like merge_invoice_data's result
+def synthetic_month(count, items, rng, strings=True):
+    merged = {}
+    for n in range(count):
+        fmt = rng.choice(FORMATS) if strings else FORMATS[0]
+        lines = [round(rng.uniform(10, 50000), 2) for _ in range(rng.randint(1, 2 * items - 1))]
+        pre_tax = round(sum(lines), 2)
+        tax = round(pre_tax * 0.09, 2)
+        total = round(pre_tax + 2 * tax, 2) + (500 if rng.random() < 0.02 else 0)
+        merged[f"INV{n}"] = {
+            "structured_data": {
+                "invoiceNumber": f"INV{n}", "invoiceDate": f"{rng.randint(1, 28):02d}/03/2024",
+                "currency": rng.choices(["INR", "USD", "EUR"], [0.8, 0.15, 0.05])[0],
+                "cgst": fmt(tax), "sgst": fmt(tax), "totalAmountPreTax": fmt(pre_tax),
+                "invoiceTotalAmount": fmt(total),
+                "items": [{"description": f"item {i}", "quantity": 1, "pricePerUnit": fmt(x), "amount": fmt(x)}
+                          for i, x in enumerate(lines)]
+            },
+            "reconciliation": {"duplicate_items_dropped": 0}
+        }
+    return merged
+
+# Function to do the same work invoice by invoice, field by field
+def per_invoice(merged, table):
+    for invoice in merged.values():
+        header = invoice["structured_data"]
+        for field in amounts.HEADER_FIELDS:
+            if field in header:
+                header[field] = to_number(header[field])
+        for item in header["items"]:
+            for field in amounts.ITEM_FIELDS:
+                if field in item:
+                    item[field] = to_number(item[field])
+        items_total = sum(item["amount"] or 0.0 for item in header["items"])
+        taxes = sum(header.get(field) or 0.0 for field in amounts.TAX_FIELDS)
+        pre_tax = header.get("totalAmountPreTax")
+        rate = table.rates([amounts.currency_code(header.get("currency"))],
+                           [amounts.date_column([header.get("invoiceDate")])[0]])[0][0]
+        invoice["reconciliation"].update({
+            "items_match_pre_tax": abs(items_total - pre_tax) <= amounts.TOTAL_TOLERANCE,
+            "total_matches": abs(pre_tax + taxes - header["invoiceTotalAmount"]) <= amounts.TOTAL_TOLERANCE
+        })
+        invoice["amounts"] = {"total_inr": header["invoiceTotalAmount"] * rate}
+
+# Function to check and convert already parsed columns
+def reconcile(columns, table):
+    amounts.reconcile_columns(columns)
+    return table.rates(columns["currency"], columns["date"])
+
+def timed(function, merged, table, runs):
+    seconds = []
+    for _ in range(runs):
+        batch = copy.deepcopy(merged)
+        start = time.perf_counter()
+        result = function(batch, table)
+        seconds.append(time.perf_counter() - start)
+    return seconds, result, batch
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Batch amount normalization benchmark")
+    parser.add_argument("--invoices", type=int, default=3000, help="invoices in the batch (a month for a busy account)")
+    parser.add_argument("--items", type=int, default=8, help="average line items per invoice")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the report to this JSON file")
+    args = parser.parse_args()
+
+    failures = check_parsing()
+    if failures:
+        print(json.dumps({"parse_failures": failures}, indent=2, ensure_ascii=False))
+        sys.exit(1)
+
+    merged = synthetic_month(args.invoices, args.items, random.Random(args.seed))
+    numeric = synthetic_month(args.invoices, args.items, random.Random(args.seed), strings=False)
+    table = amounts.RateTable([("USD", "2024-03-01", 82.9), ("USD", "2024-03-15", 83.1),
+                               ("EUR", "2024-03-01", 90.2), ("EUR", "2024-03-15", 90.6)])
+    batch_seconds, summary, batch = timed(amounts.normalize_invoices, merged, table, args.runs)
+    numeric_seconds, _, _ = timed(amounts.normalize_invoices, numeric, table, args.runs)
+    reconcile_seconds, _, _ = timed(reconcile, amounts.amount_columns(list(merged.values())), table, args.runs)
+    loop_seconds, _, loop = timed(per_invoice, merged, table, args.runs)
+    # Both must agree on which invoices add up
+    disagreements = sum(batch[key]["reconciliation"]["total_matches"] != loop[key]["reconciliation"]["total_matches"]
+                        for key in merged)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "parse_cases": len(PARSE_CASES),
+        "invoices": args.invoices,
+        "items": summary["items"],
+        "batch_ms": round(statistics.median(batch_seconds) * 1000, 2),
+        "batch_numeric_ms": round(statistics.median(numeric_seconds) * 1000, 2),
+        "reconcile_ms": round(statistics.median(reconcile_seconds) * 1000, 2),
+        "per_invoice_ms": round(statistics.median(loop_seconds) * 1000, 2),
+        "total_mismatches": summary["total_mismatches"],
+        "unconverted": summary["unconverted"],
+        "disagreements": disagreements
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
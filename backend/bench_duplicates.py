@@ -0,0 +1,101 @@
+# bench_duplicates.py
+# Lookup latency of the duplicate index (see duplicates.py) as it grows. The index is filled
+# with synthetic files: invoices drawn from a few thousand layouts, so pages of the same
+# layout share most of their perceptual hash, as real invoices from one seller do. Then
+# it is queried for exact re-uploads, near duplicates (a few hash bits flipped, as a rescan
+# would), unseen files, and invoice keys, and the latency of each kind is reported.
+#
+# Usage: python bench_duplicates.py [--files 200000] [--layouts 2000] [--queries 2000]
+#                                   [--db /tmp/duplicates_bench.db] [--output report.json]
+import argparse
+import json
+import os
+import random
+import time
+
+import duplicates
+from bench_pipeline import percentile
+
+SETTINGS = "bench"
+
+def flip_bits(phash, bits, rng):
+    value = int.from_bytes(phash, "big")
+    for bit in rng.sample(range(len(phash) * 8), bits):
+        value ^= 1 << bit
+    return value.to_bytes(len(phash), "big")
+
+# Function to make the hash of a new invoice: its layout's hash with the variable parts changed
+def invoice_hash(layout, rng):
+    return flip_bits(layout, rng.randint(40, 90), rng)
+
+def invoice_key(n):
+    return f"27ABCDE{n % 10000:04d}F1Z5|INV{n}|2024-04-01|{n % 100000}.00"
+
+# Function to fill the index with `files` synthetic files; returns what the queries need
+def populate(index, files, layouts, rng, chunk=5000):
+    layout_hashes = [rng.randbytes(32) for _ in range(layouts)]
+    stored = []
+    for start in range(0, files, chunk):
+        records = []
+        for n in range(start, min(start + chunk, files)):
+            phash = invoice_hash(rng.choice(layout_hashes), rng)
+            file_hash = f"{n:064x}"
+            records.append((file_hash, f"invoice{n}.pdf", SETTINGS, [{"page_number": 1}], [phash], [(1, invoice_key(n))]))
+            stored.append((file_hash, phash))
+        index.add_many(records)
+    return layout_hashes, stored
+
+# Function to time each lookup; returns (microsecond timings, hits)
+def timed(lookups):
+    timings, hits = [], 0
+    for lookup in lookups:
+        start = time.perf_counter()
+        hits += lookup() is not None
+        timings.append((time.perf_counter() - start) * 1e6)
+    return timings, hits
+
+def summarize(timings, hits):
+    return {"queries": len(timings), "hits": hits, "p50_us": round(percentile(timings, 50), 1),
+            "p99_us": round(percentile(timings, 99), 1), "mean_us": round(sum(timings) / len(timings), 1)}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Duplicate index lookup benchmark")
+    parser.add_argument("--files", type=int, default=200000)
+    parser.add_argument("--layouts", type=int, default=2000)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--flipped-bits", type=int, default=8, help="hash bits a near duplicate differs in")
+    parser.add_argument("--db", default=os.path.join("/tmp", "duplicates_bench.db"))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the report to this JSON file")
+    args = parser.parse_args()
+
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(args.db + suffix):
+            os.remove(args.db + suffix)
+    rng = random.Random(args.seed)
+    index = duplicates.DuplicateIndex(args.db)
+    start = time.perf_counter()
+    layout_hashes, stored = populate(index, args.files, args.layouts, rng)
+    fill_seconds = time.perf_counter() - start
+
+    picks = [rng.choice(stored) for _ in range(args.queries)]
+    lookups = {
+        "file_hash": [lambda f=f: index.find_file(f, SETTINGS) for f, _ in picks],
+        "near_duplicate": [lambda p=p: index.find_file("new", SETTINGS, [flip_bits(p, args.flipped_bits, rng)]) for _, p in picks],
+        "unseen": [lambda: index.find_file("new", SETTINGS, [invoice_hash(rng.choice(layout_hashes), rng)])
+                   for _ in range(args.queries)],
+        "invoice_key": [lambda n=n: (index.find_invoices([(1, invoice_key(n))]) or None)
+                        for n in (rng.randrange(args.files) for _ in range(args.queries))]
+    }
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "files": index.count(),
+        "layouts": args.layouts,
+        "fill_seconds": round(fill_seconds, 2),
+        "db_mb": round(os.path.getsize(args.db) / 2**20, 1),
+        "lookups": {kind: summarize(*timed(calls)) for kind, calls in lookups.items()}
+    }
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
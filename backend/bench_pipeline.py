@@ -0,0 +1,241 @@
+# bench_pipeline.py
+# Offline benchmark of the OCR-to-JSON pipeline
+# (extract_text_from_image -> process_text -> merge_invoice_data).
+# A synthetic corpus of JPG/PNG/multi-page PDF invoices is generated at several DPIs and
+# box densities, the LLM is replaced by stub_openai.py with fixed latency, and throughput,
+# per-stage latency percentiles and peak memory are reported for each worker count.
+#
+# Usage: python bench_pipeline.py [--workers 1,2,4] [--dpi 100,200] [--densities 5,30]
+#                                 [--save-baseline baseline.json] [--compare baseline.json]
+import argparse
+import json
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageDraw, ImageFont
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# A4 in inches
+PAGE_SIZE_IN = (8.27, 11.69)
+
+ITEM_NAMES = ["Copper wire 2.5mm", "PVC conduit 20mm", "MCB 32A", "LED panel 18W", "Cable tray 100mm",
+              "Junction box", "Distribution board", "Earthing rod", "Switch socket 16A", "Lugs 10sqmm"]
+
+# Function to load a font scaled to the page DPI, falling back to PIL's built-in font
+def load_font(dpi):
+    size = max(8, int(dpi * 0.14))
+    for name in ("DejaVuSans.ttf", "arial.ttf"):
+        try:
+            return ImageFont.truetype(name, size=size)
+        except OSError:
+            continue
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:  # Pillow < 10.1
+        return ImageFont.load_default()
+
+# Function to render one synthetic invoice page; returns (image, ground_truth)
+def render_invoice_page(rng, dpi, item_rows, page_number=1, page_count=1):
+    width, height = int(PAGE_SIZE_IN[0] * dpi), int(PAGE_SIZE_IN[1] * dpi)
+    image = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(image)
+    font = load_font(dpi)
+    line_height = int(dpi * 0.22)
+    x, y = int(dpi * 0.5), int(dpi * 0.5)
+
+    invoice_number = f"INV-{rng.randint(1000, 9999)}"
+    gstin = f"27{''.join(rng.choice('ABCDEFGHJKLMNPQRSTUVWXYZ') for _ in range(5))}{rng.randint(1000, 9999)}A1Z{rng.randint(1, 9)}"
+    header = [
+        "TAX INVOICE",
+        f"Invoice No: {invoice_number}",
+        f"Invoice Date: {rng.randint(1, 28):02d}/{rng.randint(1, 12):02d}/2024",
+        f"GSTIN: {gstin}",
+        "Seller: Sahyadri Electricals Pvt Ltd",
+        "Buyer: Konkan Infra Projects LLP",
+        f"Page {page_number} of {page_count}"
+    ]
+    lines = list(header)
+    total = 0.0
+    for i in range(item_rows):
+        quantity = rng.randint(1, 50)
+        price = round(rng.uniform(10, 5000), 2)
+        amount = round(quantity * price, 2)
+        total += amount
+        lines.append(f"{i + 1}. {rng.choice(ITEM_NAMES)}  HSN 8544  {quantity} Nos  {price:,.2f}  {amount:,.2f}")
+    lines.append(f"Total: {total:,.2f}")
+
+    for line in lines:
+        if y + line_height > height - dpi * 0.5:
+            break
+        draw.text((x, y), line, fill="black", font=font)
+        y += line_height
+
+    truth = {"invoiceNumber": invoice_number, "gst": gstin, "lines": lines}
+    return image, truth
+
+# Function to (re)generate the benchmark corpus; returns the list of files
+def generate_corpus(directory, dpis, densities, pdf_pages=3, seed=0):
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    files = []
+    truths = {}
+    for dpi in dpis:
+        for density in densities:
+            stem = f"dpi{dpi}_rows{density}"
+
+            image, truth = render_invoice_page(rng, dpi, density)
+            for ext, fmt in (("jpg", "JPEG"), ("png", "PNG")):
+                path = os.path.join(directory, f"{stem}.{ext}")
+                image.save(path, fmt)
+                files.append(path)
+                truths[os.path.basename(path)] = [truth]
+
+            pages = [render_invoice_page(rng, dpi, density, n + 1, pdf_pages) for n in range(pdf_pages)]
+            path = os.path.join(directory, f"{stem}.pdf")
+            pages[0][0].save(path, "PDF", resolution=dpi, save_all=True, append_images=[p[0] for p in pages[1:]])
+            files.append(path)
+            truths[os.path.basename(path)] = [p[1] for p in pages]
+
+    with open(os.path.join(directory, "ground_truth.json"), "w") as f:
+        json.dump(truths, f, indent=2)
+    return files
+
+# Function to compute the p-th percentile of a list of numbers
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(p / 100 * (len(ordered) - 1)))))
+    return ordered[index]
+
+# Function to summarise stage records into per-stage latency percentiles
+def stage_latencies(records):
+    stages = {}
+    for record in records:
+        stages.setdefault(record["stage"], []).append(record["wall_seconds"])
+    return {
+        name: {
+            "count": len(values),
+            "p50": round(percentile(values, 50), 4),
+            "p95": round(percentile(values, 95), 4),
+            "p99": round(percentile(values, 99), 4)
+        }
+        for name, values in stages.items()
+    }
+
+# Function to run the whole corpus once with `workers` OCR processes
+def run_once(d2, corpus_dir, workers):
+    d2.instrumentation.reset()
+    d2.OCR_PROCESSES = workers
+    output_folder = tempfile.mkdtemp(prefix="bench_annotated_")
+
+    start = time.perf_counter()
+    d2.process_invoice_images(corpus_dir, output_folder=output_folder)
+    elapsed = time.perf_counter() - start
+
+    records = d2.instrumentation.records()
+    pages = sum(1 for r in records if r["stage"] == "extract_text_from_image")
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    return {
+        "workers": workers,
+        "pages": pages,
+        "seconds": round(elapsed, 3),
+        "pages_per_sec": round(pages / elapsed, 3) if elapsed else 0.0,
+        "stages": stage_latencies(records),
+        "peak_rss_mb": round(self_rss, 1),
+        "peak_child_rss_mb": round(children_rss, 1)
+    }
+
+# Function to compare a run against a saved baseline; returns a list of regressions
+def compare(report, baseline, tolerance):
+    regressions = []
+    previous_runs = {run["workers"]: run for run in baseline.get("runs", [])}
+    for run in report["runs"]:
+        previous = previous_runs.get(run["workers"])
+        if not previous:
+            continue
+        if run["pages_per_sec"] < previous["pages_per_sec"] * (1 - tolerance):
+            regressions.append(f"workers={run['workers']}: throughput {previous['pages_per_sec']} -> {run['pages_per_sec']} pages/sec")
+        for name, latency in run["stages"].items():
+            before = previous["stages"].get(name)
+            if before and before["p95"] > 0 and latency["p95"] > before["p95"] * (1 + tolerance):
+                regressions.append(f"workers={run['workers']}: {name} p95 {before['p95']}s -> {latency['p95']}s")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline OCR-to-JSON pipeline benchmark")
+    parser.add_argument("--corpus", default=os.path.join(HERE, "bench_corpus"))
+    parser.add_argument("--workers", default="1,2,4", help="comma-separated OCR process counts")
+    parser.add_argument("--dpi", default="100,200", help="comma-separated rasterization DPIs")
+    parser.add_argument("--densities", default="5,30", help="comma-separated item rows per page")
+    parser.add_argument("--pdf-pages", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="stub LLM latency in seconds")
+    parser.add_argument("--save-baseline", help="write the report to this JSON file")
+    parser.add_argument("--compare", help="compare against a baseline JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="allowed regression ratio")
+    args = parser.parse_args()
+
+    files = generate_corpus(
+        args.corpus,
+        [int(v) for v in args.dpi.split(",")],
+        [int(v) for v in args.densities.split(",")],
+        pdf_pages=args.pdf_pages,
+        seed=args.seed
+    )
+
+    # The stub must be up before d2 builds its OpenAI clients, which read OPENAI_BASE_URL
+    from stub_openai import start_stub_server
+    stub, base_url = start_stub_server(latency=args.llm_latency, jitter=0.0, seed=args.seed)
+    os.environ["OPENAI_BASE_URL"] = base_url
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+    # Every run must pay for OCR and the LLM round trip: no caches, no page manifests, no
+    # duplicate index, and nothing left over from an earlier benchmark in the cache directory
+    os.environ["INVOICY_CACHE"] = "0"
+    os.environ["INCREMENTAL"] = "0"
+    os.environ["DEDUP"] = "0"
+    os.environ["INVOICY_CACHE_DIR"] = tempfile.mkdtemp(prefix="bench_cache_")
+    os.chdir(HERE)
+    sys.path.insert(0, HERE)
+    import d2
+
+    # Keep the report readable: pipeline events and prints go to a scratch file
+    events_log = open(os.path.join(tempfile.gettempdir(), "bench_pipeline_events.log"), "w")
+    d2._event_out = events_log
+    real_stdout = sys.stdout
+    sys.stdout = events_log
+
+    try:
+        runs = [run_once(d2, args.corpus, int(w)) for w in args.workers.split(",")]
+    finally:
+        sys.stdout = real_stdout
+        events_log.close()
+        stub.shutdown()
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "corpus": {"files": len(files), "dpi": args.dpi, "densities": args.densities, "pdf_pages": args.pdf_pages, "seed": args.seed},
+        "llm_latency": args.llm_latency,
+        "runs": runs
+    }
+    print(json.dumps(report, indent=2))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print("Regressions against baseline:", file=sys.stderr)
+            for line in regressions:
+                print(f"  {line}", file=sys.stderr)
+            sys.exit(1)
+        print("No regressions against baseline.", file=sys.stderr)
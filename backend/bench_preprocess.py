@@ -0,0 +1,239 @@
+# bench_preprocess.py
+# Accuracy against OCR time for each preprocessing setting (see preprocess.py).
+# Synthetic invoice pages are generated the way real uploads arrive — clean renders,
+# 300/400 DPI scans, skewed and sideways scans, upside-down pages, phone photos with wide
+# margins, slightly skewed tables without ruled lines, and image-only PDFs — and each page
+# is OCR'd under every setting. Accuracy is
+# the character similarity of the OCR text to the page's ground truth plus whether the
+# invoice number and GSTIN were read exactly; time is wall seconds per page.
+#
+# Usage: python bench_preprocess.py [--targets 16,24,32] [--dpi 150,200,300] [--rows 20]
+#                                   [--only clean,skewed] [--output report.json]
+import argparse
+import difflib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageDraw
+
+from bench_pipeline import ITEM_NAMES, PAGE_SIZE_IN, load_font, percentile, render_invoice_page
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Function to place a page on a larger background, as a phone photo of a sheet on a desk would be
+def photographed(page, scale=1.6, background=(120, 110, 100)):
+    width, height = int(page.width * scale), int(page.height * scale)
+    photo = Image.new("RGB", (width, height), background)
+    photo.paste(page, ((width - page.width) // 2, (height - page.height) // 2))
+    return photo.rotate(-3, expand=True, fillcolor=background)
+
+# Function to render a page that is mostly a table without ruled lines: every cell starts at
+# its column's fixed position and descriptions are a single word, so the columns line up
+# down the page as evenly as the rows do; returns (image, ground_truth)
+def render_table_page(rng, dpi, rows):
+    width, height = int(PAGE_SIZE_IN[0] * dpi), int(PAGE_SIZE_IN[1] * dpi)
+    page = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(page)
+    font = load_font(dpi)
+    line_height = int(dpi * 0.22)
+    y = int(dpi * 0.5)
+
+    invoice_number = f"INV-{rng.randint(1000, 9999)}"
+    gstin = f"27{''.join(rng.choice('ABCDEFGHJKLMNPQRSTUVWXYZ') for _ in range(5))}{rng.randint(1000, 9999)}A1Z{rng.randint(1, 9)}"
+    lines = [f"Invoice No: {invoice_number}", f"GSTIN: {gstin}"]
+    for line in lines:
+        draw.text((int(dpi * 0.5), y), line, fill="black", font=font)
+        y += line_height
+    columns = (0.5, 0.9, 3.4, 4.3, 5.2, 6.5)  # inches from the left edge
+    for i in range(rows):
+        if y + line_height > height - dpi * 0.5:
+            break
+        quantity = rng.randint(1, 50)
+        price = round(rng.uniform(10, 5000), 2)
+        cells = [str(i + 1), rng.choice(ITEM_NAMES).split()[0], "8544", str(quantity), f"{price:,.2f}", f"{quantity * price:,.2f}"]
+        for x, cell in zip(columns, cells):
+            draw.text((int(x * dpi), y), cell, fill="black", font=font)
+        lines.append(" ".join(cells))
+        y += line_height
+    return page, {"invoiceNumber": invoice_number, "gst": gstin, "lines": lines}
+
+# Skew angles of the borderless table pages: a few degrees either way, as a careless scan
+# leaves them. Their aligned columns must not be taken for sideways text.
+TABLE_SKEWS = (-3.5, -2.0, -1.0, 1.0, 2.0, 3.5)
+
+# Page variants: name -> (DPI the page is rendered at, function from the clean page to the upload)
+VARIANTS = {
+    "clean": (200, lambda page: page),
+    "scan300": (300, lambda page: page),
+    "scan400": (400, lambda page: page),
+    "skewed": (300, lambda page: page.rotate(2.5, expand=True, fillcolor="white")),
+    "sideways": (200, lambda page: page.rotate(90, expand=True, fillcolor="white")),
+    "upside-down": (200, lambda page: page.rotate(180)),
+    "photo": (400, photographed)
+}
+
+# Function to generate the corpus: one image per variant plus a multi-page image-only PDF
+def generate_corpus(directory, rows, pdf_pages=2, seed=0):
+    os.makedirs(directory, exist_ok=True)
+    rng = random.Random(seed)
+    pages = []
+    for name, (dpi, make_upload) in VARIANTS.items():
+        page, truth = render_invoice_page(rng, dpi, rows)
+        path = os.path.join(directory, f"{name}.png")
+        make_upload(page).save(path, "PNG")
+        pages.append({"variant": name, "path": path, "page_number": None, "truth": truth})
+    for angle in TABLE_SKEWS:
+        page, truth = render_table_page(rng, 200, 2 * rows)
+        path = os.path.join(directory, f"table{angle:+.1f}.png")
+        page.rotate(angle, expand=True, fillcolor="white").save(path, "PNG")
+        pages.append({"variant": "table-skewed", "path": path, "page_number": None, "truth": truth})
+
+    rendered = [render_invoice_page(rng, 300, rows, n + 1, pdf_pages) for n in range(pdf_pages)]
+    path = os.path.join(directory, "document.pdf")
+    rendered[0][0].save(path, "PDF", resolution=300, save_all=True, append_images=[p[0] for p in rendered[1:]])
+    for n, (_, truth) in enumerate(rendered):
+        pages.append({"variant": "pdf", "path": path, "page_number": n + 1, "truth": truth})
+    return pages
+
+# Function to score OCR text against a page's ground truth
+def accuracy(text, truth):
+    expected = "\n".join(truth["lines"])
+    compact = text.replace(" ", "")
+    return {
+        "similarity": difflib.SequenceMatcher(None, " ".join(text.split()), " ".join(expected.split())).ratio(),
+        "fields": sum(1 for field in ("invoiceNumber", "gst") if truth[field] in compact) / 2
+    }
+
+# Function to OCR one corpus page with the current settings; returns (seconds, text)
+def ocr_page(d2, page, output_folder):
+    start = time.perf_counter()
+    if page["page_number"]:
+        result = d2.ocr_pdf_page(page["path"], page["page_number"], annotated_folder=output_folder, save_pages=False)
+        text = result["extracted_text"]
+    else:
+        text = d2.extract_text_from_image(page["path"], output_folder=output_folder, annotate=False)[0]
+    return time.perf_counter() - start, text
+
+# Function to run every page under one setting, given as overrides of preprocess.py's settings
+def run_setting(d2, name, overrides, pages, repeat):
+    saved = {attr: getattr(d2.preprocess, attr) for attr in overrides}
+    for attr, value in overrides.items():
+        setattr(d2.preprocess, attr, value)
+    output_folder = tempfile.mkdtemp(prefix="bench_preprocess_")
+    try:
+        d2.instrumentation.reset()
+        variants = {}
+        for page in pages:
+            timings = []
+            for _ in range(repeat):
+                seconds, text = ocr_page(d2, page, output_folder)
+                timings.append(seconds)
+            scores = accuracy(text, page["truth"])
+            entry = variants.setdefault(page["variant"], {"seconds": [], "similarity": [], "fields": []})
+            entry["seconds"].append(min(timings))
+            entry["similarity"].append(scores["similarity"])
+            entry["fields"].append(scores["fields"])
+        records = [r for r in d2.instrumentation.records() if r["stage"] == "extract_text_from_image"]
+    finally:
+        for attr, value in saved.items():
+            setattr(d2.preprocess, attr, value)
+
+    seconds = [s for entry in variants.values() for s in entry["seconds"]]
+    similarity = [s for entry in variants.values() for s in entry["similarity"]]
+    fields = [f for entry in variants.values() for f in entry["fields"]]
+    return {
+        "setting": name,
+        "overrides": overrides,
+        "pages": len(seconds),
+        "seconds_per_page": round(sum(seconds) / len(seconds), 3),
+        "p95_seconds": round(percentile(seconds, 95), 3),
+        "similarity": round(sum(similarity) / len(similarity), 4),
+        "field_accuracy": round(sum(fields) / len(fields), 4),
+        "cls_skipped": sum(1 for r in records if r.get("cls") is False),
+        "cls_fallbacks": sum(1 for r in records if r.get("cls_fallback")),
+        "preprocess_seconds": round(sum(r.get("preprocess_seconds", 0.0) for r in records), 3),
+        "variants": {
+            variant: {
+                "seconds": round(sum(entry["seconds"]) / len(entry["seconds"]), 3),
+                "similarity": round(sum(entry["similarity"]) / len(entry["similarity"]), 4),
+                "field_accuracy": round(sum(entry["fields"]) / len(entry["fields"]), 4)
+            }
+            for variant, entry in variants.items()
+        }
+    }
+
+# Function to list the settings to compare: preprocessing off (the old pipeline), each target
+# text height, crop and deskew turned off one at a time, and fixed PDF DPIs
+def build_settings(targets, dpis):
+    settings = [("off", {"PREPROCESS": False, "PDF_DPI": 200})]
+    settings += [(f"text{target}px", {"PREPROCESS": True, "TARGET_TEXT_HEIGHT": target}) for target in targets]
+    settings += [
+        ("no-crop", {"PREPROCESS": True, "CROP_MARGINS": False}),
+        ("no-deskew", {"PREPROCESS": True, "DESKEW": False})
+    ]
+    settings += [(f"pdf{dpi}dpi", {"PREPROCESS": True, "PDF_DPI": dpi}) for dpi in dpis]
+    return settings
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OCR preprocessing accuracy/time benchmark")
+    parser.add_argument("--corpus", default=os.path.join(HERE, "bench_preprocess_corpus"))
+    parser.add_argument("--targets", default="16,24,32", help="comma-separated target text heights in pixels")
+    parser.add_argument("--dpi", default="150,200,300", help="comma-separated fixed PDF DPIs to compare with auto")
+    parser.add_argument("--rows", type=int, default=20, help="item rows per page")
+    parser.add_argument("--only", help="comma-separated variants to keep (e.g. clean,photo,pdf)")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per page; the fastest is kept")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the report to this JSON file")
+    args = parser.parse_args()
+
+    pages = generate_corpus(args.corpus, args.rows, seed=args.seed)
+    if args.only:
+        keep = set(args.only.split(","))
+        pages = [page for page in pages if page["variant"] in keep]
+
+    # d2 builds its OpenAI client at import time; no request is made here
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+    # Every setting must pay for OCR, not hit the cache
+    os.environ["INVOICY_CACHE"] = "0"
+    os.chdir(HERE)
+    sys.path.insert(0, HERE)
+    import d2
+
+    # Keep the report readable: pipeline events and prints go to a scratch file
+    events_log = open(os.path.join(tempfile.gettempdir(), "bench_preprocess_events.log"), "w")
+    d2._event_out = events_log
+    real_stdout = sys.stdout
+    sys.stdout = events_log
+    try:
+        # Warm the engine so the first setting doesn't pay for model loading
+        ocr_page(d2, pages[0], tempfile.mkdtemp(prefix="bench_preprocess_"))
+        runs = [run_setting(d2, name, overrides, pages, args.repeat)
+                for name, overrides in build_settings([int(v) for v in args.targets.split(",")],
+                                                      [int(v) for v in args.dpi.split(",")])]
+    finally:
+        sys.stdout = real_stdout
+        events_log.close()
+
+    # Orientation alone, without OCR: a skewed table read as sideways is turned a quarter turn
+    tables = [page for page in pages if page["variant"] == "table-skewed"]
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "corpus": {"pages": len(pages), "rows": args.rows, "seed": args.seed},
+        "tables_read_sideways": sum(1 for page in tables if abs(d2.preprocess.analyze(Image.open(page["path"]))["skew"]) > 45),
+        "runs": runs
+    }
+    print(json.dumps(report, indent=2))
+    baseline = runs[0]
+    print(f"{'setting':<14}{'s/page':>9}{'speedup':>9}{'similarity':>12}{'fields':>8}", file=sys.stderr)
+    for run in runs:
+        speedup = baseline["seconds_per_page"] / run["seconds_per_page"] if run["seconds_per_page"] else 0.0
+        print(f"{run['setting']:<14}{run['seconds_per_page']:>9.3f}{speedup:>8.2f}x{run['similarity']:>12.4f}{run['field_accuracy']:>8.2f}",
+              file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,150 @@
+# bench_startup.py
+# Startup benchmark: how long it takes to import the pipeline modules, to build the OCR
+# engine, to get the first OCR result out of a fresh process, and for the --serve worker
+# to become ready and answer its first request. Every measurement runs in a new
+# interpreter without OPENAI_API_KEY, so it also checks that nothing needs credentials
+# before the LLM is actually called. Results can be saved as a baseline and compared.
+#
+# Usage: python bench_startup.py [file] [--runs 3] [--save-baseline startup.json]
+#                                [--compare startup.json] [--tolerance 0.25]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Snippets timed inside a fresh interpreter; each prints the seconds it measured
+PROBES = {
+    "import_helpers": "import rules, merging, validation",
+    "import_d2": "import d2",
+    "build_ocr_engine": "import d2; start = time.perf_counter(); d2.get_ocr()",
+    "first_ocr": "import d2; d2.extract_text_from_image(sys.argv[1], output_folder=tempfile.mkdtemp())"
+}
+PROBE_TEMPLATE = """
+import sys, tempfile, time
+start = time.perf_counter()
+sys.stdout = sys.stderr
+{code}
+sys.__stdout__.write(str(time.perf_counter() - start))
+"""
+
+# Environment of every measured process: no credentials, no caches
+def probe_env():
+    env = {k: v for k, v in os.environ.items() if k != "OPENAI_API_KEY"}
+    env.update({"INVOICY_CACHE": "0", "OCR_ONLY": "1"})
+    return env
+
+# Function to run one probe in a new interpreter; returns (seconds inside, seconds including interpreter start)
+def run_probe(code, file_path):
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE_TEMPLATE.format(code=code), file_path],
+        cwd=HERE, env=probe_env(), capture_output=True, text=True
+    )
+    wall = time.perf_counter() - start
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else f"exit {result.returncode}")
+    return float(result.stdout.strip()), wall
+
+# Function to list the slowest modules d2 imports directly, from python -X importtime
+def slowest_imports(count=10):
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import d2"],
+                            cwd=HERE, env=probe_env(), capture_output=True, text=True)
+    imports = []
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            # Nesting is shown as two spaces per level; d2 is level 0, its own imports level 1
+            level = (len(parts[2]) - len(parts[2].lstrip()) - 1) // 2
+            if level == 1:
+                imports.append((parts[2].strip(), int(parts[1]) / 1e6))
+    imports.sort(key=lambda item: item[1], reverse=True)
+    return [{"module": name, "seconds": round(seconds, 4)} for name, seconds in imports[:count]]
+
+# Function to time the --serve worker: until "ready", then its first and second OCR requests
+def run_serve(file_path):
+    start = time.perf_counter()
+    worker = subprocess.Popen(
+        [sys.executable, "d2.py", "--serve", "--workers", "1", "--ocr-only"],
+        cwd=HERE, env=probe_env(), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+    )
+    try:
+        ready = json.loads(worker.stdout.readline())
+        if ready.get("event") != "ready":
+            raise RuntimeError(f"Unexpected worker handshake: {ready}")
+        timings = {"serve_ready": time.perf_counter() - start}
+        for request_id, name in enumerate(("serve_first_request", "serve_second_request")):
+            start = time.perf_counter()
+            worker.stdin.write(json.dumps({"id": request_id, "op": "ocr", "path": file_path}) + "\n")
+            worker.stdin.flush()
+            response = json.loads(worker.stdout.readline())
+            if not response.get("ok"):
+                raise RuntimeError(response.get("error"))
+            timings[name] = time.perf_counter() - start
+        return timings
+    finally:
+        worker.stdin.write(json.dumps({"op": "shutdown"}) + "\n")
+        worker.stdin.close()
+        worker.wait()
+
+def summarize(values):
+    return {"median_s": round(statistics.median(values), 4), "min_s": round(min(values), 4), "max_s": round(max(values), 4)}
+
+# Function to compare a report against a saved baseline; returns a list of regressions
+def compare(report, baseline, tolerance):
+    regressions = []
+    for name, timing in report["timings"].items():
+        before = baseline.get("timings", {}).get(name)
+        if before and before["median_s"] > 0 and timing["median_s"] > before["median_s"] * (1 + tolerance):
+            regressions.append(f"{name}: {before['median_s']}s -> {timing['median_s']}s")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import time and first-request latency benchmark")
+    parser.add_argument("file", nargs="?", default=os.path.join(HERE, "invoice4.jpg"))
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--skip-ocr", action="store_true", help="only time imports (no paddle needed)")
+    parser.add_argument("--save-baseline", help="write the report to this JSON file")
+    parser.add_argument("--compare", help="compare against a baseline JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed regression ratio")
+    args = parser.parse_args()
+
+    file_path = os.path.abspath(args.file)
+    probes = {name: code for name, code in PROBES.items()
+              if not args.skip_ocr or name.startswith("import")}
+    samples = {}
+    for _ in range(args.runs):
+        for name, code in probes.items():
+            inside, wall = run_probe(code, file_path)
+            samples.setdefault(name, []).append(inside)
+            samples.setdefault(name + "_process", []).append(wall)
+        if not args.skip_ocr:
+            for name, seconds in run_serve(file_path).items():
+                samples.setdefault(name, []).append(seconds)
+
+    report = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "file": os.path.basename(file_path),
+        "runs": args.runs,
+        "timings": {name: summarize(values) for name, values in samples.items()},
+        "slowest_imports": slowest_imports()
+    }
+    print(json.dumps(report, indent=2))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        if regressions:
+            print("Regressions against baseline:", file=sys.stderr)
+            for line in regressions:
+                print(f"  {line}", file=sys.stderr)
+            sys.exit(1)
+        print("No regressions against baseline.", file=sys.stderr)
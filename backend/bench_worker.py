@@ -0,0 +1,89 @@
+# bench_worker.py
+# Compare per-invoice latency of cold `python d2.py <file>` spawns against the
+# warm `python d2.py --serve` worker pool.
+#
+# Usage: python bench_worker.py [file] [--runs N] [--workers N] [--op process|ocr]
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Function to summarise a list of latencies in seconds
+def summarize(latencies):
+    ordered = sorted(latencies)
+    return {
+        "runs": len(ordered),
+        "mean_s": round(statistics.mean(ordered), 3),
+        "p50_s": round(ordered[len(ordered) // 2], 3),
+        "max_s": round(ordered[-1], 3),
+        "total_s": round(sum(ordered), 3)
+    }
+
+# Function to time cold spawns, one fresh interpreter per invoice
+def bench_cold(file_path, runs, op):
+    if op == "ocr":
+        command = [sys.executable, "-c", "import sys, d2; d2.extract_text_from_image(sys.argv[1])", file_path]
+    else:
+        command = [sys.executable, "d2.py", file_path]
+
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(command, cwd=HERE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+# Function to time requests against a warm worker pool
+def bench_warm(file_path, runs, workers, op):
+    start = time.perf_counter()
+    worker = subprocess.Popen(
+        [sys.executable, "d2.py", "--serve", "--workers", str(workers)],
+        cwd=HERE, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+    )
+    try:
+        ready = json.loads(worker.stdout.readline())
+        if ready.get("event") != "ready":
+            raise RuntimeError(f"Unexpected worker handshake: {ready}")
+        startup = time.perf_counter() - start
+
+        latencies = []
+        for request_id in range(runs):
+            start = time.perf_counter()
+            worker.stdin.write(json.dumps({"id": request_id, "op": op, "path": file_path}) + "\n")
+            worker.stdin.flush()
+            response = json.loads(worker.stdout.readline())
+            if not response.get("ok"):
+                raise RuntimeError(response.get("error"))
+            latencies.append(time.perf_counter() - start)
+        return startup, latencies
+    finally:
+        worker.stdin.write(json.dumps({"op": "shutdown"}) + "\n")
+        worker.stdin.close()
+        worker.wait()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cold spawn vs warm worker latency")
+    parser.add_argument("file", nargs="?", default=os.path.join(HERE, "invoice4.jpg"))
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--op", choices=["process", "ocr"], default="ocr")
+    args = parser.parse_args()
+
+    file_path = os.path.abspath(args.file)
+    cold = bench_cold(file_path, args.runs, args.op)
+    startup, warm = bench_warm(file_path, args.runs, args.workers, args.op)
+
+    report = {
+        "file": os.path.basename(file_path),
+        "op": args.op,
+        "cold": summarize(cold),
+        "warm": summarize(warm),
+        "warm_startup_s": round(startup, 3),
+        "speedup": round(statistics.mean(cold) / statistics.mean(warm), 2)
+    }
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,150 @@
+# cache.py
+# Content-addressed on-disk cache for OCR output and LLM extractions.
+# Entries are JSON files named by a sha256 key; recency is tracked through the
+# file mtime so least-recently-used entries are evicted once the size limit is hit.
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+# Function to build a stable cache key from bytes/str/JSON-able parts
+def make_key(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, bytes):
+            data = part
+        elif isinstance(part, str):
+            data = part.encode('utf-8')
+        else:
+            data = json.dumps(part, sort_keys=True, separators=(',', ':')).encode('utf-8')
+        # Length prefix keeps ("ab", "c") and ("a", "bc") distinct
+        digest.update(len(data).to_bytes(8, 'big'))
+        digest.update(data)
+    return digest.hexdigest()
+
+# Function to hash a file's bytes without loading it all at once
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class DiskCache:
+    def __init__(self, directory, max_bytes, enabled=True):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._index = None  # path -> size, built lazily on first write
+        self._total_bytes = 0
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                value = json.load(f)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        try:
+            # Touch the entry so LRU eviction sees it as recently used
+            os.utime(path, None)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return value
+
+    def set(self, key, value):
+        if not self.enabled:
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        data = json.dumps(value).encode('utf-8')
+
+        # Write to a temp file and rename so concurrent readers never see partial entries
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+        with self._lock:
+            self._load_index()
+            self._total_bytes += len(data) - self._index.get(path, 0)
+            self._index[path] = len(data)
+            if self._total_bytes > self.max_bytes:
+                self._evict()
+
+    def _load_index(self):
+        if self._index is not None:
+            return
+        self._index = {}
+        self._total_bytes = 0
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if name.endswith('.json'):
+                    path = os.path.join(root, name)
+                    try:
+                        size = os.path.getsize(path)
+                    except OSError:
+                        continue
+                    self._index[path] = size
+                    self._total_bytes += size
+
+    def _evict(self):
+        # Evict down to 90% of the limit so we don't rescan on every write
+        target = self.max_bytes * 0.9
+        entries = []
+        for path in self._index:
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except OSError:
+                entries.append((0.0, path))
+        entries.sort()
+        for _, path in entries:
+            if self._total_bytes <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            self._total_bytes -= self._index.pop(path)
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            shutil.rmtree(self.directory, ignore_errors=True)
+            self._index = {}
+            self._total_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            self._load_index()
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._index),
+                "bytes": self._total_bytes,
+                "max_bytes": self.max_bytes
+            }
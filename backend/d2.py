@@ -1,244 +1,1024 @@
 # d2.py
+import argparse
+import asyncio
+import contextvars
 import os
 import json
 import sys
-from PIL import Image, ImageDraw, ImageFont
-from openai import OpenAI
-from paddleocr import PaddleOCR
-from pdf2image import convert_from_path
-from datetime import datetime
+import numpy as np
+from PIL import Image
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+import queue
+from collections import OrderedDict
+import threading
+import time
 import traceback
-
-# Initialize OpenAI client and PaddleOCR
-api_key = os.getenv("OPENAI_API_KEY")
-if not api_key:
-    raise ValueError("OPENAI_API_KEY not found in environment variables")
-client = OpenAI(api_key=api_key)
-ocr = PaddleOCR(use_angle_cls=True, lang='en', use_gpu=False)
+import uuid
+from contextlib import contextmanager
+from cache import DiskCache, file_digest, make_key
+from structuring import AsyncStructurer, estimate_tokens
+import instrumentation
+from workspace import JobWorkspace, atomic_write, maybe_cleanup_jobs
+from jobqueue import FileCheckpoint, JobQueue
+from manifest import PageManifest, fully_reusable
+import preprocess
+import rules
+import textlayer
+import triage
+import duplicates
+import amounts
+from rules import pre_extract, remaining_schema
+from merging import merge_pages, parse_structured
+from prompting import PROMPT_SCHEMA_MODE, RESPONSE_FORMAT, compact_prompt, layout_text, prompt_savings, reask_prompt
+import validation
+from annotate import draw_annotations, render_annotated_image, save_ocr_data
+from instrumentation import stage
+
+# The OpenAI client and the PaddleOCR engine are built on first use (get_client, get_ocr),
+# so importing this module is fast and needs no API key. With OCR_ONLY=1 (or --ocr-only)
+# pages are structured by the rules alone and OpenAI is never touched.
+OCR_ONLY = os.getenv("OCR_ONLY", "0") == "1"
+_client = None
+_ocr = None
+_factory_lock = threading.Lock()
+
+def get_api_key():
+    api_key = os.getenv("OPENAI_API_KEY")
+    if not api_key:
+        raise ValueError("OPENAI_API_KEY not found in environment variables")
+    return api_key
+
+def get_client():
+    global _client
+    with _factory_lock:
+        if _client is None:
+            from openai import OpenAI
+            _client = OpenAI(api_key=get_api_key())
+        return _client
+
+# Function to build a PaddleOCR engine; loading paddle and the models takes seconds
+def new_ocr_engine():
+    from paddleocr import PaddleOCR
+    return PaddleOCR(use_angle_cls=True, lang='en', use_gpu=False)
+
+# Function to return this process's shared OCR engine, building it on first use
+def get_ocr():
+    global _ocr
+    with _factory_lock:
+        if _ocr is None:
+            with stage("load_ocr_engine"):
+                _ocr = new_ocr_engine()
+        return _ocr
+
+# Number of processes used to OCR PDF pages in parallel, and how many pages may be
+# rasterized ahead of the OCR stage; together they bound peak memory per document
+OCR_PROCESSES = int(os.getenv("OCR_PROCESSES", "1"))
+PAGE_WINDOW = int(os.getenv("PAGE_WINDOW", "4"))
+# Rendered PDF pages are kept in memory unless page images are asked for
+SAVE_PAGE_IMAGES = os.getenv("SAVE_PAGE_IMAGES", "0") == "1"
+# Annotated images are rendered on demand unless eager rendering is asked for
+ANNOTATE_IMAGES = os.getenv("ANNOTATE_IMAGES", "0") == "1"
+# Files of queued jobs processed at once (0: one per warm engine), and how often idle queue threads look for work
+QUEUE_CONCURRENCY = int(os.getenv("QUEUE_CONCURRENCY", "0"))
+QUEUE_POLL_SECONDS = float(os.getenv("QUEUE_POLL_SECONDS", "1.0"))
+# Pages OCR'd without the angle classifier are redone with it below this mean confidence
+CLS_FALLBACK_CONFIDENCE = float(os.getenv("CLS_FALLBACK_CONFIDENCE", "0.8"))
+# Which backend reads PDF pages: "auto" takes a page's text layer when it has a usable one
+# and OCRs it otherwise, "paddleocr" OCRs every page, "textlayer" never OCRs (see textlayer.py)
+OCR_BACKEND = os.getenv("OCR_BACKEND", "auto")
+OCR_BACKENDS = ("auto", "paddleocr", "textlayer")
+
+# On-disk caches for OCR output and LLM extractions (INVOICY_CACHE=0 or --no-cache bypasses them)
+OCR_SETTINGS = {"engine": "paddleocr", "use_angle_cls": True, "lang": "en", "cls": True}
+LLM_MODEL = 'gpt-3.5-turbo-0125'
+# Fields that fail schema validation get one small follow-up request (REASK=0 turns it off)
+REASK_ENABLED = os.getenv("REASK", "1") != "0"
+REASK_MAX_TOKENS = 1024
+CACHE_DIR = os.getenv("INVOICY_CACHE_DIR", ".cache")
+CACHE_ENABLED = os.getenv("INVOICY_CACHE", "1") != "0"
+ocr_cache = DiskCache(os.path.join(CACHE_DIR, "ocr"), max_bytes=int(os.getenv("OCR_CACHE_MAX_MB", "512")) << 20, enabled=CACHE_ENABLED)
+llm_cache = DiskCache(os.path.join(CACHE_DIR, "llm"), max_bytes=int(os.getenv("LLM_CACHE_MAX_MB", "128")) << 20, enabled=CACHE_ENABLED)
+# Pages unchanged since a document was last processed are taken from its page manifest
+# instead of being OCR'd and structured again (INCREMENTAL=0 turns it off)
+INCREMENTAL = os.getenv("INCREMENTAL", "1") != "0"
+MANIFEST_DIR = os.getenv("INVOICY_MANIFEST_DIR", os.path.join(CACHE_DIR, "manifests"))
+# Where merged batches are exported as invoice/line-item tables when no directory is given
+EXPORT_DIR = os.getenv("INVOICY_EXPORT_DIR", "exports")
+# Files already processed byte for byte get their earlier result from the duplicate index
+# instead of being processed again, and so do rescans and re-renders of them once their OCR
+# text confirms the match; they skip the LLM (DEDUP=0 turns it off).
+# A document split across workers is recorded from its page manifest, so only while INCREMENTAL is on.
+DEDUP = os.getenv("DEDUP", "1") != "0"
+
+# OCR engine borrowed from the --serve worker pool by the work in this context (falls back
+# to the global one); a ContextVar, so the executor threads a request's pages are OCR'd on use it too
+_borrowed_engine = contextvars.ContextVar("ocr_engine", default=None)
+# Warm engines shared by request handlers and queue workers (None outside --serve/--drain)
+_engine_pool = None
+
+def get_ocr_engine():
+    engine = _borrowed_engine.get()
+    return engine if engine is not None else get_ocr()
+
+# Function to build the pool of warm engines; the shared engine is the first one
+def start_engine_pool(workers):
+    global _engine_pool
+    engines = queue.Queue()
+    engines.put(get_ocr())
+    for _ in range(workers - 1):
+        engines.put(new_ocr_engine())
+    _engine_pool = engines
+    return engines
+
+# Function to hold one warm engine for the duration of a block of work in this context
+@contextmanager
+def borrowed_engine():
+    if _engine_pool is None:
+        yield get_ocr_engine()
+        return
+    engine = _engine_pool.get()
+    token = _borrowed_engine.set(engine)
+    try:
+        yield engine
+    finally:
+        _borrowed_engine.reset(token)
+        _engine_pool.put(engine)
 
 # Function to load JSON schema
 def load_json_schema(schema_file: str) -> dict:
     with open(schema_file, 'r') as file:
         return json.load(file)
 
-# Load the JSON schema
-invoice_schema = load_json_schema('invoice_schema.json')
+# Load the JSON schema; found next to this file, so the module can be imported from anywhere
+invoice_schema = load_json_schema(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'invoice_schema.json'))
+
+# Scratch workspace of the job being processed in this context (None outside a job)
+_job_workspace = contextvars.ContextVar("job_workspace", default=None)
+# Page checkpoints of the queued file being processed in this context (None outside the queue)
+_checkpoint = contextvars.ContextVar("page_checkpoint", default=None)
+
+# Where pipeline events go: --serve routes them to the request that produced them,
+# otherwise they are written to stdout as NDJSON
+_event_sink = contextvars.ContextVar("event_sink", default=None)
+_event_out = None
+_event_lock = threading.Lock()
+
+# Function to emit one structured pipeline event
+def emit_event(event, **fields):
+    message = {"event": event, **fields}
+    sink = _event_sink.get()
+    if sink is not None:
+        sink(message)
+        return
+    out = _event_out or sys.stdout
+    with _event_lock:
+        out.write(json.dumps(message) + "\n")
+        out.flush()
 
 def print_progress(step):
-    print(f"Progress: {step}", flush=True)
-
-# Function to try parsing dates in multiple formats
-def parse_date(date_str, reference_date=None):
-    formats = ['%m/%d/%Y', '%d/%m/%Y', '%Y/%m/%d', '%Y-%m-%d']
-    for fmt in formats:
-        try:
-            parsed_date = datetime.strptime(date_str, fmt)
-            if reference_date and parsed_date.year != reference_date.year:
-                continue
-            return parsed_date.strftime('%Y-%m-%d')
-        except ValueError:
-            continue
-    return date_str  # Return original string if parsing fails
-
-# Function to extract text from image using PaddleOCR and save annotated image
-def extract_text_from_image(image_path, output_folder="annotated_images"):
+    emit_event("progress", step=step)
+
+# Function to publish every finished stage record as a "stage" event. Only the command line
+# and --serve install it, so importing d2 as a library writes nothing to stdout.
+def publish_stages():
+    instrumentation.set_listener(lambda record: emit_event("stage", **record))
+
+# Function to decode an image path once, or accept an already decoded PIL image / RGB numpy array
+def load_image(image_source):
+    if isinstance(image_source, str):
+        with Image.open(image_source) as image:
+            return image.convert("RGB")
+    if isinstance(image_source, np.ndarray):
+        return Image.fromarray(image_source)
+    return image_source if image_source.mode == "RGB" else image_source.convert("RGB")
+
+# Function to compute the OCR cache identity of an image: file bytes for paths, pixels otherwise
+def image_digest(image_source, image):
+    if isinstance(image_source, str):
+        return file_digest(image_source)
+    return make_key("pixels", image.mode, list(image.size), image.tobytes())
+
+# Function to run the OCR engine on a decoded image and flatten its result into boxes, texts and scores
+def ocr_boxes(image, cls):
+    # PaddleOCR expects BGR arrays, as cv2 would decode them
+    result = get_ocr_engine().ocr(np.ascontiguousarray(np.asarray(image)[:, :, ::-1]), cls=cls)
+
+    # Extract relevant information from OCR result
+    boxes = []
+    txts = []
+    scores = []
+    for idx in range(len(result)):
+        res = result[idx] or []
+        for line in res:
+            boxes.append([[float(x), float(y)] for x, y in line[0]])
+            txts.append(line[1][0])
+            scores.append(float(line[1][1]))
+    return boxes, txts, scores
+
+# Function to run PaddleOCR on a decoded image, reusing cached output for identical content.
+# The page is cropped, deskewed and scaled first (see preprocess.py); on a page found upright
+# the per-box angle classifier is skipped, unless the result comes back with low confidence.
+# Boxes are returned in the coordinates of `image`.
+def run_ocr(image, digest=None, record=None):
+    record = {} if record is None else record
+    key = make_key("ocr", digest, OCR_SETTINGS, preprocess.settings()) if digest and ocr_cache.enabled else None
+    if key:
+        cached = ocr_cache.get(key)
+        record["ocr_cached"] = cached is not None
+        if cached is not None:
+            return cached["boxes"], cached["texts"], cached["scores"]
+
+    matrix = None
+    cls = OCR_SETTINGS["cls"]
+    if preprocess.PREPROCESS:
+        start = time.perf_counter()
+        image, matrix, info = preprocess.prepare(image)
+        record["preprocess_seconds"] = round(time.perf_counter() - start, 4)
+        record["ocr_width"], record["ocr_height"] = image.size
+        record["scale"] = round(info["scale"], 3)
+        record["skew"] = round(info["skew"], 2)
+        record["cropped"] = info["cropped"]
+        cls = cls and not info["upright"]
+
+    boxes, txts, scores = ocr_boxes(image, cls)
+    # An upside-down page profiles like an upright one; its text comes back as noise
+    if cls != OCR_SETTINGS["cls"] and scores and sum(scores) / len(scores) < CLS_FALLBACK_CONFIDENCE:
+        retry = ocr_boxes(image, True)
+        record["cls_fallback"] = True
+        if sum(retry[2]) > sum(scores):
+            boxes, txts, scores = retry
+            cls = True
+    record["cls"] = cls
+    boxes = preprocess.map_boxes(boxes, matrix)
+
+    if key:
+        ocr_cache.set(key, {"boxes": boxes, "texts": txts, "scores": scores})
+    return boxes, txts, scores
+
+# Function to name the OCR data file extract_text_from_image stores for a page
+def ocr_data_path(output_folder, name):
+    return os.path.join(output_folder, name + "_ocr.json")
+
+# Where the OCR data of recently processed pages lives, keyed by (source file, page),
+# so the --serve worker can annotate a page the UI asks for
+_ocr_data_index = OrderedDict()
+_ocr_data_index_lock = threading.Lock()
+
+def remember_ocr_data(source_path, page_number, path):
+    with _ocr_data_index_lock:
+        _ocr_data_index[(os.path.abspath(source_path), page_number)] = path
+        _ocr_data_index.move_to_end((os.path.abspath(source_path), page_number))
+        while len(_ocr_data_index) > 10000:
+            _ocr_data_index.popitem(last=False)
+
+def find_ocr_data(source_path, page_number):
+    with _ocr_data_index_lock:
+        return _ocr_data_index.get((os.path.abspath(source_path), page_number))
+
+# Function to extract text from image using PaddleOCR and store its boxes for annotation.
+# `image_source` may be a file path or an in-memory PIL image / RGB numpy array; in-memory
+# pages need a `name` and the `source_path`/`page_number` they were rendered from, so the
+# annotated view can be drawn later. The annotated image is only rendered here when
+# `annotate` (or ANNOTATE_IMAGES=1) asks for it; otherwise "" is returned in its place and
+# annotate.render_annotated_image builds it on demand from the stored boxes.
+def extract_text_from_image(image_source, output_folder="annotated_images", name=None,
+                            source_path=None, page_number=None, annotate=None):
+    annotate = ANNOTATE_IMAGES if annotate is None else annotate
+    if isinstance(image_source, str):
+        source_path = source_path or image_source
+    if name is None:
+        name = os.path.splitext(os.path.basename(image_source))[0] if isinstance(image_source, str) else "image"
     try:
-        # Perform OCR on the image
-        result = ocr.ocr(image_path, cls=True)
-
-        # Extract relevant information from OCR result
-        boxes = []
-        txts = []
-        scores = []
-        for idx in range(len(result)):
-            res = result[idx]
-            for line in res:
-                boxes.append(line[0])
-                txts.append(line[1][0])
-                scores.append(line[1][1])
-
-        # Calculate average confidence score
-        avg_confidence = sum(scores) / len(scores) if scores else 0.0
-
-        # Save extracted data to a file
-        os.makedirs(output_folder, exist_ok=True)
-        extracted_data_path = os.path.join(output_folder, "extracted_data.txt")
-        with open(extracted_data_path, "w", encoding='utf-8') as f:
-            for box, text, score in zip(boxes, txts, scores):
-                f.write(f"Box: {box}, Text: {text}, Confidence: {score}\n")
-
-        # Annotate the image with bounding boxes and save
-        image = Image.open(image_path)
-        draw = ImageDraw.Draw(image)
-        font_path = 'arial.ttf'
-        for box, text, score in zip(boxes, txts, scores):
-            if score >= 0.97:
-                text_color = (0, 255, 0)  # Green for high confidence
-            else:
-                text_color = (255, 0, 0)   # Red for low confidence
-            draw.polygon([
-                box[0][0], box[0][1],
-                box[1][0], box[1][1],
-                box[2][0], box[2][1],
-                box[3][0], box[3][1]
-            ], outline=text_color)
-            draw.text((box[0][0], box[0][1] - 10), f"{text} ({score:.2f})", font=ImageFont.truetype(font_path, size=14), fill=text_color)
-
-        annotated_image_path = os.path.join(output_folder, os.path.splitext(os.path.basename(image_path))[0] + "_annotated.jpg")
-        image.save(annotated_image_path)
-
-        # Print the extracted text
-        extracted_text = ' '.join(txts)
-        print(f"Extracted Text: {extracted_text}")
-
-        return extracted_text, annotated_image_path, avg_confidence
+        with stage("extract_text_from_image", file=name) as record:
+            ocr_start = time.perf_counter()
+            image = load_image(image_source)
+            digest = image_digest(image_source, image) if ocr_cache.enabled else None
+            boxes, txts, scores = run_ocr(image, digest, record)
+            record["ocr_seconds"] = round(time.perf_counter() - ocr_start, 4)
+            record["boxes"] = len(boxes)
+            record["width"], record["height"] = image.size
+
+            # Draw on a copy when the caller still owns the decoded image
+            if annotate and not isinstance(image_source, str):
+                image = image.copy()
+            return store_ocr_result(boxes, txts, scores, image.size, output_folder, name, source_path, page_number,
+                                    record, image if annotate else None)
 
     except Exception as e:
-        print(f"Error extracting text from {image_path}: {e}")
+        print(f"Error extracting text from {name}: {e}")
         return "", "", 0.0
-    
-# Function to process text and return extracted details as plain text
-def process_text(text: str, invoice_schema: dict) -> dict:
-    extra_prompt = [
-        "You are an Invoice Extraction Specialist. Your task is to extract key details from the OCR text provided. We are using the PaddleOCR engine to perform extraction of text from image.",
-        "Handle potential ambiguities in the invoice format, such as multiple pages belonging to the same invoice, by ensuring that invoice details are correctly aggregated.",
-        "The OCR data has been extracted using the PaddleOCR engine. Match all particulars from the extracted OCR data with the provided JSON schema and return structured data.",
-        "The JSON schema specifies the particulars and data types for accurate comprehension of the extracted OCR data.",
-        "Respond only with the structured data in JSON format as per the schema. Do not include any explanations."
-    ]
-
-    prompt_content = "\n".join(extra_prompt) + "\n\n" + "Use the provided JSON Schema as a reference for the expected structure of the extracted information. The schema is as follows:\n" + json.dumps(invoice_schema, indent=2) + "\n\nExtracted Text:\n" + text
-
-    with open('gptextract.txt', 'w') as f:
-        f.write(prompt_content)
 
+# Function to store what a backend read from a page and lay out its text for the prompt.
+# Writes the extracted data file and the OCR data the annotated view is drawn from; with an
+# `image` the annotations are drawn on it now. Returns (extracted_text, annotated_image_path, avg_confidence).
+def store_ocr_result(boxes, txts, scores, size, output_folder, name, source_path, page_number, record, image=None):
+    # Calculate average confidence score
+    avg_confidence = sum(scores) / len(scores) if scores else 0.0
+
+    # Save extracted data to a file
+    extracted_data_path = os.path.join(output_folder, name + "_extracted_data.txt")
+    atomic_write(extracted_data_path, "".join(
+        f"Box: {box}, Text: {text}, Confidence: {score}\n" for box, text, score in zip(boxes, txts, scores)
+    ))
+
+    # Keep the boxes so the annotated view can be rendered when someone asks for it
+    annotate_start = time.perf_counter()
+    save_ocr_data(ocr_data_path(output_folder, name), boxes, txts, scores,
+                  size[0], size[1], source_path, page_number)
+
+    annotated_image_path = ""
+    if image is not None:
+        draw_annotations(image, boxes, txts, scores)
+        annotated_image_path = os.path.join(output_folder, name + "_annotated.jpg")
+        image.save(annotated_image_path)
+    record["annotate_seconds"] = round(time.perf_counter() - annotate_start, 4)
+
+    # Layout-ordered lines without low-confidence noise; the raw boxes stay in the files above
+    extracted_text = layout_text(boxes, txts, scores)
+    print(f"Extracted Text: {extracted_text}")
+
+    return extracted_text, annotated_image_path, avg_confidence
+
+# Function to read a PDF page from its text layer, skipping rasterization and OCR; returns
+# what extract_text_from_image returns, or None when the page has no usable text layer
+def read_text_layer(pdf_path, page_number, output_folder, name, annotate=None):
+    annotate = ANNOTATE_IMAGES if annotate is None else annotate
+    with stage("read_text_layer", file=os.path.basename(pdf_path), page=page_number) as record:
+        page = textlayer.read_page(pdf_path, page_number)
+        record["found"] = page is not None
+        if page is None:
+            return None
+        record["reader"] = page["reader"]
+        record["boxes"] = len(page["boxes"])
+        result = store_ocr_result(page["boxes"], page["texts"], page["scores"], (page["width"], page["height"]),
+                                  output_folder, name, pdf_path, page_number, record)
+    if annotate:
+        # There is no rendered page to draw on; rasterize one for the annotations only
+        result = (result[0], render_annotated_image(ocr_data_path(output_folder, name)), result[2])
+    return result
+    
+# Function to build the extraction prompt for one page of OCR text
+def build_prompt(text: str, invoice_schema: dict, prompt_name: str = "gptextract") -> str:
+    prompt_content = compact_prompt(text, invoice_schema)
+
+    # Kept for debugging; inside a job it goes to the job's own prompts/ folder
+    workspace = _job_workspace.get()
+    prompt_path = workspace.path("prompts", prompt_name + ".txt") if workspace else prompt_name + ".txt"
+    atomic_write(prompt_path, prompt_content)
+
+    return prompt_content
+
+# Function to look up a previous extraction for the same prompt; returns (cache_key, result or None)
+def cached_extraction(prompt_content: str, invoice_schema: dict):
+    if not llm_cache.enabled:
+        return None, None
+    cache_key = make_key("llm", prompt_content, invoice_schema, LLM_MODEL)
+    cached = llm_cache.get(cache_key)
+    if cached is None:
+        return cache_key, None
+    # A cache hit costs no tokens
+    return cache_key, {
+        "response_content": cached["response_content"],
+        "token_usage": {
+            "prompt_tokens": 0,
+            "completion_tokens": 0
+        },
+        "cached": True
+    }
+
+# Function to check an LLM reply and package it with its token usage
+def package_response(message_content, usage, cache_key=None) -> dict:
+    if not message_content or not message_content.strip():
+        raise ValueError("Empty response from OpenAI")
+
+    structured_data = json.loads(message_content)
+
+    # Print the structured data
+    print(f"Structured Data: {json.dumps(structured_data, indent=2)}")
+
+    if cache_key:
+        llm_cache.set(cache_key, {"response_content": message_content})
+
+    return {
+        "response_content": message_content,
+        "token_usage": {
+            "prompt_tokens": usage.prompt_tokens,
+            "completion_tokens": usage.completion_tokens
+        }
+    }
+
+# Function to package a failed extraction the same way the UI expects
+def error_response(e) -> dict:
+    print(f"Error processing text: {e}")
+    return {
+        "response_content": f"Error processing text: {e}",
+        "token_usage": {
+            "prompt_tokens": 0,
+            "completion_tokens": 0
+        }
+    }
+
+# Function to copy token usage onto a process_text stage record
+def record_llm_usage(record, result):
+    token_usage = result.get("token_usage", {})
+    record["prompt_tokens"] = token_usage.get("prompt_tokens", 0)
+    record["completion_tokens"] = token_usage.get("completion_tokens", 0)
+    record["cached"] = result.get("cached", False)
+
+# Function to combine the rule-extracted fields with the LLM's answer for the others
+def with_rule_fields(result, rule_fields):
+    if not rule_fields:
+        return result
     try:
-        response = client.chat.completions.create(
-            model='gpt-3.5-turbo-0125',
-            messages=[
-                {"role": "user", "content": prompt_content}
-            ],
-            max_tokens=4096,
-            temperature=0.0
-        )
-
-        message_content = response.choices[0].message.content
-
-        if not message_content.strip():
-            raise ValueError("Empty response from OpenAI")
-
-        structured_data = json.loads(message_content)
-
-        # Print the structured data
-        print(f"Structured Data: {json.dumps(structured_data, indent=2)}")
-
-        return {
-            "response_content": message_content,
+        structured_data = json.loads(result["response_content"])
+    except ValueError:
+        return result  # Error responses are passed through as they are
+    if not isinstance(structured_data, dict):
+        return result
+    structured_data.update(rule_fields)
+    return {**result, "response_content": json.dumps(structured_data), "rule_fields": sorted(rule_fields)}
+
+# Function to do everything short of calling the LLM: rules, prompt and cache lookup.
+# Returns (rule_fields, prompt_content, cache_key, result); result is None while the LLM is still needed
+def prepare_extraction(text: str, invoice_schema: dict, prompt_name: str, record: dict):
+    rule_fields = pre_extract(text, invoice_schema)
+    record["rule_fields"] = len(rule_fields)
+    schema = remaining_schema(invoice_schema, rule_fields)
+    if not schema.get("properties"):
+        # The rules read every field, so the page costs no API call
+        rules.count_avoided_call()
+        result = {
+            "response_content": json.dumps(rule_fields),
             "token_usage": {
-                "prompt_tokens": response.usage.prompt_tokens,
-                "completion_tokens": response.usage.completion_tokens
+                "prompt_tokens": 0,
+                "completion_tokens": 0
             }
         }
-
-    except Exception as e:
-        print(f"Error processing text: {e}")
+        return rule_fields, None, None, result
+
+    # Only the fields the rules could not read are asked for
+    prompt_content = build_prompt(text, schema, prompt_name)
+    record.update(prompt_savings(prompt_content, text, invoice_schema))
+    cache_key, result = cached_extraction(prompt_content, schema)
+    return rule_fields, prompt_content, cache_key, result
+
+# Function to validate an extraction against the schema. Returns (structured_data, errors,
+# reask_prompt): structured_data is None for failed extractions, and reask_prompt is set
+# when some values are invalid and a small follow-up request should ask for just those
+# (required fields that are absent are only reported in errors)
+def check_extraction(text: str, result: dict, invoice_schema: dict, record: dict):
+    try:
+        structured_data = json.loads(result["response_content"])
+    except ValueError:
+        return None, {}, None
+    if not isinstance(structured_data, dict):
+        return None, {}, None
+    structured_data = validation.coerce(structured_data, invoice_schema)
+    errors = validation.validate(structured_data, invoice_schema)
+    record["validation_errors"] = len(errors)
+    # Missing fields are reported, not re-asked: the page may simply not show them
+    invalid = validation.reaskable(errors)
+    record["missing_fields"] = len(errors) - len(invalid)
+    if not invalid or not REASK_ENABLED:
+        return structured_data, errors, None
+    reask_content = reask_prompt(text, structured_data, invalid, invoice_schema)
+    record["reask_prompt_tokens_estimate"] = estimate_tokens(reask_content)
+    return structured_data, errors, reask_content
+
+# Function to fold the re-ask answer into the extraction and count what still fails
+def apply_reask(result: dict, structured_data: dict, errors: dict, reask_result, invoice_schema: dict, record: dict) -> dict:
+    token_usage = dict(result.get("token_usage", {}))
+    if reask_result is not None:
+        try:
+            fixes = json.loads(reask_result["response_content"])
+        except ValueError:
+            fixes = {}
+        if isinstance(fixes, dict):
+            for name in errors:
+                if fixes.get(name) is not None:
+                    structured_data[name] = fixes[name]
+            structured_data = validation.coerce(structured_data, invoice_schema)
+        for key, value in reask_result.get("token_usage", {}).items():
+            token_usage[key] = token_usage.get(key, 0) + value
+
+    remaining = validation.validate(structured_data, invoice_schema) if errors else {}
+    validation.count(invoice_schema, errors, remaining)
+    record["validation_errors_after_reask"] = len(remaining)
+    return {
+        **result,
+        "response_content": json.dumps(structured_data),
+        "token_usage": token_usage,
+        "validation_errors": remaining
+    }
+
+# Function to send one chat completion synchronously and package the reply
+def request_completion(prompt_content: str, cache_key, max_tokens: int = 4096) -> dict:
+    response = get_client().chat.completions.create(
+        model=LLM_MODEL,
+        messages=[
+            {"role": "user", "content": prompt_content}
+        ],
+        max_tokens=max_tokens,
+        temperature=0.0,
+        response_format=RESPONSE_FORMAT
+    )
+    return package_response(response.choices[0].message.content, response.usage, cache_key)
+
+# Function to structure a page from the rules alone, for OCR-only mode
+def process_text_rules_only(text: str, invoice_schema: dict) -> dict:
+    with stage("process_text", chars=len(text), ocr_only=True) as record:
+        rule_fields = pre_extract(text, invoice_schema)
+        record["rule_fields"] = len(rule_fields)
         return {
-            "response_content": f"Error processing text: {e}",
+            "response_content": json.dumps(rule_fields),
             "token_usage": {
                 "prompt_tokens": 0,
                 "completion_tokens": 0
-            }
+            },
+            "ocr_only": True
         }
 
-# Function to convert USD to INR
-def usd_to_inr(amount_usd: float) -> float:
-    exchange_rate = 83.5  # 1 USD = 83.5 INR
-    amount_inr = amount_usd * exchange_rate
-    return amount_inr
+# Function to structure one page: rules, prompt, cache, the LLM call, rule-field override,
+# validation and the re-ask for invalid values. Written as a generator so the sync and async
+# paths share it: it yields each LLM request it needs as (prompt_content, cache_key,
+# max_tokens), is sent the packaged reply (or has the call's exception thrown into it), and
+# returns the final result.
+def extraction_steps(text: str, invoice_schema: dict, prompt_name: str, record: dict):
+    rule_fields, prompt_content, cache_key, result = prepare_extraction(text, invoice_schema, prompt_name, record)
+    if result is None:
+        try:
+            result = yield prompt_content, cache_key, 4096
+        except Exception as e:
+            result = error_response(e)
+    result = with_rule_fields(result, rule_fields)
+
+    structured_data, errors, reask_content = check_extraction(text, result, invoice_schema, record)
+    if structured_data is not None:
+        reask_result = None
+        if reask_content:
+            reask_key, reask_result = cached_extraction(reask_content, invoice_schema)
+            if reask_result is None:
+                try:
+                    reask_result = yield reask_content, reask_key, REASK_MAX_TOKENS
+                except Exception as e:
+                    print(f"Re-ask failed: {e}")
+        result = apply_reask(result, structured_data, errors, reask_result, invoice_schema, record)
+    record_llm_usage(record, result)
+    return result
+
+# Function to process text and return extracted details as plain text
+def process_text(text: str, invoice_schema: dict) -> dict:
+    if OCR_ONLY:
+        return process_text_rules_only(text, invoice_schema)
+    with stage("process_text", chars=len(text)) as record:
+        steps = extraction_steps(text, invoice_schema, "gptextract", record)
+        reply, error = None, None
+        try:
+            while True:
+                prompt_content, cache_key, max_tokens = steps.send(reply) if error is None else steps.throw(error)
+                try:
+                    reply, error = request_completion(prompt_content, cache_key, max_tokens=max_tokens), None
+                except Exception as e:
+                    reply, error = None, e
+        except StopIteration as done:
+            return done.value
+
+# Async counterpart of process_text, scheduled through the shared AsyncStructurer
+async def process_text_async(text: str, invoice_schema: dict, structurer: AsyncStructurer, prompt_name: str = "gptextract") -> dict:
+    with stage("process_text", chars=len(text)) as record:
+        steps = extraction_steps(text, invoice_schema, prompt_name, record)
+        reply, error = None, None
+        try:
+            while True:
+                prompt_content, cache_key, max_tokens = steps.send(reply) if error is None else steps.throw(error)
+                try:
+                    message_content, usage = await structurer.complete(prompt_content, max_tokens=max_tokens, response_format=RESPONSE_FORMAT)
+                    reply, error = package_response(message_content, usage, cache_key), None
+                except Exception as e:
+                    reply, error = None, e
+        except StopIteration as done:
+            return done.value
+
+# Function to structure OCR'd pages concurrently. `pages` is a (blocking) iterator of
+# page records; it is drained on a background thread so OCR of later pages overlaps
+# with the LLM calls for earlier ones. `on_result(page, structured_data)` fires as each
+# page finishes. Returns [(page, structured_data)] in input order; pages without text get None.
+async def structure_pages_async(pages, invoice_schema: dict, on_result=None):
+    loop = asyncio.get_running_loop()
+    arrivals = asyncio.Queue()
+    finished = object()
+
+    def produce():
+        try:
+            for page in pages:
+                loop.call_soon_threadsafe(arrivals.put_nowait, page)
+        finally:
+            loop.call_soon_threadsafe(arrivals.put_nowait, finished)
+
+    async def structure(page):
+        # Structured by an earlier attempt of the same queued file
+        checkpointed = page.pop("checkpointed_result", None)
+        if checkpointed is not None:
+            if on_result:
+                on_result(page, checkpointed)
+            return checkpointed
+
+        start = time.perf_counter()
+        prompt_name = f"{os.path.splitext(page['source'])[0]}_page_{page['page_number']}"
+        if structurer is None:
+            structured_data = process_text_rules_only(page["extracted_text"], invoice_schema)
+        else:
+            structured_data = await process_text_async(page["extracted_text"], invoice_schema, structurer, prompt_name)
+        emit_event(
+            "llm-done",
+            file=page["source"],
+            page=page["page_number"],
+            seconds=round(time.perf_counter() - start, 3),
+            token_usage=structured_data.get("token_usage", {}),
+            cached=structured_data.get("cached", False)
+        )
+        if on_result:
+            on_result(page, structured_data)
+        return structured_data
+
+    structurer = None if OCR_ONLY else AsyncStructurer(api_key=get_api_key(), model=LLM_MODEL)
+    try:
+        # The OCR thread inherits our context so its events reach the same sink
+        producer = loop.run_in_executor(None, contextvars.copy_context().run, produce)
+        scheduled = []
+        while True:
+            page = await arrivals.get()
+            if page is finished:
+                break
+            if page["extracted_text"]:
+                print_progress("Collating information")
+                task = asyncio.create_task(structure(page))
+            else:
+                emit_event("page-skipped", file=page["source"], page=page["page_number"], reason="no text found")
+                task = None
+            scheduled.append((page, task))
+        # Re-raises anything the OCR side failed with
+        await producer
+
+        results = []
+        for page, task in scheduled:
+            results.append((page, await task if task else None))
+        if structurer and structurer.retries:
+            print(f"LLM retries: {structurer.retries}")
+        return results
+    finally:
+        if structurer:
+            await structurer.close()
+
+# Function to convert USD to INR at the rate of `date` (from the exchange-rate table; the latest rate without one)
+def usd_to_inr(amount_usd: float, date=None) -> float:
+    return float(amounts.to_inr([amount_usd], "USD", [date])[0])
+
+# Function to count PDF pages from its metadata without rendering anything
+def pdf_page_count(pdf_path):
+    from pdf2image import pdfinfo_from_path
+    return int(pdfinfo_from_path(pdf_path)["Pages"])
+
+# Function to lazily rasterize a PDF, rendering at most `window` pages at a time
+def iter_pdf_pages(pdf_path, window=None):
+    from pdf2image import convert_from_path
+    window = max(1, window or PAGE_WINDOW)
+    page_count = pdf_page_count(pdf_path)
+    for first_page in range(1, page_count + 1, window):
+        last_page = min(first_page + window - 1, page_count)
+        images = convert_from_path(pdf_path, first_page=first_page, last_page=last_page)
+        for offset, image in enumerate(images):
+            yield first_page + offset, image
+        del images
 
 # Function to convert PDF to images
 def pdf_to_images(pdf_path, output_folder="pdf_images"):
     os.makedirs(output_folder, exist_ok=True)
 
-    images = convert_from_path(pdf_path)
     image_paths = []
-    for i, image in enumerate(images):
-        image_path = os.path.join(output_folder, f"page_{i + 1}.jpg")
-        image.save(image_path, 'JPEG')
-        image_paths.append(image_path)
+    with stage("pdf_to_images", file=os.path.basename(pdf_path)) as record:
+        for page_number, image in iter_pdf_pages(pdf_path):
+            image_path = os.path.join(output_folder, f"page_{page_number}.jpg")
+            image.save(image_path, 'JPEG')
+            image_paths.append(image_path)
+        record["pages"] = len(image_paths)
     return image_paths
 
-# Function to merge extracted data for invoices with the same invoice number
+# Function to read a single PDF page; runs inside the page pool workers. The page is taken
+# from its text layer when it has a usable one (OCR_BACKEND), and rasterized and OCR'd otherwise.
+def ocr_pdf_page(pdf_path, page_number, output_folder="pdf_images", annotated_folder="annotated_images", save_pages=None):
+    save_pages = SAVE_PAGE_IMAGES if save_pages is None else save_pages
+    start = time.perf_counter()
+    # Pages of different PDFs may share a folder, so names carry the document stem
+    name = f"{os.path.splitext(os.path.basename(pdf_path))[0]}_page_{page_number}"
+    file_name = f"page_{page_number}"
+    # Stage records are returned with the page so the parent can adopt them
+    with instrumentation.collect() as stages:
+        # Born-digital pages are read from their text layer in milliseconds
+        text_layer = read_text_layer(pdf_path, page_number, annotated_folder, name) if OCR_BACKEND != "paddleocr" else None
+        if text_layer is None and OCR_BACKEND == "textlayer":
+            # OCR is off, so a page without a text layer comes back empty
+            text_layer = store_ocr_result([], [], [], (0, 0), annotated_folder, name, pdf_path, page_number, {})
+        if text_layer is not None:
+            extracted_text, annotated_image_path, avg_confidence = text_layer
+            engine = "textlayer"
+        else:
+            extracted_text, annotated_image_path, avg_confidence, file_name = ocr_rendered_page(
+                pdf_path, page_number, output_folder, annotated_folder, name, file_name, save_pages)
+            engine = "paddleocr"
+    return {
+        "source": os.path.basename(pdf_path),
+        "page_number": page_number,
+        "file_name": file_name,
+        "extracted_text": extracted_text,
+        "annotated_image_path": annotated_image_path,
+        "ocr_data_path": ocr_data_path(annotated_folder, name),
+        "avg_confidence": avg_confidence,
+        "ocr_engine": engine,
+        "ocr_seconds": time.perf_counter() - start,
+        "stages": stages
+    }
+
+# Function to rasterize a PDF page and OCR it with PaddleOCR. The rendered page goes straight
+# to OCR in memory; it is only written to disk when save_pages is set (lossless PNG, so saved
+# copies match what OCR saw). Returns extract_text_from_image's result plus the page's file name.
+def ocr_rendered_page(pdf_path, page_number, output_folder, annotated_folder, name, file_name, save_pages):
+    from pdf2image import convert_from_path
+    with stage("pdf_to_images", file=os.path.basename(pdf_path), page=page_number, pages=1) as record:
+        # Rendered so the text comes out near the OCR target height, not at a fixed DPI
+        record["dpi"] = preprocess.pdf_dpi(pdf_path, page_number)
+        image = convert_from_path(pdf_path, dpi=record["dpi"], first_page=page_number, last_page=page_number)[0]
+        record["width"], record["height"] = image.size
+        if save_pages:
+            os.makedirs(output_folder, exist_ok=True)
+            file_name = name + ".png"
+            tmp_path = os.path.join(output_folder, "." + file_name + ".tmp")
+            image.save(tmp_path, 'PNG')
+            os.replace(tmp_path, os.path.join(output_folder, file_name))
+
+    extracted_text, annotated_image_path, avg_confidence = extract_text_from_image(
+        image, output_folder=annotated_folder, name=name, source_path=pdf_path, page_number=page_number)
+    del image
+    return extracted_text, annotated_image_path, avg_confidence, file_name
+
+# Function to OCR a single image file into the same page record ocr_pdf_page produces
+def ocr_image_file(image_path, annotated_folder="annotated_images"):
+    emit_event("page-started", file=os.path.basename(image_path), page=1)
+    start = time.perf_counter()
+    extracted_text, annotated_image_path, avg_confidence = extract_text_from_image(image_path, output_folder=annotated_folder)
+    page = {
+        "source": os.path.basename(image_path),
+        "page_number": 1,
+        "file_name": os.path.basename(image_path),
+        "extracted_text": extracted_text,
+        "annotated_image_path": annotated_image_path,
+        "ocr_data_path": ocr_data_path(annotated_folder, os.path.splitext(os.path.basename(image_path))[0]),
+        "avg_confidence": avg_confidence,
+        "ocr_engine": "paddleocr",
+        "ocr_seconds": time.perf_counter() - start
+    }
+    remember_ocr_data(image_path, 1, page["ocr_data_path"])
+    emit_ocr_done(page)
+    return page
+
+# Function to report a page whose OCR just finished
+def emit_ocr_done(page):
+    emit_event(
+        "ocr-done",
+        file=page["source"],
+        page=page["page_number"],
+        seconds=round(page["ocr_seconds"], 3),
+        avg_confidence=page["avg_confidence"],
+        characters=len(page["extracted_text"]),
+        engine=page.get("ocr_engine")
+    )
+
+# Process pool shared across documents so its OCR engines stay warm
+_page_pool = None
+_page_pool_size = 0
+_page_pool_lock = threading.Lock()
+
+# Page workers share the parent's stdout, which --serve reserves for its protocol
+def init_page_worker():
+    sys.stdout = sys.stderr
+    # Records travel back with each page and are emitted by the parent
+    instrumentation.set_listener(None)
+
+def get_page_pool(processes):
+    global _page_pool, _page_pool_size
+    with _page_pool_lock:
+        if _page_pool is None or _page_pool_size != processes:
+            if _page_pool is not None:
+                _page_pool.shutdown(wait=True)
+            # Paddle is not fork-safe, so workers start from a clean interpreter
+            _page_pool = ProcessPoolExecutor(
+                max_workers=processes,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_page_worker
+            )
+            _page_pool_size = processes
+        return _page_pool
+
+# Function to OCR every page of a PDF, yielding page records in page order.
+# Pages are rasterized on demand, so memory is bounded by the window, not the page count.
+# `resume` maps page numbers to page records from an earlier attempt; those pages are not redone.
+# `first_page`/`last_page` limit the run to a range of pages, as for one slice of a split document.
+def ocr_pdf_pages(pdf_path, output_folder="pdf_images", annotated_folder="annotated_images", processes=None, window=None, resume=None,
+                  first_page=None, last_page=None):
+    processes = processes or OCR_PROCESSES
+    window = max(1, window or PAGE_WINDOW)
+    page_count = pdf_page_count(pdf_path)
+    first_page = max(1, first_page or 1)
+    last_page = min(page_count, last_page or page_count)
+    source = os.path.basename(pdf_path)
+    resume = resume or {}
+
+    if processes <= 1:
+        for page_number in range(first_page, last_page + 1):
+            if page_number in resume:
+                emit_event("page-resumed", file=source, page=page_number, pages=page_count)
+                page = dict(resume[page_number])
+                remember_ocr_data(pdf_path, page_number, page["ocr_data_path"])
+                yield page
+                continue
+            emit_event("page-started", file=source, page=page_number, pages=page_count)
+            page = ocr_pdf_page(pdf_path, page_number, output_folder, annotated_folder)
+            # Already recorded in this process
+            page.pop("stages")
+            remember_ocr_data(pdf_path, page_number, page["ocr_data_path"])
+            emit_ocr_done(page)
+            yield page
+        return
+
+    pool = get_page_pool(processes)
+    max_in_flight = max(window, processes)
+    in_flight = {}
+    finished = {}
+    next_to_submit = first_page
+    next_to_yield = first_page
+
+    while next_to_yield <= last_page:
+        while next_to_submit <= last_page and len(in_flight) + len(finished) < max_in_flight:
+            if next_to_submit in resume:
+                emit_event("page-resumed", file=source, page=next_to_submit, pages=page_count)
+                finished[next_to_submit] = dict(resume[next_to_submit])
+            else:
+                emit_event("page-started", file=source, page=next_to_submit, pages=page_count)
+                in_flight[next_to_submit] = pool.submit(ocr_pdf_page, pdf_path, next_to_submit, output_folder, annotated_folder)
+            next_to_submit += 1
+
+        # Wait for the page we need next; later pages keep running meanwhile
+        if next_to_yield in in_flight:
+            finished[next_to_yield] = in_flight.pop(next_to_yield).result()
+        for page_number in [n for n, future in in_flight.items() if future.done()]:
+            finished[page_number] = in_flight.pop(page_number).result()
+
+        while next_to_yield in finished:
+            page = finished.pop(next_to_yield)
+            if next_to_yield not in resume:
+                instrumentation.adopt(page.pop("stages"))
+                emit_ocr_done(page)
+            remember_ocr_data(pdf_path, page["page_number"], page["ocr_data_path"])
+            yield page
+            next_to_yield += 1
+
+# Function to identify everything besides a page's content that its results depend on
+def extraction_settings():
+    return make_key("extraction", OCR_SETTINGS, OCR_BACKEND, preprocess.settings(), LLM_MODEL, PROMPT_SCHEMA_MODE,
+                    REASK_ENABLED, OCR_ONLY, invoice_schema)
+
+# Function to open a document's page manifest (for the range `pages` of a split PDF) and work
+# out which of its pages changed; None when incremental re-extraction is off or the pages can't be fingerprinted
+def open_manifest(file_path, pages=None):
+    if not INCREMENTAL:
+        return None
+    try:
+        manifest = PageManifest(MANIFEST_DIR, file_path, extraction_settings(), pages)
+    except Exception as e:
+        print(f"Page manifest unavailable for {file_path}: {e}")
+        return None
+    return manifest
+
+# Function to return a document's unchanged pages from its manifest and announce what will be redone
+def reused_pages(manifest, annotated_folder):
+    if manifest is None:
+        return {}
+    pages = manifest.reusable(annotated_folder)
+    emit_event("pages-reused", file=os.path.basename(manifest.source_path), pages=sorted(pages), changed=manifest.changed())
+    return pages
+
+# Function to merge extracted data for invoices with the same invoice number (and seller GSTIN)
 def merge_invoice_data(extraction_results):
-    merged_data = {}
-    for result in extraction_results:
-        invoice_number = result['structured_data'].get('invoice_number')
-        if invoice_number:
-            if invoice_number not in merged_data:
-                merged_data[invoice_number] = {
-                    "extracted_text": "",
-                    "structured_data": result['structured_data'],
-                    "avg_confidence": 0.0,
-                    "page_count": 0
-                }
-            merged_data[invoice_number]["extracted_text"] += result['extracted_text'] + "\n"
-            merged_data[invoice_number]["avg_confidence"] += result['avg_confidence']
-            merged_data[invoice_number]["page_count"] += 1
-
-            # Merge items from all pages
-            if "items" not in merged_data[invoice_number]["structured_data"]:
-                merged_data[invoice_number]["structured_data"]["items"] = []
-            merged_data[invoice_number]["structured_data"]["items"].extend(result['structured_data'].get("items", []))
-
-    # Calculate average confidence for merged data
-    for invoice_number, data in merged_data.items():
-        data["avg_confidence"] /= data["page_count"]
-
+    with stage("merge_invoice_data", pages=len(extraction_results)) as record:
+        merged_data, unreadable = merge_pages(extraction_results)
+        record["invoices"] = len(merged_data)
+        record["unreadable_pages"] = unreadable
+    return normalize_amounts(merged_data)
+
+# Function to parse, convert and check the amounts of all merged invoices as one batch (see amounts.py)
+def normalize_amounts(merged_data):
+    with stage("normalize_amounts", invoices=len(merged_data)) as record:
+        record.update(amounts.normalize_invoices(merged_data))
     return merged_data
 
-# Function to process invoice images and print the final results
-def process_invoice_images(input_path, output_folder="annotated_images"):
-    os.makedirs(output_folder, exist_ok=True)
-
-    print_progress("Extracting information")
-
+# Function to write merged invoices to the columnar export tables (see export.py);
+# the batch is named after its job, so exporting a job again replaces its Parquet/Arrow parts
+def export_results(merged_data, export_dir=None, export_format=None, batch_id=None):
+    # pyarrow is only loaded by batches that export
+    from export import export_invoices
+    with stage("export_invoices", invoices=len(merged_data)) as record:
+        exported = export_invoices(merged_data, export_dir or EXPORT_DIR, invoice_schema, export_format, batch_id)
+        record["format"] = exported["format"]
+        record["rows"] = sum(table["rows"] for table in exported["tables"].values())
+    emit_event("exported", **exported)
+    return exported
+
+# Function to list the invoice files at a path (a file or a folder); None if it doesn't exist
+def list_invoice_files(input_path):
     if os.path.isfile(input_path):
-        files = [input_path]
-    elif os.path.isdir(input_path):
-        files = [
+        return [input_path]
+    if os.path.isdir(input_path):
+        return [
             os.path.join(input_path, f) for f in os.listdir(input_path)
             if f.lower().endswith('.jpg') or f.lower().endswith('.png') or f.lower().endswith('.pdf')
         ]
-    else:
+    return None
+
+# Function to process invoice images and print the final results
+# Artifacts go to a per-job workspace unless an explicit output folder is given.
+# With `durable`, the files go through the job queue instead (see process_invoice_batch).
+# With `export_dir`, the merged invoices are also written there as Parquet/Arrow/CSV tables.
+def process_invoice_images(input_path, output_folder=None, job_id=None, durable=False, concurrency=None,
+                           export_dir=None, export_format=None):
+    if durable:
+        return process_invoice_batch(input_path, job_id=job_id, concurrency=concurrency,
+                                     export_dir=export_dir, export_format=export_format)
+    workspace = JobWorkspace(job_id)
+    maybe_cleanup_jobs()
+    token = _job_workspace.set(workspace)
+    try:
+        merged_data = _process_invoice_images(input_path, output_folder, workspace)
+        if export_dir and merged_data:
+            export_results(merged_data, export_dir, export_format, batch_id=workspace.job_id)
+        workspace.finish(merged_data)
+        return merged_data
+    except BaseException as e:
+        workspace.finish(error=str(e))
+        raise
+    finally:
+        _job_workspace.reset(token)
+
+def _process_invoice_images(input_path, output_folder, workspace):
+    pages_folder = output_folder or workspace.pages
+    annotated_folder = output_folder or workspace.annotated
+    os.makedirs(annotated_folder, exist_ok=True)
+
+    print_progress("Extracting information")
+
+    files = list_invoice_files(input_path)
+    if files is None:
         print(f"Invalid input path: {input_path}")
         sys.exit(1)
 
-    pdf_files = [f for f in files if f.lower().endswith('.pdf')]
-    for pdf_file in pdf_files:
-        pdf_images = pdf_to_images(pdf_file, output_folder=output_folder)
-        files.remove(pdf_file)
-        files.extend(pdf_images)
+    # Page manifests of the files OCR'd so far, by file name; unchanged pages skip OCR and the LLM
+    manifests = {}
 
-    extraction_results = []
-    for file in files:
-        if file.lower().endswith('.jpg') or file.lower().endswith('.png'):
+    # Function to OCR every page of every file; consumed on a background thread
+    def ocr_pages():
+        for file in files:
             try:
-                extracted_text, annotated_image_path, avg_confidence = extract_text_from_image(file, output_folder=output_folder)
-                if extracted_text:
-                    print_progress("Collating information")
-                    structured_data = process_text(extracted_text, invoice_schema)
-                    extraction_results.append({
-                        "file_name": os.path.basename(file),
-                        "extracted_text": extracted_text,
-                        "annotated_image_path": annotated_image_path,
-                        "structured_data": structured_data,
-                        "avg_confidence": avg_confidence
-                    })
+                if not (file.lower().endswith('.pdf') or file.lower().endswith('.jpg') or file.lower().endswith('.png')):
+                    continue
+                manifest = open_manifest(file)
+                reused = reused_pages(manifest, annotated_folder)
+                if file.lower().endswith('.pdf'):
+                    pages = ocr_pdf_pages(file, output_folder=pages_folder, annotated_folder=annotated_folder, resume=reused)
+                elif 1 in reused:
+                    pages = iter([reused[1]])
                 else:
-                    print(f"No valid text found in {file}. Skipping.")
+                    pages = iter([ocr_image_file(file, annotated_folder=annotated_folder)])
+                if manifest:
+                    manifests[os.path.basename(file)] = manifest
+                    pages = manifest.track(pages)
+                yield from pages
             except Exception as e:
                 print(f"Error processing {file}: {e}")
 
+    def on_result(page, structured_data):
+        manifest = manifests.get(page["source"])
+        if manifest and parse_structured(structured_data) is not None:
+            manifest.structured(page, structured_data)
+
+    extraction_results = []
+    for page, structured_data in asyncio.run(structure_pages_async(ocr_pages(), invoice_schema, on_result=on_result)):
+        if structured_data is None:
+            print(f"No valid text found in {page['file_name']}. Skipping.")
+            continue
+        extraction_results.append({**page, "structured_data": structured_data})
+    for manifest in manifests.values():
+        manifest.save()
+
     if extraction_results:
         print_progress("Ready to present")
         merged_data = merge_invoice_data(extraction_results)
@@ -246,62 +1026,562 @@ def process_invoice_images(input_path, output_folder="annotated_images"):
 
     return {}
 
+# Function to check a PDF's page count from its metadata, without rendering its pages
 def is_single_page_pdf(file_path):
     try:
-        images = convert_from_path(file_path)
-        return len(images) == 1
+        return pdf_page_count(file_path) == 1
     except Exception as e:
         print(f"Error checking if PDF is single page: {e}")
         return False
+
+# Function to triage files for scheduling (see triage.py); a file that can't be read gets an "error"
+def triage_files(paths):
+    results = []
+    for path in paths:
+        with stage("triage", file=os.path.basename(path)) as record:
+            try:
+                result = triage.triage_file(path, backend=OCR_BACKEND, llm=not OCR_ONLY)
+                record["pages"] = result["pages"]
+                record["text_layer"] = result["text_layer"]
+                result["reusable"] = record["reusable"] = is_reusable(path)
+            except Exception as e:
+                result = {"file": os.path.basename(path), "error": str(e)}
+        results.append(result)
+    return results
+
+# Function to tell whether a file's results can be handed back without OCR or the LLM: the
+# same bytes are in the duplicate index, or its manifest covers every page of them. Such a
+# file is processed whole rather than split into page ranges (see scheduler.js), since only
+# a whole document is looked up in the duplicate index.
+def is_reusable(file_path):
+    settings = extraction_settings()
+    try:
+        digest = file_digest(file_path)
+        if DEDUP and get_duplicate_index().find_file(digest, settings) is not None:
+            return True
+        return INCREMENTAL and fully_reusable(MANIFEST_DIR, file_path, settings, digest)
+    except Exception as e:
+        print(f"Could not check earlier results for {file_path}: {e}")
+        return False
+
+# Function to run the full extraction for one file and return one output record per page.
+# Everything the job writes lives in its own workspace (work/<job_id>/), so concurrent
+# jobs never overwrite each other's pages, OCR data or prompts. `pages` = (first, last)
+# processes only that range of a PDF, so a long document can be split across workers.
+def process_file(input_path, job_id=None, pages=None):
+    workspace = JobWorkspace(job_id)
+    maybe_cleanup_jobs()
+    token = _job_workspace.set(workspace)
+    try:
+        outputs = _process_file(input_path, workspace, pages)
+        workspace.finish(outputs)
+        return outputs
+    except BaseException as e:
+        workspace.finish(error=str(e))
+        raise
+    finally:
+        _job_workspace.reset(token)
+
+def _process_file(input_path, workspace, pages=None):
+    print_progress("Extracting information")
+    is_pdf = input_path.lower().endswith('.pdf')
+    source = os.path.basename(input_path)
+
+    # PDF pages keep their OCR details; single images return the structured data alone,
+    # which is the shape the UI reads for them
+    def page_output(page, structured_data):
+        if not is_pdf:
+            return structured_data
+        return {
+            **page,
+            "structured_data": structured_data,
+            "token_usage": structured_data.get("token_usage", {})
+        }
+
+    # Inside the durable queue every page's OCR and LLM result is checkpointed,
+    # and pages finished by an earlier attempt are picked up where they were left
+    checkpoint = _checkpoint.get()
+
+    # The same file processed before: hand back that result before anything else is read.
+    # Slices don't look the document up: triage did, and a document it found is not split.
+    fingerprint, duplicate = find_duplicate(input_path) if pages is None else (None, None)
+    if duplicate and duplicate["match"] == "file_hash":
+        return reuse_duplicate(input_path, workspace, duplicate)
+
+    # Pages unchanged since the document was last processed are reused from its manifest;
+    # a slice of a split document reads and writes the entries of its own pages
+    manifest = open_manifest(input_path, pages)
+    resume = {**reused_pages(manifest, workspace.annotated), **(checkpoint.ocr_pages() if checkpoint else {})}
+
+    # A perceptual match may be another invoice filled into the same template, so the earlier
+    # result is only reused once this file's OCR text confirms it (see confirm_duplicate)
+    if duplicate:
+        resume, confirmed = confirm_duplicate(input_path, workspace, duplicate, resume)
+        emit_event("duplicate", file=source, match=duplicate["match"], of=duplicate["source"],
+                   distance=duplicate.get("distance"), reused=confirmed)
+
+    def on_result(page, structured_data):
+        if parse_structured(structured_data) is not None:
+            if checkpoint:
+                checkpoint.structured(page, structured_data)
+            if manifest:
+                manifest.structured(page, structured_data)
+        emit_event("page-result", file=source, page=page["page_number"], output=page_output(page, structured_data))
+
+    first_page, last_page = pages or (None, None)
+    if is_pdf:
+        page_records = ocr_pdf_pages(input_path, output_folder=workspace.pages, annotated_folder=workspace.annotated, resume=resume,
+                                     first_page=first_page, last_page=last_page)
+    elif 1 in resume:
+        page_records = iter([resume[1]])
+    else:
+        page_records = iter([ocr_image_file(input_path, annotated_folder=workspace.annotated)])
+    if checkpoint:
+        page_records = checkpoint.track(page_records)
+    if manifest:
+        page_records = manifest.track(page_records)
+
+    outputs = []
+    results = []
+    for page, structured_data in asyncio.run(structure_pages_async(page_records, invoice_schema, on_result=on_result)):
+        if structured_data is None:
+            structured_data = error_response(ValueError("No text found on page"))
+            on_result(page, structured_data)
+
+        print("Extracted Text:", page["extracted_text"])
+        print("Structured Data:", json.dumps(structured_data, indent=2))
+        outputs.append(page_output(page, structured_data))
+        results.append((page["page_number"], structured_data))
+    if manifest and manifest.save() and pages:
+        record_split_document(input_path, manifest)
+    if fingerprint:
+        record_duplicates(fingerprint, input_path, outputs, results)
+
+    print_progress("Ready to present")
+    emit_event("done", file=source, pages=len(outputs), job_id=workspace.job_id)
+    return outputs
+
+# Duplicate index shared by every job, opened on first use
+_duplicate_index = None
+_duplicate_index_lock = threading.Lock()
+
+def get_duplicate_index():
+    global _duplicate_index
+    with _duplicate_index_lock:
+        if _duplicate_index is None:
+            _duplicate_index = duplicates.DuplicateIndex()
+        return _duplicate_index
+
+# Function to look a file up in the duplicate index before processing it. Returns (fingerprint,
+# match): the fingerprint to record the file under once processed, and the earlier file it
+# duplicates (see DuplicateIndex.find_file) or None. Both are None when DEDUP is off.
+def find_duplicate(input_path):
+    if not DEDUP:
+        return None, None
+    with stage("find_duplicate", file=os.path.basename(input_path)) as record:
+        index = get_duplicate_index()
+        fingerprint = {"file_hash": file_digest(input_path), "settings": extraction_settings(), "hashes": []}
+        match = index.find_file(fingerprint["file_hash"], fingerprint["settings"])
+        if match is None:
+            # Only rendered when the bytes are new
+            try:
+                fingerprint["hashes"] = duplicates.page_hashes(input_path)
+            except Exception as e:
+                print(f"Perceptual hash unavailable for {input_path}: {e}")
+            match = index.find_file(fingerprint["file_hash"], fingerprint["settings"], fingerprint["hashes"])
+        record["match"] = match["match"] if match else None
+    return fingerprint, match
+
+# Function to copy earlier structured data for reuse; nothing is billed for it again
+def unbilled(structured_data):
+    return {**structured_data, "token_usage": {"prompt_tokens": 0, "completion_tokens": 0}}
+
+# Function to return an earlier file's outputs as this file's, announcing them as processing would
+def reuse_duplicate(input_path, workspace, duplicate):
+    source = os.path.basename(input_path)
+    emit_event("duplicate", file=source, match=duplicate["match"], of=duplicate["source"], reused=True)
+    outputs = []
+    for page_number, output in enumerate(duplicate["outputs"], start=1):
+        # A single image's output is its structured data
+        if "structured_data" in output:
+            structured_data = unbilled(output["structured_data"])
+            output = {**output, "structured_data": structured_data, "token_usage": structured_data["token_usage"]}
+        else:
+            output = unbilled(output)
+        page_number = output.get("page_number", page_number)
+        # The earlier job's OCR data still draws this file's annotations while it is kept
+        if output.get("ocr_data_path") and os.path.exists(output["ocr_data_path"]):
+            remember_ocr_data(input_path, page_number, output["ocr_data_path"])
+        emit_event("page-result", file=source, page=page_number, output=output, duplicate_of=duplicate["source"])
+        outputs.append(output)
+    print_progress("Ready to present")
+    emit_event("done", file=source, pages=len(outputs), job_id=workspace.job_id, duplicate_of=duplicate["source"])
+    return outputs
+
+# Function to confirm a perceptual duplicate without the LLM: the file is OCR'd and the rules
+# read each page's invoice number, GSTIN and date, which must agree with the earlier result
+# (see duplicates.confirm_match). Returns (pages, confirmed): the page records by page number,
+# to be resumed from so no page is OCR'd twice, with the earlier structured data attached as
+# "checkpointed_result" when confirmed.
+def confirm_duplicate(input_path, workspace, duplicate, resume):
+    with stage("confirm_duplicate", file=os.path.basename(input_path), of=duplicate["source"]) as record:
+        if input_path.lower().endswith('.pdf'):
+            pages = {page["page_number"]: page for page in ocr_pdf_pages(
+                input_path, output_folder=workspace.pages, annotated_folder=workspace.annotated, resume=resume)}
+        else:
+            pages = {1: resume.get(1) or ocr_image_file(input_path, annotated_folder=workspace.annotated)}
+        fields = [rules.pre_extract(pages[page_number]["extracted_text"], invoice_schema) for page_number in sorted(pages)]
+        record["confirmed"] = duplicates.confirm_match(fields, duplicate["outputs"])
+        if record["confirmed"]:
+            for page_number, output in zip(sorted(pages), duplicate["outputs"]):
+                # Pages already structured by the manifest or an earlier attempt keep their result
+                pages[page_number].setdefault("checkpointed_result", unbilled(output.get("structured_data", output)))
+    return pages, record["confirmed"]
+
+# Function to add a processed file to the duplicate index and flag invoices already seen in
+# other files. Files with a failed page are left out, so uploading them again retries them.
+def record_duplicates(fingerprint, input_path, outputs, results):
+    if any(parse_structured(structured_data) is None for _, structured_data in results):
+        return
+    keys = []
+    for page_number, structured_data in results:
+        key = duplicates.invoice_key(structured_data)
+        if key:
+            keys.append((page_number, key))
+    index = get_duplicate_index()
+    for match in index.find_invoices(keys, fingerprint["file_hash"]):
+        emit_event("duplicate", file=os.path.basename(input_path), match="invoice_key", page=match["page_number"],
+                   of=match["source"], of_page=match["page"], invoice_key=match["invoice_key"])
+    index.add(fingerprint["file_hash"], os.path.basename(input_path), fingerprint["settings"], outputs,
+              fingerprint["hashes"], keys)
+
+# Function to add a split document to the duplicate index once its last slice is saved. No
+# slice sees the whole document, so its outputs are read back from the completed manifest.
+def record_split_document(input_path, manifest):
+    if not DEDUP:
+        return
+    with stage("record_split_document", file=os.path.basename(input_path), pages=manifest.page_count):
+        entries = manifest.saved["pages"]
+        outputs = [{**entry["page"], "structured_data": entry["structured_data"],
+                    "token_usage": (entry["structured_data"] or {}).get("token_usage", {})} for entry in entries]
+        results = [(entry["page_number"], entry["structured_data"]) for entry in entries]
+        fingerprint = {"file_hash": manifest.file_digest, "settings": manifest.settings, "hashes": []}
+        try:
+            fingerprint["hashes"] = duplicates.page_hashes(input_path)
+        except Exception as e:
+            print(f"Perceptual hash unavailable for {input_path}: {e}")
+        record_duplicates(fingerprint, input_path, outputs, results)
+
+# Durable job queue shared by the --serve worker and batch runs, opened on first use
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+def get_job_queue():
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue()
+        return _job_queue
+
+# Function to process one claimed file under its page checkpoints and record the outcome
+def run_queued_file(job_queue, claimed):
+    token = _checkpoint.set(FileCheckpoint(job_queue, claimed["job_id"], claimed["seq"]))
+    try:
+        with borrowed_engine():
+            # The workspace is named after the file, so a resumed attempt finds its earlier OCR data
+            outputs = process_file(claimed["path"], job_id=f"{claimed['job_id']}-{claimed['seq']}")
+        job_queue.complete(claimed["job_id"], claimed["seq"], outputs)
+    except Exception as e:
+        print(f"Error processing {claimed['path']} (attempt {claimed['attempts']}): {e}")
+        job_queue.fail(claimed["job_id"], claimed["seq"], e)
+    finally:
+        _checkpoint.reset(token)
+
+# Function to keep claiming and processing queued files. With `poll_seconds` it waits for
+# new work until `stop` is set; otherwise it returns once there is nothing left to claim.
+def drain_queue(job_queue, job_id=None, stop=None, poll_seconds=None):
+    while not (stop and stop.is_set()):
+        claimed = job_queue.claim(job_id)
+        if claimed is None:
+            if poll_seconds is None:
+                return
+            # Idle: pick up files abandoned by dead workers, then wait for more
+            job_queue.recover()
+            if stop:
+                stop.wait(poll_seconds)
+            else:
+                time.sleep(poll_seconds)
+            continue
+        run_queued_file(job_queue, claimed)
+
+# Function to drain the queue (or one job of it) on `concurrency` threads until it is empty
+def drain(concurrency=None, job_id=None):
+    concurrency = max(1, concurrency or QUEUE_CONCURRENCY or 1)
+    job_queue = get_job_queue()
+    job_queue.recover()
+    if _engine_pool is None:
+        start_engine_pool(concurrency)
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(drain_queue, job_queue, job_id) for _ in range(concurrency)]:
+            future.result()
+
+# Function to run a file or folder through the durable queue and merge the results.
+# Every page is checkpointed, so running it again with the same job_id resumes an
+# interrupted batch from the last finished page.
+def process_invoice_batch(input_path, job_id=None, concurrency=None, export_dir=None, export_format=None):
+    files = list_invoice_files(input_path)
+    if files is None:
+        raise FileNotFoundError(f"Invalid input path: {input_path}")
+    job_queue = get_job_queue()
+    job_id = job_queue.submit(files, job_id)
+    emit_event("job-submitted", job_id=job_id, files=len(files))
+    return finish_batch(job_queue, job_id, concurrency, export_dir, export_format)
+
+# Function to process whatever is left of a queued job and merge all of its pages
+def finish_batch(job_queue, job_id, concurrency=None, export_dir=None, export_format=None):
+    drain(concurrency, job_id)
+    status = job_queue.status(job_id)
+    emit_event("job-done", job_id=job_id, status=status["status"], counts=status["counts"])
+    merged_data = merge_invoice_data(job_queue.job_pages(job_id))
+    if export_dir and merged_data:
+        export_results(merged_data, export_dir, export_format, batch_id=job_id)
+    return merged_data
+
+# Function to report hit/miss counters for both caches
+def cache_stats():
+    return {"ocr": ocr_cache.stats(), "llm": llm_cache.stats()}
+
+# Function to handle a single request received by the --serve worker
+def handle_request(request):
+    op = request.get("op", "process")
+    if op == "ping":
+        return {"pong": True}
+    if op == "ocr":
+        with borrowed_engine():
+            extracted_text, annotated_image_path, avg_confidence = extract_text_from_image(request["path"])
+        return {
+            "extracted_text": extracted_text,
+            "annotated_image_path": annotated_image_path,
+            "avg_confidence": avg_confidence
+        }
+    if op == "cache_stats":
+        return cache_stats()
+    if op == "cache_clear":
+        ocr_cache.clear()
+        llm_cache.clear()
+        return cache_stats()
+    if op == "annotate":
+        ocr_path = find_ocr_data(request["path"], request.get("page", 1))
+        if not ocr_path or not os.path.exists(ocr_path):
+            raise ValueError(f"No OCR data for page {request.get('page', 1)} of {os.path.basename(request['path'])}; process it first")
+        annotated_image_path = render_annotated_image(ocr_path, request.get("max_size"))
+        return {"annotated_image_path": os.path.abspath(annotated_image_path)}
+    if op == "metrics":
+        return {"summary": instrumentation.summary(), "rules": rules.stats(),
+                "validation": validation.stats(), "prometheus": instrumentation.prometheus_text()}
+    if op == "triage":
+        return {"files": triage_files(request["paths"])}
+    if op == "find_duplicate":
+        _, match = find_duplicate(request["path"])
+        if match is None:
+            return {"duplicate": None}
+        return {"duplicate": {key: value for key, value in match.items() if key != "outputs"}}
+    if op == "process":
+        job_id = request.get("job_id") or uuid.uuid4().hex
+        pages = tuple(request["pages"]) if request.get("pages") else None
+        with borrowed_engine():
+            return {"outputs": process_file(request["path"], job_id=job_id, pages=pages), "job_id": job_id}
+    if op == "submit":
+        # Queued files are picked up by the worker's queue threads; this returns at once
+        return {"job_id": get_job_queue().submit(request["paths"], request.get("job_id"))}
+    if op == "job_status":
+        return get_job_queue().status(request["job_id"], include_results=request.get("results", False))
+    if op == "export":
+        # Exports whatever pages of the job have finished so far
+        merged_data = merge_invoice_data(get_job_queue().job_pages(request["job_id"]))
+        if not merged_data:
+            raise ValueError(f"No finished pages to export for job {request['job_id']}")
+        return export_results(merged_data, request.get("directory"), request.get("format"), batch_id=request["job_id"])
+    if op == "job_resume":
+        get_job_queue().resume(request["job_id"])
+        return get_job_queue().status(request["job_id"])
+    raise ValueError(f"Unknown op: {op}")
+
+# Ops of the --serve protocol that borrow an OCR engine, and threads for all other ops
+ENGINE_OPS = {"process", "ocr"}
+CONTROL_THREADS = 4
+
+# Function to run a long-lived worker that keeps warm OCR engines and answers
+# JSON-lines requests on stdin with JSON-lines responses on stdout
+def serve(workers=1):
+    # Keep stdout reserved for the protocol; diagnostic prints go to stderr
+    protocol_out = sys.stdout
+    sys.stdout = sys.stderr
+    write_lock = threading.Lock()
+
+    def write_message(message):
+        with write_lock:
+            protocol_out.write(json.dumps(message) + "\n")
+            protocol_out.flush()
+
+    # Build the engine pool up front so every request hits a warm engine;
+    # request handlers and queue threads borrow from it for each file
+    start_engine_pool(workers)
+
+    def run(request):
+        request_id = request.get("id")
+        # Events raised while handling this request are tagged with its id
+        token = _event_sink.set(lambda message: write_message({"id": request_id, **message}))
+        try:
+            write_message({"id": request_id, "ok": True, "result": handle_request(request)})
+        except Exception as e:
+            write_message({
+                "id": request_id,
+                "ok": False,
+                "error": str(e),
+                "traceback": traceback.format_exc()
+            })
+        finally:
+            _event_sink.reset(token)
+
+    # Queue threads drain submitted jobs, including files a previous worker left unfinished
+    job_queue = get_job_queue()
+    job_queue.recover()
+    job_queue.purge()
+    stop = threading.Event()
+
+    def drain_in_background():
+        # Queued work answers no request; its progress is read back with job_status
+        _event_sink.set(lambda message: None)
+        drain_queue(job_queue, stop=stop, poll_seconds=QUEUE_POLL_SECONDS)
+
+    for _ in range(QUEUE_CONCURRENCY or workers):
+        threading.Thread(target=drain_in_background, daemon=True).start()
+
+    # Requests that hold an OCR engine run one per engine; the rest (triage, status, annotation,
+    # metrics) have threads of their own, so they are answered while every engine is busy
+    with ThreadPoolExecutor(max_workers=workers) as executor, ThreadPoolExecutor(max_workers=CONTROL_THREADS) as control:
+        write_message({"event": "ready", "workers": workers})
+
+        for line in sys.stdin:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                write_message({"id": None, "ok": False, "error": f"Invalid request: {e}"})
+                continue
+            if request.get("op") == "shutdown":
+                break
+            (executor if request.get("op", "process") in ENGINE_OPS else control).submit(run, request)
+        stop.set()
+
 # At the end of the main block in d2.py
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print(json.dumps({"error": "Usage: python d2.py <image_path or folder_path>"}))
+    parser = argparse.ArgumentParser(description="Extract structured invoice data from images and PDFs")
+    parser.add_argument("input_path", nargs="?", help="image, PDF or folder to process")
+    parser.add_argument("--serve", action="store_true", help="run as a long-lived JSON-lines worker")
+    parser.add_argument("--workers", type=int, default=1, help="warm OCR engines kept by --serve")
+    parser.add_argument("--ocr-processes", type=int, default=None, help="processes used to OCR PDF pages")
+    parser.add_argument("--no-cache", action="store_true", help="bypass the OCR and LLM caches")
+    parser.add_argument("--clear-cache", action="store_true", help="empty the OCR and LLM caches first")
+    parser.add_argument("--save-pages", action="store_true", help="also write rendered PDF pages to pdf_images/")
+    parser.add_argument("--job-id", help="name of the job's scratch directory under work/")
+    parser.add_argument("--annotate", action="store_true", help="render annotated images during extraction")
+    parser.add_argument("--metrics-file", help="write per-stage records as JSON lines to this file")
+    parser.add_argument("--prometheus-file", help="write per-stage aggregates in Prometheus text format to this file")
+    parser.add_argument("--queue", action="store_true", help="process through the durable job queue, merging the results")
+    parser.add_argument("--resume", metavar="JOB_ID", help="resume an interrupted queued job from its last finished page")
+    parser.add_argument("--drain", action="store_true", help="process everything in the job queue, then exit")
+    parser.add_argument("--concurrency", type=int, default=None, help="files processed at once from the queue")
+    parser.add_argument("--export", metavar="DIR", help="also write the merged invoices to DIR as invoice and line-item tables")
+    parser.add_argument("--export-format", choices=("parquet", "arrow", "csv"), help="format of --export tables (default parquet, CSV without pyarrow)")
+    parser.add_argument("--ocr-only", action="store_true", help="OCR and rule-based fields only; never calls OpenAI")
+    parser.add_argument("--full", action="store_true", help="redo every page, even those unchanged since the last run or seen in another file")
+    parser.add_argument("--triage", action="store_true", help="only report page counts and estimated cost of the input files")
+    parser.add_argument("--ocr-backend", choices=OCR_BACKENDS, help="how PDF pages are read (default auto: text layer when usable, else OCR)")
+    args = parser.parse_args()
+
+    if not args.input_path and not args.serve and not args.clear_cache and not args.resume and not args.drain:
+        print(json.dumps({"error": "Usage: python d2.py <image_path or folder_path> [--queue] | --resume JOB_ID | --drain | --serve [--workers N]"}))
         sys.exit(1)
 
-    input_path = sys.argv[1]
+    publish_stages()
+
+    if args.no_cache:
+        # Exported so page pool workers started later inherit it
+        os.environ["INVOICY_CACHE"] = "0"
+        ocr_cache.enabled = llm_cache.enabled = False
+    if args.clear_cache:
+        ocr_cache.clear()
+        llm_cache.clear()
+        if not args.input_path and not args.serve:
+            print(json.dumps(cache_stats()))
+            sys.exit(0)
+
+    if args.full:
+        INCREMENTAL = False
+        DEDUP = False
+
+    if args.ocr_only:
+        OCR_ONLY = True
+
+    if args.save_pages:
+        # Exported so page pool workers started later inherit it
+        os.environ["SAVE_PAGE_IMAGES"] = "1"
+        SAVE_PAGE_IMAGES = True
+
+    if args.annotate:
+        os.environ["ANNOTATE_IMAGES"] = "1"
+        ANNOTATE_IMAGES = True
+
+    if args.ocr_processes:
+        OCR_PROCESSES = max(1, args.ocr_processes)
+
+    if args.ocr_backend:
+        # Exported so page pool workers started later inherit it
+        os.environ["OCR_BACKEND"] = args.ocr_backend
+        OCR_BACKEND = args.ocr_backend
+
+    if args.serve:
+        serve(workers=max(1, args.workers))
+        sys.exit(0)
+
+    # stdout carries the NDJSON event stream; everything else is diagnostics on stderr
+    _event_out = sys.stdout
+    sys.stdout = sys.stderr
+
+    input_path = args.input_path
     try:
-        print_progress("Extracting information")
-        if input_path.lower().endswith('.pdf'):
-            pdf_images = pdf_to_images(input_path)
-            for image_path in pdf_images:
-                extracted_text, annotated_image_path, avg_confidence = extract_text_from_image(image_path)
-                print_progress("Collating information")
-                structured_data = process_text(extracted_text, invoice_schema)
-
-                output_data = {
-                    "file_name": os.path.basename(image_path),
-                    "extracted_text": extracted_text,
-                    "annotated_image_path": annotated_image_path,
-                    "structured_data": structured_data,
-                    "avg_confidence": avg_confidence,
-                    "token_usage": structured_data.get("token_usage", {})
-                }
-
-                print("Extracted Text:", extracted_text)
-                print("Structured Data:", json.dumps(structured_data, indent=2))
-                print_progress("Ready to present")
-                print(f"output data: {json.dumps(output_data)}")
+        if args.resume:
+            job_queue = get_job_queue()
+            job_queue.resume(args.resume)
+            emit_event("result", merged=finish_batch(job_queue, args.resume, args.concurrency, args.export, args.export_format))
+        elif args.drain:
+            drain(args.concurrency)
+        elif args.queue:
+            emit_event("result", merged=process_invoice_batch(input_path, job_id=args.job_id, concurrency=args.concurrency,
+                                                              export_dir=args.export, export_format=args.export_format))
+        elif args.triage:
+            emit_event("triage", files=triage_files(list_invoice_files(input_path) or []))
+        elif args.export:
+            emit_event("result", merged=process_invoice_images(input_path, job_id=args.job_id,
+                                                               export_dir=args.export, export_format=args.export_format))
         else:
-            extracted_text, annotated_image_path, avg_confidence = extract_text_from_image(input_path)
-            print_progress("Collating information")
-            structured_data = process_text(extracted_text, invoice_schema)
-
-            output_data = {
-                "file_name": os.path.basename(input_path),
-                "extracted_text": extracted_text,
-                "annotated_image_path": annotated_image_path,
-                "structured_data": structured_data,
-                "avg_confidence": avg_confidence
-            }
-
-            print_progress("Ready to present")
-            print(f"output data: {json.dumps(structured_data)}")
+            process_file(input_path, job_id=args.job_id)
+        print(f"Cache stats: {json.dumps(cache_stats())}", file=sys.stderr)
+        if args.metrics_file:
+            instrumentation.write_json(args.metrics_file)
+        if args.prometheus_file:
+            with open(args.prometheus_file, 'w') as f:
+                f.write(instrumentation.prometheus_text())
     except Exception as e:
         error_info = {
             "error": str(e),
             "traceback": traceback.format_exc()
         }
+        emit_event("error", error=str(e))
         print(json.dumps(error_info), file=sys.stderr)
         sys.exit(1)
 
@@ -310,7 +1590,6 @@ if __name__ == "__main__":
 
 
 
-
 # import os
 # import json
 # import sys
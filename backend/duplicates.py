@@ -0,0 +1,273 @@
+# duplicates.py
+# Persistent index of processed files, so an invoice uploaded again byte for byte gets its
+# earlier result back instead of going through OCR and the LLM a second time, and one that
+# arrives in another form is flagged. Three signals, from cheapest to latest:
+#   - file hash: the same file again; its stored result is reused;
+#   - perceptual hash of every page (a 256-bit difference hash of the page cropped to its
+#     ink and deskewed), matched within PHASH_MAX_DISTANCE bits: the same pages rescanned,
+#     re-rendered or recompressed. Invoices filled into one supplier's template come within
+#     a few bits of each other too, so the match is only a candidate: the new file is OCR'd
+#     and its result reused only when the invoice number, GSTIN and date the rules read from
+#     its text agree with the earlier result (confirm_match), which saves the LLM calls;
+#   - invoice key (seller GSTIN, invoice number, date, total) from the structured results:
+#     the same invoice arriving in any other form. It is only known once a file has been
+#     structured, so it flags the duplicate rather than saving the work.
+# Perceptual lookups go through the first page hash's 32-bit bands: a near duplicate shares
+# at least one band exactly (always, for up to 7 differing bits; in practice for more), so
+# each lookup is a few indexed probes however many files are stored.
+#
+# Tables: files (one row per processed file, with its outputs), bands (the first page's
+# hash bands), pages (every page's full hash) and invoice_keys.
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+from PIL import Image
+
+import preprocess
+from amounts import parse_date
+from merging import normalize_gstin, normalize_invoice_number, parse_structured, to_number
+
+DUPLICATES_DB = os.getenv("INVOICY_DUPLICATES_DB", os.path.join(os.getenv("INVOICY_CACHE_DIR", ".cache"), "duplicates.db"))
+# Pages whose hashes differ in at most this many of their 256 bits are the same page
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "16"))
+# Hash grid (bits per row and rows), band width, and the size pages are hashed at
+HASH_SIZE = 16
+BAND_BITS = 32
+HASH_DPI = 72
+HASH_SIDE = 800
+HASH_WINDOW = 16
+# Bands with fewer set (or clear) bits than this are not indexed
+MIN_BAND_BITS = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    file_id INTEGER PRIMARY KEY,
+    file_hash TEXT NOT NULL UNIQUE,
+    source TEXT NOT NULL,
+    page_count INTEGER NOT NULL,
+    settings TEXT NOT NULL,
+    outputs TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pages (
+    file_id INTEGER NOT NULL,
+    page_number INTEGER NOT NULL,
+    phash BLOB NOT NULL,
+    PRIMARY KEY (file_id, page_number)
+);
+CREATE TABLE IF NOT EXISTS bands (
+    band INTEGER NOT NULL,
+    value INTEGER NOT NULL,
+    file_id INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS bands_value ON bands (band, value);
+CREATE INDEX IF NOT EXISTS bands_file ON bands (file_id);
+CREATE TABLE IF NOT EXISTS invoice_keys (
+    invoice_key TEXT PRIMARY KEY,
+    file_id INTEGER NOT NULL,
+    page_number INTEGER NOT NULL
+);
+"""
+
+# Function to compute the perceptual hash of a page image: 32 bytes, one bit per horizontal
+# brightness step on a 16x16 grid over the page's content, straightened
+def page_hash(image):
+    gray = image.convert("L")
+    gray.thumbnail((HASH_SIDE, HASH_SIDE))
+    info = preprocess.analyze(gray)
+    if preprocess.MIN_SKEW_DEGREES <= abs(info["skew"]) <= preprocess.MAX_SKEW_DEGREES:
+        # Straighten first, so the content box is that of the upright page
+        gray = gray.rotate(info["skew"], resample=Image.BILINEAR, fillcolor=255)
+        info = preprocess.analyze(gray)
+    if info["ink_box"]:
+        left, top, right, bottom = info["ink_box"]
+        gray = gray.crop((int(left), int(top), int(right) + 1, int(bottom) + 1))
+    grid = np.asarray(gray.resize((HASH_SIZE + 1, HASH_SIZE), Image.BILINEAR), dtype=np.int16)
+    return np.packbits(grid[:, 1:] > grid[:, :-1]).tobytes()
+
+# Function to split a hash into its bands, as (band number, value); bands that are (nearly)
+# all one value — blank stretches of the page — are left out, since every page shares them
+def hash_bands(phash):
+    step = BAND_BITS // 8
+    bands = []
+    for band, start in enumerate(range(0, len(phash), step)):
+        value = int.from_bytes(phash[start:start + step], "big")
+        if MIN_BAND_BITS <= value.bit_count() <= BAND_BITS - MIN_BAND_BITS:
+            bands.append((band, value))
+    return bands
+
+def distance(a, b):
+    return (int.from_bytes(a, "big") ^ int.from_bytes(b, "big")).bit_count()
+
+# Function to hash every page of a file; a PDF is rendered small, an image is decoded at reduced size
+def page_hashes(file_path):
+    if not file_path.lower().endswith('.pdf'):
+        with Image.open(file_path) as image:
+            image.draft("L", (HASH_SIDE, HASH_SIDE))
+            return [page_hash(image)]
+    from pdf2image import convert_from_path, pdfinfo_from_path
+    page_count = int(pdfinfo_from_path(file_path)["Pages"])
+    hashes = []
+    for first_page in range(1, page_count + 1, HASH_WINDOW):
+        last_page = min(first_page + HASH_WINDOW - 1, page_count)
+        for image in convert_from_path(file_path, dpi=HASH_DPI, first_page=first_page, last_page=last_page, grayscale=True):
+            hashes.append(page_hash(image))
+    return hashes
+
+# Function to normalize a date for comparison: ISO when it parses, else the text without spaces
+def normalize_date(value):
+    return parse_date(value) or re.sub(r"\s", "", str(value or ""))
+
+# Fields rules.py reads from OCR text that must agree with an earlier file's result before it
+# is reused for a perceptual match, with how each is normalized for the comparison
+CONFIRM_FIELDS = {"invoiceNumber": normalize_invoice_number, "gst": normalize_gstin, "invoiceDate": normalize_date}
+
+# Function to check a perceptual match against the new file's text. `pages` holds the fields the
+# rules read from each of its pages, `outputs` the earlier file's outputs. Confirmed when no
+# field read on both sides differs, and each of CONFIRM_FIELDS agreed on at least one page.
+def confirm_match(pages, outputs):
+    if len(pages) != len(outputs):
+        return False
+    agreed = set()
+    for fields, output in zip(pages, outputs):
+        # A single image's output is its structured data
+        earlier = parse_structured(output.get("structured_data", output)) or {}
+        for field, normalize in CONFIRM_FIELDS.items():
+            ours, theirs = fields.get(field), earlier.get(field)
+            if not ours or not theirs:
+                continue
+            if normalize(ours) != normalize(theirs):
+                return False
+            agreed.add(field)
+    return agreed == set(CONFIRM_FIELDS)
+
+# Function to build the normalized invoice key of one page's structured data; None unless all four parts are present
+def invoice_key(structured_data):
+    invoice = parse_structured(structured_data)
+    if not invoice:
+        return None
+    total = to_number(invoice.get("invoiceTotalAmount"))
+    parts = [normalize_gstin(invoice.get("gst")), normalize_invoice_number(invoice.get("invoiceNumber")),
+             normalize_date(invoice.get("invoiceDate")), f"{total:.2f}" if total is not None else ""]
+    return "|".join(parts) if all(parts) else None
+
+class DuplicateIndex:
+    def __init__(self, path=None):
+        self.path = path or DUPLICATES_DB
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._local = threading.local()
+        self._connection().executescript(SCHEMA)
+
+    # One connection per thread, as in jobqueue.py
+    def _connection(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    def _match(self, row, kind, **fields):
+        return {"match": kind, "file_hash": row["file_hash"], "source": row["source"],
+                "outputs": json.loads(row["outputs"]), **fields}
+
+    # Function to find an earlier file with the same content. `settings` must equal those
+    # the earlier file was processed under. Returns {"match", "file_hash", "source",
+    # "outputs", ...} or None; `hashes` are the file's page hashes when already computed.
+    def find_file(self, file_hash, settings, hashes=None):
+        db = self._connection()
+        row = db.execute("SELECT * FROM files WHERE file_hash = ? AND settings = ?", (file_hash, settings)).fetchone()
+        if row is not None:
+            return self._match(row, "file_hash")
+        if not hashes:
+            return None
+
+        # Files whose first page shares a band with ours and is within the distance, then the rest of their pages
+        probes = hash_bands(hashes[0])
+        if not probes:
+            return None
+        candidates = db.execute(
+            "SELECT DISTINCT p.file_id, p.phash FROM bands b JOIN pages p ON p.file_id = b.file_id AND p.page_number = 1 "
+            "WHERE " + " OR ".join(["(b.band = ? AND b.value = ?)"] * len(probes)),
+            [value for probe in probes for value in probe]
+        ).fetchall()
+        for candidate in candidates:
+            if distance(candidate["phash"], hashes[0]) > PHASH_MAX_DISTANCE:
+                continue
+            row = db.execute("SELECT * FROM files WHERE file_id = ? AND settings = ? AND page_count = ?",
+                             (candidate["file_id"], settings, len(hashes))).fetchone()
+            if row is None or row["file_hash"] == file_hash:
+                continue
+            stored = [page["phash"] for page in db.execute(
+                "SELECT phash FROM pages WHERE file_id = ? ORDER BY page_number", (row["file_id"],))]
+            distances = [distance(a, b) for a, b in zip(hashes, stored)]
+            if len(stored) == len(hashes) and max(distances) <= PHASH_MAX_DISTANCE:
+                return self._match(row, "perceptual", distance=max(distances))
+        return None
+
+    # Function to find earlier files holding the same invoices; returns [{"page_number", "invoice_key", "file_hash", "source", "page"}]
+    def find_invoices(self, keys, file_hash=None):
+        db = self._connection()
+        matches = []
+        for page_number, key in keys:
+            row = db.execute(
+                "SELECT f.file_hash, k.page_number, f.source FROM invoice_keys k JOIN files f ON f.file_id = k.file_id "
+                "WHERE k.invoice_key = ?", (key,)
+            ).fetchone()
+            if row is not None and row["file_hash"] != file_hash:
+                matches.append({"page_number": page_number, "invoice_key": key, "file_hash": row["file_hash"],
+                                "source": row["source"], "page": row["page_number"]})
+        return matches
+
+    # Function to record a processed file: its outputs, page hashes and invoice keys ([(page_number, key)])
+    def add(self, file_hash, source, settings, outputs, hashes, keys):
+        self.add_many([(file_hash, source, settings, outputs, hashes, keys)])
+
+    # Function to record many files in one transaction; each record holds add()'s arguments
+    def add_many(self, records):
+        with self._transaction() as db:
+            for file_hash, source, settings, outputs, hashes, keys in records:
+                fields = (source, len(hashes), settings, json.dumps(outputs), time.time())
+                row = db.execute("SELECT file_id FROM files WHERE file_hash = ?", (file_hash,)).fetchone()
+                if row is None:
+                    file_id = db.execute(
+                        "INSERT INTO files (file_hash, source, page_count, settings, outputs, created) VALUES (?, ?, ?, ?, ?, ?)",
+                        (file_hash, *fields)
+                    ).lastrowid
+                else:
+                    # Processed again (under other settings): the new result replaces the old one
+                    file_id = row["file_id"]
+                    db.execute("UPDATE files SET source = ?, page_count = ?, settings = ?, outputs = ?, created = ? WHERE file_id = ?",
+                               (*fields, file_id))
+                    db.execute("DELETE FROM bands WHERE file_id = ?", (file_id,))
+                    db.execute("DELETE FROM pages WHERE file_id = ?", (file_id,))
+                db.executemany("INSERT INTO pages (file_id, page_number, phash) VALUES (?, ?, ?)",
+                               [(file_id, page_number, phash) for page_number, phash in enumerate(hashes, start=1)])
+                if hashes:
+                    db.executemany("INSERT INTO bands (band, value, file_id) VALUES (?, ?, ?)",
+                                   [(band, value, file_id) for band, value in hash_bands(hashes[0])])
+                # The first file an invoice was seen in stays its reference
+                db.executemany("INSERT OR IGNORE INTO invoice_keys (invoice_key, file_id, page_number) VALUES (?, ?, ?)",
+                               [(key, file_id, page_number) for page_number, key in keys])
+
+    def count(self):
+        return self._connection().execute("SELECT COUNT(*) FROM files").fetchone()[0]
@@ -0,0 +1,228 @@
+# export.py
+# Columnar export of merged invoices for analytics. Header fields go to an `invoices`
+# table; `items` and `hsnOrSacCodesWithItemNames` go to `items` and `hsn_codes` tables,
+# one row per line, joined to their invoice on invoice_key (and invoiceNumber/gst).
+# Columns come from invoice_schema.json, so every batch writes the same table layout.
+#
+# Rows are buffered EXPORT_CHUNK_ROWS at a time and written as one Parquet row group
+# (or Arrow record batch), so memory stays flat however many invoices a batch has.
+# Each export adds new part files, which readers pick up as one dataset:
+#   <directory>/<table>/part-<batch_id>.parquet   (or .arrow, or .csv without pyarrow)
+# Exporting a batch again replaces its parts.
+import csv
+import json
+import os
+import time
+import uuid
+
+from merging import to_number
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Optional; CSV is written instead
+    pa = pq = None
+
+EXPORT_FORMAT = os.getenv("EXPORT_FORMAT", "parquet")
+EXPORT_CHUNK_ROWS = int(os.getenv("EXPORT_CHUNK_ROWS", "5000"))
+FORMATS = ("parquet", "arrow", "csv")
+
+# Columns every table starts with, ahead of the schema's own fields
+INVOICE_COLUMNS = [
+    ("batch_id", "string"), ("invoice_key", "string"), ("source_files", "string"), ("page_count", "integer"),
+    ("avg_confidence", "number"), ("prompt_tokens", "integer"), ("completion_tokens", "integer"),
+    ("items_match_pre_tax", "boolean"), ("total_matches", "boolean"), ("exchange_rate", "number"), ("total_inr", "number")
+]
+LINE_COLUMNS = [
+    ("batch_id", "string"), ("invoice_key", "string"), ("invoiceNumber", "string"), ("gst", "string"), ("line", "integer")
+]
+# Line-item tables and the schema array each one is built from
+LINE_TABLES = {"items": "items", "hsn_codes": "hsnOrSacCodesWithItemNames"}
+
+# Function to map a schema property to a column kind; objects and arrays are stored as JSON text
+def column_kind(prop):
+    kind = prop.get("type", "string")
+    return kind if kind in ("number", "integer", "boolean") else "string"
+
+# Function to lay out the export tables for a schema: {table: [(column, kind), ...]}
+def table_columns(schema):
+    properties = schema.get("properties", {})
+    array_fields = set(LINE_TABLES.values())
+    tables = {"invoices": INVOICE_COLUMNS + [
+        (name, column_kind(prop)) for name, prop in properties.items() if name not in array_fields
+    ]}
+    for table, field in LINE_TABLES.items():
+        item_properties = properties.get(field, {}).get("items", {}).get("properties", {})
+        tables[table] = LINE_COLUMNS + [(name, column_kind(prop)) for name, prop in item_properties.items()]
+    return tables
+
+# Function to convert a value to its column kind; values that don't fit become null
+def cell(value, kind):
+    if value is None or value == "":
+        return None
+    if kind == "number":
+        return to_number(value)
+    if kind == "integer":
+        number = to_number(value)
+        return int(number) if number is not None else None
+    if kind == "boolean":
+        return value if isinstance(value, bool) else None
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False)
+    return str(value)
+
+ARROW_TYPES = {"string": "string", "number": "float64", "integer": "int64", "boolean": "bool_"}
+
+class TableWriter:
+    # Buffers rows of one table and writes them out a chunk at a time
+    def __init__(self, directory, name, columns, fmt, batch_id):
+        self.columns = columns
+        self.fmt = fmt
+        self.rows = 0
+        self._buffer = []
+        self._writer = None
+        os.makedirs(os.path.join(directory, name), exist_ok=True)
+        self.path = os.path.join(directory, name, f"part-{batch_id}.{fmt}")
+        # Readers of the dataset never see a half-written part
+        self._tmp_path = os.path.join(directory, name, f".part-{batch_id}.{fmt}.tmp")
+
+    def add(self, row):
+        self._buffer.append([cell(row.get(column), kind) for column, kind in self.columns])
+        if len(self._buffer) >= EXPORT_CHUNK_ROWS:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        if self.fmt == "csv":
+            self._flush_csv()
+        else:
+            self._flush_arrow()
+        self.rows += len(self._buffer)
+        self._buffer = []
+
+    def _flush_csv(self):
+        if self._writer is None:
+            self._sink = open(self._tmp_path, 'w', newline='', encoding='utf-8')
+            self._writer = csv.writer(self._sink)
+            self._writer.writerow([column for column, _ in self.columns])
+        self._writer.writerows(self._buffer)
+
+    def _flush_arrow(self):
+        if self._writer is None:
+            self.arrow_schema = pa.schema([(column, getattr(pa, ARROW_TYPES[kind])()) for column, kind in self.columns])
+            if self.fmt == "parquet":
+                self._writer = pq.ParquetWriter(self._tmp_path, self.arrow_schema, compression="zstd")
+            else:
+                self._sink = pa.OSFile(self._tmp_path, 'wb')
+                self._writer = pa.ipc.new_file(self._sink, self.arrow_schema)
+        columns = list(zip(*self._buffer))
+        table = pa.Table.from_arrays(
+            [pa.array(values, type=field.type) for values, field in zip(columns, self.arrow_schema)],
+            schema=self.arrow_schema
+        )
+        self._writer.write_table(table)
+
+    # Function to write what is left and publish the part file; returns its path, or None if empty
+    def close(self):
+        self.flush()
+        if self._writer is None:
+            # Nothing for this table now; a part from an earlier export of the batch goes too
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return None
+        self._close_writer()
+        os.replace(self._tmp_path, self.path)
+        return self.path
+
+    def _close_writer(self):
+        if self.fmt != "csv":
+            self._writer.close()
+        if self.fmt != "parquet":
+            self._sink.close()
+
+    # Function to drop a part that was never finished
+    def abort(self):
+        if self._writer is not None:
+            self._close_writer()
+            os.remove(self._tmp_path)
+        self._writer = None
+
+class InvoiceExporter:
+    # Usage: with InvoiceExporter("exports", invoice_schema) as exporter:
+    #            for key, invoice in merged.items(): exporter.add(key, invoice)
+    def __init__(self, directory, schema, fmt=None, batch_id=None):
+        fmt = (fmt or EXPORT_FORMAT).lower()
+        if fmt not in FORMATS:
+            raise ValueError(f"Unknown export format: {fmt} (expected one of {', '.join(FORMATS)})")
+        if fmt != "csv" and pa is None:
+            print(f"pyarrow is not installed; exporting CSV instead of {fmt}")
+            fmt = "csv"
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fmt = fmt
+        self.batch_id = batch_id or f"{time.strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self.invoices = 0
+        self.tables = {
+            name: TableWriter(directory, name, columns, fmt, self.batch_id)
+            for name, columns in table_columns(schema).items()
+        }
+
+    # Function to add one merged invoice (a merge_invoice_data value) under its merge key
+    def add(self, key, invoice):
+        header = invoice.get("structured_data") or {}
+        reconciliation = invoice.get("reconciliation") or {}
+        token_usage = invoice.get("token_usage") or {}
+        converted = invoice.get("amounts") or {}
+        sources = []
+        for page in invoice.get("pages") or []:
+            if page.get("source") and page["source"] not in sources:
+                sources.append(page["source"])
+        self.tables["invoices"].add({
+            **header,
+            "batch_id": self.batch_id,
+            "invoice_key": key,
+            "source_files": ";".join(sources),
+            "page_count": invoice.get("page_count"),
+            "avg_confidence": invoice.get("avg_confidence"),
+            "prompt_tokens": token_usage.get("prompt_tokens"),
+            "completion_tokens": token_usage.get("completion_tokens"),
+            "items_match_pre_tax": reconciliation.get("items_match_pre_tax"),
+            "total_matches": reconciliation.get("total_matches"),
+            "exchange_rate": converted.get("exchange_rate"),
+            "total_inr": converted.get("total_inr")
+        })
+        link = {"batch_id": self.batch_id, "invoice_key": key,
+                "invoiceNumber": header.get("invoiceNumber"), "gst": header.get("gst")}
+        for table, field in LINE_TABLES.items():
+            for line, item in enumerate(header.get(field) or [], start=1):
+                if isinstance(item, dict):
+                    self.tables[table].add({**item, **link, "line": line})
+        self.invoices += 1
+
+    # Function to finish every table; returns {table: {"path", "rows"}} for the tables written
+    def close(self):
+        written = {}
+        for name, table in self.tables.items():
+            path = table.close()
+            if path:
+                written[name] = {"path": os.path.abspath(path), "rows": table.rows}
+        return written
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            for table in self.tables.values():
+                table.abort()
+            return False
+        self.written = self.close()
+        return False
+
+# Function to export a merge_invoice_data result in one go; returns what was written
+def export_invoices(merged_data, directory, schema, fmt=None, batch_id=None):
+    with InvoiceExporter(directory, schema, fmt, batch_id) as exporter:
+        for key, invoice in merged_data.items():
+            exporter.add(key, invoice)
+    return {"format": exporter.fmt, "batch_id": exporter.batch_id, "invoices": exporter.invoices, "tables": exporter.written}
@@ -2,15 +2,31 @@
 const express = require('express');
 const cors = require('cors');
 const bodyParser = require('body-parser');
-const { spawn } = require('child_process');
 const multer = require('multer');
 const path = require('path');
 const fs = require('fs');
+const crypto = require('crypto');
 const Promise = require('bluebird');
+const { ExtractionWorker } = require('./workerPool');
+const { SizeAwareScheduler, planJobs } = require('./scheduler');
 
 
 const app = express();
 const port = 5000;
+const extractionConcurrency = parseInt(process.env.EXTRACTION_WORKERS || '4', 10);
+// PDFs longer than this many pages are processed as separate page ranges
+const splitPages = parseInt(process.env.SPLIT_PAGES || '10', 10);
+
+// Warm d2.py worker shared by all requests, so OCR models load once per server
+const extractionWorker = new ExtractionWorker({ workers: extractionConcurrency });
+extractionWorker.start();
+
+// One queue for the files of every request, shortest estimated job first, so the worker's
+// engines are never asked for more than they can run at once
+const scheduler = new SizeAwareScheduler({
+  concurrency: extractionConcurrency,
+  agingRate: parseFloat(process.env.SCHEDULER_AGING_RATE || '1'),
+});
 
 // Configure CORS to allow specific origins and credentials
 const corsOptions = {
@@ -51,13 +67,78 @@ app.post('/upload', upload.single('file'), async (req, res) => {
   console.log(`File uploaded: ${file.filename}`);
 
   if (fileExt === '.pdf' || fileExt === '.jpg' || fileExt === '.png') {
-    res.json({ files: [`http://127.0.0.1:5000/uploads/${file.filename}`] });
+    // Flag a file that was processed before (same bytes, or the same pages scanned again);
+    // processing it hands back the earlier result
+    let duplicateOf = null;
+    try {
+      const { duplicate } = await extractionWorker.request({ op: 'find_duplicate', path: filePath });
+      duplicateOf = duplicate;
+    } catch (error) {
+      console.error('Duplicate check failed:', error);
+    }
+    res.json({ files: [`http://127.0.0.1:5000/uploads/${file.filename}`], duplicateOf });
   } else {
     console.log('Unsupported file type:', file.filename);
     res.status(400).send('Unsupported file type');
   }
 });
 
+// Shape one page record from the extraction worker for the client
+const toClientRecord = (outputData, fileName) => {
+  const imagePaths = outputData.image_paths || [];
+  const imageUrls = imagePaths.map(imagePath => `http://127.0.0.1:5000/uploads/${path.basename(imagePath)}`);
+  return { ...outputData, imageUrls, fileName };
+};
+
+// Run one uploaded file (or the page range `pages` = [first, last] of a PDF) through the
+// extraction worker; resolves to one record per page
+const processFile = async (fileName, onEvent = null, pages = null) => {
+  const filePath = path.join(uploadsDir, fileName);
+
+  if (!fs.existsSync(filePath)) {
+    console.error('File not found:', filePath);
+    return [{ error: 'File not found', fileName }];
+  }
+
+  try {
+    // Each file gets its own job id, so its scratch files live in work/<jobId>/ on the Python side
+    const jobId = crypto.randomUUID();
+    const { outputs } = await extractionWorker.request({ op: 'process', path: filePath, job_id: jobId, pages }, onEvent);
+    if (!outputs || outputs.length === 0) {
+      throw { error: 'No output data found in Python script output', fileName };
+    }
+    return outputs.map(outputData => ({ ...toClientRecord(outputData, fileName), jobId }));
+  } catch (error) {
+    console.error('Python script error:', error);
+    throw { ...error, fileName };
+  }
+};
+
+// Page count, text layer and estimated seconds of each file, read without rendering anything;
+// files that can't be triaged are scheduled with a default estimate
+const triageFiles = async (fileNames) => {
+  const existing = fileNames.filter((fileName) => fs.existsSync(path.join(uploadsDir, fileName)));
+  try {
+    const { files } = await extractionWorker.request({
+      op: 'triage', paths: existing.map((fileName) => path.join(uploadsDir, fileName)),
+    });
+    return new Map(existing.map((fileName, index) => [fileName, files[index]]));
+  } catch (error) {
+    console.error('Triage failed:', error);
+    return new Map();
+  }
+};
+
+// Schedule one triaged file, split into page ranges if it is long and has no earlier
+// results to reuse; resolves to its page records in page order
+const scheduleFile = async (fileName, triage, onEvent = null) => {
+  const jobs = planJobs(triage, splitPages);
+  const parts = await Promise.all(jobs.map(({ pages, estimatedSeconds }) => (
+    scheduler.submit(estimatedSeconds, () => processFile(fileName, onEvent, pages))
+  )));
+  return parts.flat();
+};
+
 // Endpoint to process invoice using Python script
 
 app.post('/processInvoice', async (req, res) => {
@@ -69,65 +150,152 @@ app.post('/processInvoice', async (req, res) => {
       return res.status(400).json({ error: 'File names are undefined or not an array' });
     }
 
-    const processFile = async (fileName) => {
-      const filePath = path.join(uploadsDir, fileName);
+    // Every page of every file is returned, in file then page order, whatever order they ran in
+    const triaged = await triageFiles(fileNames);
+    const results = await Promise.all(fileNames.map((fileName) => scheduleFile(fileName, triaged.get(fileName))));
+    res.json(results.flat());
+  } catch (error) {
+    console.error('Error processing invoices:', error);
+    res.status(500).json({ error: 'Failed to process invoices', details: error.message });
+  }
+});
+
+// Same as /processInvoice, but pipeline events are streamed as Server-Sent Events so the
+// client sees each page's result as soon as it is ready.
+// Usage: GET /processInvoice/events?fileNames=a.pdf&fileNames=b.jpg
+app.get('/processInvoice/events', async (req, res) => {
+  const fileNames = [].concat(req.query.fileNames || []);
+  if (fileNames.length === 0) {
+    return res.status(400).json({ error: 'File names are undefined or not an array' });
+  }
+
+  res.set({
+    'Content-Type': 'text/event-stream',
+    'Cache-Control': 'no-cache',
+    Connection: 'keep-alive',
+  });
+  res.flushHeaders();
+
+  let closed = false;
+  req.on('close', () => {
+    closed = true;
+  });
+
+  const send = (event, data) => {
+    if (!closed) {
+      res.write(`event: ${event}\ndata: ${JSON.stringify(data)}\n\n`);
+    }
+  };
+
+  const forward = (fileName) => (message) => {
+    const { id, event, ...data } = message;
+    if (event === 'page-result') {
+      data.output = toClientRecord(data.output, fileName);
+    }
+    send(event, { ...data, fileName });
+  };
+
+  const triaged = await triageFiles(fileNames);
+  send('triage', { files: fileNames.map((fileName) => ({ fileName, ...triaged.get(fileName) })) });
 
-      if (!fs.existsSync(filePath)) {
-        console.error('File not found:', filePath);
-        return { error: 'File not found', fileName };
+  await Promise.all(fileNames.map(async (fileName) => {
+    try {
+      const records = await scheduleFile(fileName, triaged.get(fileName), forward(fileName));
+      if (records.length > 0 && records[0].error) {
+        send('file-error', records[0]);
       }
+    } catch (error) {
+      send('file-error', { fileName, error: error.error || 'Failed to process invoice', details: error.details });
+    }
+  }));
+
+  send('complete', { fileNames });
+  res.end();
+});
+
+// Durable batch submission: files are queued in the worker's SQLite job queue and the
+// job id is returned at once. Every page is checkpointed, so a restart of this server
+// (and of the worker with it) resumes the batch from the last finished page.
+app.post('/jobs', async (req, res) => {
+  const { fileNames } = req.body;
+  if (!fileNames || !Array.isArray(fileNames) || fileNames.length === 0) {
+    return res.status(400).json({ error: 'File names are undefined or not an array' });
+  }
 
-      return new Promise((resolve, reject) => {
-        const pythonProcess = spawn('python', ['d2.py', filePath]);
-
-        let pythonOutput = '';
-        let pythonError = '';
-
-        pythonProcess.stdout.on('data', (data) => {
-          pythonOutput += data.toString();
-          console.log(`Python stdout for ${fileName}: ${data.toString()}`);
-        });
-
-        pythonProcess.stderr.on('data', (data) => {
-          pythonError += data.toString();
-          console.error(`Python stderr for ${fileName}: ${data.toString()}`);
-        });
-
-        pythonProcess.on('close', (code) => {
-          console.log(`Python process for ${fileName} exited with code ${code}`);
-
-          if (code !== 0) {
-            console.error('Python script error:', pythonError);
-            reject({ error: 'Python script error', details: pythonError, fileName });
-          }
-
-          try {
-            const match = pythonOutput.match(/output data: (.*)/);
-            if (match && match[1]) {
-              const outputData = JSON.parse(match[1]);
-              const imagePaths = outputData.image_paths || [];
-              const imageUrls = imagePaths.map(imagePath => `http://127.0.0.1:5000/uploads/${path.basename(imagePath)}`);
-              resolve({ ...outputData, imageUrls, fileName });
-            } else {
-              reject({ error: 'No output data found in Python script output', fileName });
-            }
-          } catch (error) {
-            console.error('Error parsing Python script output:', error);
-            console.error('Python output:', pythonOutput);
-            reject({ error: 'Failed to parse invoice data', details: error.message, fileName });
-          }
-        });
-      });
-    };
-
-    const results = await Promise.map(fileNames, processFile, { concurrency: 4 });
-    res.json(results);
+  const missing = fileNames.filter((fileName) => !fs.existsSync(path.join(uploadsDir, path.basename(fileName))));
+  if (missing.length > 0) {
+    return res.status(404).json({ error: 'File not found', fileNames: missing });
+  }
+
+  try {
+    const paths = fileNames.map((fileName) => path.join(uploadsDir, path.basename(fileName)));
+    const { job_id: jobId } = await extractionWorker.request({ op: 'submit', paths });
+    res.status(202).json({ jobId });
   } catch (error) {
-    console.error('Error processing invoices:', error);
-    res.status(500).json({ error: 'Failed to process invoices', details: error.message });
+    res.status(500).json({ error: 'Failed to queue invoices', details: error.error });
   }
 });
 
+// Progress of a queued job; once files finish, their page records are included
+app.get('/jobs/:jobId', async (req, res) => {
+  try {
+    const status = await extractionWorker.request({ op: 'job_status', job_id: req.params.jobId, results: true });
+    const files = status.files.map(({ outputs, ...file }) => ({
+      ...file,
+      records: (outputs || []).map((outputData) => ({ ...toClientRecord(outputData, file.file), jobId: status.job_id })),
+    }));
+    res.json({ ...status, files });
+  } catch (error) {
+    res.status(404).json({ error: 'Job not found', details: error.error });
+  }
+});
+
+// Put a job's failed files back in the queue; pages already finished are not redone
+app.post('/jobs/:jobId/resume', async (req, res) => {
+  try {
+    res.json(await extractionWorker.request({ op: 'job_resume', job_id: req.params.jobId }));
+  } catch (error) {
+    res.status(404).json({ error: 'Job not found', details: error.error });
+  }
+});
+
+// Export a job's merged invoices as invoice and line-item tables (Parquet by default;
+// ?format=arrow or csv). Responds with the files written and their row counts.
+app.post('/jobs/:jobId/export', async (req, res) => {
+  const format = req.query.format || (req.body && req.body.format);
+  try {
+    res.json(await extractionWorker.request({ op: 'export', job_id: req.params.jobId, format }));
+  } catch (error) {
+    res.status(404).json({ error: 'Export failed', details: error.error });
+  }
+});
+
+// Annotated view of one processed page, rendered on demand from its stored OCR boxes.
+// Usage: GET /annotated/invoice.pdf?page=2&size=1200 (size limits the long side in pixels)
+app.get('/annotated/:fileName', async (req, res) => {
+  const filePath = path.join(uploadsDir, path.basename(req.params.fileName));
+  const page = parseInt(req.query.page || '1', 10);
+  const maxSize = req.query.size ? parseInt(req.query.size, 10) : null;
+
+  try {
+    const { annotated_image_path: annotatedPath } = await extractionWorker.request({
+      op: 'annotate', path: filePath, page, max_size: maxSize,
+    });
+    res.sendFile(annotatedPath);
+  } catch (error) {
+    res.status(404).json({ error: 'Annotated image not available', details: error.error });
+  }
+});
+
+// Per-stage timing and resource aggregates from the extraction worker, in Prometheus text format
+app.get('/metrics', async (req, res) => {
+  try {
+    const { prometheus } = await extractionWorker.request({ op: 'metrics' });
+    res.type('text/plain; version=0.0.4').send(prometheus);
+  } catch (error) {
+    res.status(500).json({ error: 'Failed to collect metrics', details: error.error });
+  }
+});
 
 app.listen(port, () => {
   console.log(`Server is running on port ${port}`);
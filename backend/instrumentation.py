@@ -0,0 +1,163 @@
+# instrumentation.py
+# Stage-level timing and resource records for the extraction pipeline.
+# Each `with stage("name", **attrs) as record:` block produces one JSON-able record
+# with wall time, CPU time and peak RSS, plus whatever attributes the stage adds
+# (page dimensions, OCR box counts, token usage, ...).
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Histogram buckets (seconds) for the Prometheus dump
+WALL_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Raw records are kept in a bounded buffer; per-stage aggregates are cumulative,
+# so the long-lived --serve worker does not grow without bound
+_records = deque(maxlen=int(os.getenv("STAGE_RECORDS_MAX", "10000")))
+_aggregates = {}
+_records_lock = threading.Lock()
+_listener = None
+# Records produced inside a collect() block are also gathered here, so page pool
+# workers can ship their records back to the parent process
+_collector = contextvars.ContextVar("stage_collector", default=None)
+
+# Function to read this process's peak resident set size in MB
+def peak_rss_mb():
+    if resource is None:
+        return None
+    # ru_maxrss is in KB on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+# Function to register a callback invoked with every finished record (or None to stop)
+def set_listener(listener):
+    global _listener
+    _listener = listener
+
+# Function to fold one record into the per-stage aggregates
+def _aggregate(record):
+    entry = _aggregates.setdefault(record["stage"], {
+        "count": 0,
+        "errors": 0,
+        "wall_seconds": 0.0,
+        "cpu_seconds": 0.0,
+        "max_wall_seconds": 0.0,
+        "peak_rss_mb": 0.0,
+        "buckets": [0] * len(WALL_BUCKETS)
+    })
+    entry["count"] += 1
+    entry["errors"] += 1 if "error" in record else 0
+    entry["wall_seconds"] += record["wall_seconds"]
+    entry["cpu_seconds"] += record["cpu_seconds"]
+    entry["max_wall_seconds"] = max(entry["max_wall_seconds"], record["wall_seconds"])
+    entry["peak_rss_mb"] = max(entry["peak_rss_mb"], record.get("peak_rss_mb") or 0.0)
+    for i, bound in enumerate(WALL_BUCKETS):
+        if record["wall_seconds"] <= bound:
+            entry["buckets"][i] += 1
+    for key in ("boxes", "prompt_tokens", "completion_tokens", "tokens_saved", "validation_errors", "pages"):
+        if isinstance(record.get(key), (int, float)):
+            entry[key] = entry.get(key, 0) + record[key]
+
+def add_record(record):
+    with _records_lock:
+        _records.append(record)
+        _aggregate(record)
+    collected = _collector.get()
+    if collected is not None:
+        collected.append(record)
+    if _listener:
+        _listener(record)
+
+@contextmanager
+def stage(name, **attrs):
+    record = {"stage": name, **attrs}
+    wall_start = time.perf_counter()
+    # process_time covers every thread, so concurrent stages overlap in cpu_seconds
+    cpu_start = time.process_time()
+    try:
+        yield record
+    except Exception as e:
+        record["error"] = str(e)
+        raise
+    finally:
+        record["wall_seconds"] = round(time.perf_counter() - wall_start, 4)
+        record["cpu_seconds"] = round(time.process_time() - cpu_start, 4)
+        record["peak_rss_mb"] = peak_rss_mb()
+        record["timestamp"] = time.time()
+        add_record(record)
+
+@contextmanager
+def collect():
+    collected = []
+    token = _collector.set(collected)
+    try:
+        yield collected
+    finally:
+        _collector.reset(token)
+
+# Function to take over records produced in another process
+def adopt(records):
+    for record in records:
+        add_record(record)
+
+def records():
+    with _records_lock:
+        return list(_records)
+
+def reset():
+    with _records_lock:
+        _records.clear()
+        _aggregates.clear()
+
+# Function to write every record as one JSON line
+def write_json(path):
+    with open(path, 'w', encoding='utf-8') as f:
+        for record in records():
+            f.write(json.dumps(record) + "\n")
+
+# Function to return the per-stage aggregates
+def summary():
+    with _records_lock:
+        return {name: {**entry, "buckets": list(entry["buckets"])} for name, entry in _aggregates.items()}
+
+# Function to render the per-stage aggregates in Prometheus text exposition format
+def prometheus_text():
+    lines = [
+        "# HELP invoicy_stage_wall_seconds Wall time spent per pipeline stage.",
+        "# TYPE invoicy_stage_wall_seconds histogram"
+    ]
+    stages = summary()
+    for name, entry in stages.items():
+        for bound, count in zip(WALL_BUCKETS, entry["buckets"]):
+            lines.append(f'invoicy_stage_wall_seconds_bucket{{stage="{name}",le="{bound}"}} {count}')
+        lines.append(f'invoicy_stage_wall_seconds_bucket{{stage="{name}",le="+Inf"}} {entry["count"]}')
+        lines.append(f'invoicy_stage_wall_seconds_sum{{stage="{name}"}} {entry["wall_seconds"]:.4f}')
+        lines.append(f'invoicy_stage_wall_seconds_count{{stage="{name}"}} {entry["count"]}')
+
+    gauges = [
+        ("invoicy_stage_cpu_seconds_total", "counter", "CPU time (whole process) spent per stage.", "cpu_seconds"),
+        ("invoicy_stage_errors_total", "counter", "Stage executions that raised.", "errors"),
+        ("invoicy_stage_peak_rss_mb", "gauge", "Peak RSS observed at the end of a stage.", "peak_rss_mb"),
+        ("invoicy_stage_pages_total", "counter", "Pages handled.", "pages"),
+        ("invoicy_ocr_boxes_total", "counter", "OCR boxes detected.", "boxes"),
+        ("invoicy_llm_prompt_tokens_total", "counter", "Prompt tokens billed.", "prompt_tokens"),
+        ("invoicy_llm_completion_tokens_total", "counter", "Completion tokens billed.", "completion_tokens"),
+        ("invoicy_llm_prompt_tokens_saved_total", "counter", "Estimated prompt tokens saved by the compact prompt.", "tokens_saved"),
+        ("invoicy_validation_errors_total", "counter", "Fields that failed schema validation before any re-ask.", "validation_errors")
+    ]
+    for metric, kind, help_text, key in gauges:
+        values = [(name, entry[key]) for name, entry in stages.items() if key in entry]
+        if not values:
+            continue
+        lines.append(f"# HELP {metric} {help_text}")
+        lines.append(f"# TYPE {metric} {kind}")
+        for name, value in values:
+            lines.append(f'{metric}{{stage="{name}"}} {value}')
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,303 @@
+# jobqueue.py
+# Durable job queue for extraction batches, backed by SQLite. A job is a list of files;
+# workers claim one file at a time under a lease, and every page's OCR result and LLM
+# result is checkpointed as it finishes, so a crashed or interrupted batch resumes from
+# the last finished page instead of starting over. Files whose worker died (or whose
+# lease ran out) are handed to the next worker that asks.
+#
+# Tables: jobs (one row per submission), files (one row per file, the unit of work)
+# and pages (per-page checkpoints: the OCR page record, then the structured data).
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from workspace import WORK_ROOT, JOB_RETENTION_SECONDS, validate_job_id
+
+QUEUE_DB = os.getenv("INVOICY_QUEUE_DB", os.path.join(WORK_ROOT, "queue.db"))
+# A claimed file is handed to another worker if its lease is not renewed for this long
+LEASE_SECONDS = float(os.getenv("QUEUE_LEASE_SECONDS", "600"))
+# Attempts per file before it is marked failed
+MAX_ATTEMPTS = int(os.getenv("QUEUE_MAX_ATTEMPTS", "3"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    job_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    path TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_until REAL,
+    error TEXT,
+    result TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (job_id, seq)
+);
+CREATE INDEX IF NOT EXISTS files_status ON files (status, job_id, seq);
+CREATE TABLE IF NOT EXISTS pages (
+    job_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    page_number INTEGER NOT NULL,
+    page TEXT,
+    structured_data TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (job_id, seq, page_number)
+);
+"""
+
+# Function to name this worker process; the pid lets a restarted server spot its dead predecessor
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+def _worker_alive(worker):
+    host, _, pid = (worker or "").rpartition(":")
+    if host != socket.gethostname() or not pid.isdigit():
+        return True  # Another machine's worker; only its lease can tell
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+class JobQueue:
+    def __init__(self, path=None):
+        self.path = path or QUEUE_DB
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self.worker = worker_name()
+        self._local = threading.local()
+        self._connection().executescript(SCHEMA)
+
+    # One connection per thread; writers take the database lock up front (BEGIN IMMEDIATE)
+    def _connection(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    @contextmanager
+    def _transaction(self):
+        db = self._connection()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+        except BaseException:
+            db.execute("ROLLBACK")
+            raise
+        db.execute("COMMIT")
+
+    # Function to enqueue files as one job; returns the job ID straight away. Submitting
+    # an existing job ID again re-queues its unfinished files rather than duplicating them.
+    def submit(self, paths, job_id=None):
+        job_id = validate_job_id(job_id) if job_id else uuid.uuid4().hex
+        now = time.time()
+        with self._transaction() as db:
+            if db.execute("SELECT 1 FROM jobs WHERE job_id = ?", (job_id,)).fetchone():
+                self._requeue(db, job_id, now)
+                return job_id
+            db.execute("INSERT INTO jobs (job_id, created, updated) VALUES (?, ?, ?)", (job_id, now, now))
+            db.executemany(
+                "INSERT INTO files (job_id, seq, path, updated) VALUES (?, ?, ?, ?)",
+                [(job_id, seq, os.path.abspath(path), now) for seq, path in enumerate(paths)]
+            )
+        return job_id
+
+    def _requeue(self, db, job_id, now):
+        db.execute(
+            "UPDATE files SET status = 'queued', attempts = 0, error = NULL, worker = NULL, lease_until = NULL, updated = ? "
+            "WHERE job_id = ? AND status IN ('failed', 'running')",
+            (now, job_id)
+        )
+        db.execute("UPDATE jobs SET updated = ? WHERE job_id = ?", (now, job_id))
+
+    # Function to put a job's failed and interrupted files back in the queue
+    def resume(self, job_id):
+        with self._transaction() as db:
+            if not db.execute("SELECT 1 FROM jobs WHERE job_id = ?", (job_id,)).fetchone():
+                raise KeyError(f"Unknown job: {job_id}")
+            self._requeue(db, job_id, time.time())
+        return job_id
+
+    # Function to hand back files whose lease ran out or whose worker process is gone
+    def recover(self):
+        now = time.time()
+        recovered = 0
+        with self._transaction() as db:
+            for row in db.execute("SELECT job_id, seq, worker, lease_until FROM files WHERE status = 'running'").fetchall():
+                if row["lease_until"] < now or (row["worker"] != self.worker and not _worker_alive(row["worker"])):
+                    db.execute(
+                        "UPDATE files SET status = 'queued', worker = NULL, lease_until = NULL, updated = ? WHERE job_id = ? AND seq = ?",
+                        (now, row["job_id"], row["seq"])
+                    )
+                    recovered += 1
+        return recovered
+
+    # Function to claim the next queued file (oldest job first); returns None when there is none
+    def claim(self, job_id=None):
+        now = time.time()
+        with self._transaction() as db:
+            query = "SELECT job_id, seq, path, attempts FROM files WHERE status = 'queued'"
+            params = ()
+            if job_id:
+                query += " AND job_id = ?"
+                params = (job_id,)
+            row = db.execute(query + " ORDER BY rowid LIMIT 1", params).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE files SET status = 'running', attempts = attempts + 1, worker = ?, lease_until = ?, updated = ? "
+                "WHERE job_id = ? AND seq = ?",
+                (self.worker, now + LEASE_SECONDS, now, row["job_id"], row["seq"])
+            )
+            return {"job_id": row["job_id"], "seq": row["seq"], "path": row["path"], "attempts": row["attempts"] + 1}
+
+    # Function to store one page's progress: its OCR record, and its structured data once known.
+    # Also renews the file's lease, since the worker is evidently alive.
+    def checkpoint(self, job_id, seq, page_number, page=None, structured_data=None):
+        now = time.time()
+        with self._transaction() as db:
+            db.execute(
+                "INSERT INTO pages (job_id, seq, page_number, page, structured_data, updated) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (job_id, seq, page_number) DO UPDATE SET "
+                "page = COALESCE(excluded.page, page), "
+                "structured_data = COALESCE(excluded.structured_data, structured_data), "
+                "updated = excluded.updated",
+                (job_id, seq, page_number,
+                 json.dumps(page) if page is not None else None,
+                 json.dumps(structured_data) if structured_data is not None else None,
+                 now)
+            )
+            db.execute(
+                "UPDATE files SET lease_until = ?, updated = ? WHERE job_id = ? AND seq = ? AND worker = ?",
+                (now + LEASE_SECONDS, now, job_id, seq, self.worker)
+            )
+
+    # Function to load a file's checkpoints: {page_number: {"page": ..., "structured_data": ...}}
+    def checkpoints(self, job_id, seq):
+        rows = self._connection().execute(
+            "SELECT page_number, page, structured_data FROM pages WHERE job_id = ? AND seq = ?", (job_id, seq)
+        ).fetchall()
+        return {
+            row["page_number"]: {
+                "page": json.loads(row["page"]) if row["page"] else None,
+                "structured_data": json.loads(row["structured_data"]) if row["structured_data"] else None
+            }
+            for row in rows
+        }
+
+    def complete(self, job_id, seq, outputs):
+        now = time.time()
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE files SET status = 'done', result = ?, error = NULL, lease_until = NULL, updated = ? WHERE job_id = ? AND seq = ?",
+                (json.dumps(outputs), now, job_id, seq)
+            )
+            db.execute("UPDATE jobs SET updated = ? WHERE job_id = ?", (now, job_id))
+
+    # Function to record a failed attempt; the file goes back in the queue until MAX_ATTEMPTS
+    def fail(self, job_id, seq, error):
+        now = time.time()
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE files SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'queued' END, "
+                "error = ?, worker = NULL, lease_until = NULL, updated = ? WHERE job_id = ? AND seq = ?",
+                (MAX_ATTEMPTS, str(error), now, job_id, seq)
+            )
+            db.execute("UPDATE jobs SET updated = ? WHERE job_id = ?", (now, job_id))
+
+    # Function to report a job's progress, optionally with each finished file's outputs
+    def status(self, job_id, include_results=False):
+        db = self._connection()
+        job = db.execute("SELECT job_id, created, updated FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if job is None:
+            raise KeyError(f"Unknown job: {job_id}")
+        pages_done = {
+            row["seq"]: row["pages"] for row in db.execute(
+                "SELECT seq, COUNT(structured_data) AS pages FROM pages WHERE job_id = ? GROUP BY seq", (job_id,))
+        }
+        files = []
+        counts = {"queued": 0, "running": 0, "done": 0, "failed": 0}
+        for row in db.execute(
+                "SELECT seq, path, status, attempts, error" + (", result" if include_results else "") +
+                " FROM files WHERE job_id = ? ORDER BY seq", (job_id,)):
+            counts[row["status"]] += 1
+            entry = {
+                "seq": row["seq"],
+                "file": os.path.basename(row["path"]),
+                "status": row["status"],
+                "attempts": row["attempts"],
+                "pages_done": pages_done.get(row["seq"], 0),
+                "error": row["error"]
+            }
+            if include_results and row["result"]:
+                entry["outputs"] = json.loads(row["result"])
+            files.append(entry)
+
+        if counts["queued"] or counts["running"]:
+            status = "running" if counts["running"] or counts["done"] or counts["failed"] else "queued"
+        else:
+            status = "failed" if counts["failed"] and not counts["done"] else "done"
+        return {"job_id": job_id, "status": status, "created": job["created"], "updated": job["updated"],
+                "counts": counts, "files": files}
+
+    # Function to return every checkpointed page of a job with its structured data, in file then page order
+    def job_pages(self, job_id):
+        rows = self._connection().execute(
+            "SELECT page, structured_data FROM pages WHERE job_id = ? AND page IS NOT NULL "
+            "AND structured_data IS NOT NULL ORDER BY seq, page_number", (job_id,)
+        ).fetchall()
+        return [{**json.loads(row["page"]), "structured_data": json.loads(row["structured_data"])} for row in rows]
+
+    # Function to delete jobs with nothing left to do that have not changed for the retention period
+    def purge(self, retention_seconds=None):
+        retention_seconds = JOB_RETENTION_SECONDS if retention_seconds is None else retention_seconds
+        cutoff = time.time() - retention_seconds
+        with self._transaction() as db:
+            expired = [row["job_id"] for row in db.execute(
+                "SELECT job_id FROM jobs WHERE updated < ? AND NOT EXISTS ("
+                "SELECT 1 FROM files WHERE files.job_id = jobs.job_id AND status IN ('queued', 'running'))", (cutoff,))]
+            for job_id in expired:
+                for table in ("pages", "files", "jobs"):
+                    db.execute(f"DELETE FROM {table} WHERE job_id = ?", (job_id,))
+        return expired
+
+class FileCheckpoint:
+    # Checkpoints of one claimed file, loaded once when its processing (re)starts
+    def __init__(self, job_queue, job_id, seq):
+        self.queue = job_queue
+        self.job_id = job_id
+        self.seq = seq
+        self.saved = job_queue.checkpoints(job_id, seq)
+
+    # Function to return the OCR page records that need not be recomputed
+    def ocr_pages(self):
+        return {number: saved["page"] for number, saved in self.saved.items() if saved["page"] is not None}
+
+    # Function to pass pages through, checkpointing new OCR results and attaching
+    # structured data already known from an earlier attempt as "checkpointed_result"
+    def track(self, pages):
+        for page in pages:
+            saved = self.saved.get(page["page_number"], {})
+            if saved.get("page") is None:
+                self.queue.checkpoint(self.job_id, self.seq, page["page_number"], page=page)
+            if saved.get("structured_data") is not None:
+                page["checkpointed_result"] = saved["structured_data"]
+            yield page
+
+    def structured(self, page, structured_data):
+        self.queue.checkpoint(self.job_id, self.seq, page["page_number"], structured_data=structured_data)
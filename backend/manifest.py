@@ -0,0 +1,186 @@
+# manifest.py
+# Per-document page manifests for incremental re-extraction. Every processed document
+# leaves a manifest with one fingerprint per page (a hash of the page rendered at low
+# resolution) next to that page's OCR record and structured data. When the document is
+# submitted again — one page fixed or re-scanned — pages whose fingerprint is already in
+# the manifest are handed back as they were, and only the changed pages are OCR'd and
+# structured. Pages are matched by content, so inserted or reordered pages are found too.
+#
+# A long PDF split into page ranges (see scheduler.js) shares one manifest: each slice
+# fingerprints and writes only its own pages, merging them into what the other slices saved.
+#
+# Layout: <directory>/<hash of the document path>.json
+import json
+import os
+import threading
+
+from cache import file_digest, make_key
+from workspace import atomic_write_json
+
+# Resolution PDF pages are rendered at to be fingerprinted, and how many are rendered per call
+FINGERPRINT_DPI = 72
+FINGERPRINT_WINDOW = 16
+
+# Saves of one manifest take turns, so slices finishing together don't drop each other's pages
+_save_locks = {}
+_save_locks_guard = threading.Lock()
+
+def save_lock(path):
+    with _save_locks_guard:
+        return _save_locks.setdefault(path, threading.Lock())
+
+def pdf_page_count(pdf_path):
+    from pdf2image import pdfinfo_from_path
+    return int(pdfinfo_from_path(pdf_path)["Pages"])
+
+# Function to fingerprint pages first_page..last_page of a PDF; returns {page number: fingerprint}
+def pdf_fingerprints(pdf_path, first_page, last_page):
+    from pdf2image import convert_from_path
+    fingerprints = {}
+    for window_start in range(first_page, last_page + 1, FINGERPRINT_WINDOW):
+        window_end = min(window_start + FINGERPRINT_WINDOW - 1, last_page)
+        images = convert_from_path(pdf_path, dpi=FINGERPRINT_DPI, first_page=window_start, last_page=window_end, grayscale=True)
+        for offset, image in enumerate(images):
+            fingerprints[window_start + offset] = make_key("page", list(image.size), image.tobytes())
+    return fingerprints
+
+# Function to fingerprint the pages of any supported file, all of them or the range `pages` =
+# (first, last); returns (page count of the whole file, {page number: fingerprint}). An image is one page.
+def page_fingerprints(file_path, pages=None):
+    if not file_path.lower().endswith('.pdf'):
+        return 1, {1: file_digest(file_path)}
+    page_count = pdf_page_count(file_path)
+    first_page, last_page = pages or (1, page_count)
+    return page_count, pdf_fingerprints(file_path, first_page, min(last_page, page_count))
+
+def manifest_path(directory, source_path):
+    return os.path.join(directory, make_key("manifest", os.path.abspath(source_path))[:32] + ".json")
+
+def read_manifest(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+# Function to tell whether a saved manifest has an entry for every page of the file with
+# digest `digest`. Slices write their pages separately, so each entry carries the digest
+# of the file it was written for.
+def is_complete(saved, digest, settings):
+    pages = saved.get("pages", [])
+    return (bool(pages) and saved.get("settings") == settings and saved.get("page_count") == len(pages)
+            and all(entry.get("file_digest", saved.get("file_digest")) == digest for entry in pages))
+
+# Function to tell whether nothing of a file would be redone: its manifest covers every page
+# of these bytes, each one structured and with its OCR data still on disk
+def fully_reusable(directory, source_path, settings, digest):
+    saved = read_manifest(manifest_path(directory, source_path))
+    return is_complete(saved, digest, settings) and all(
+        entry.get("structured_data") is not None and os.path.exists(entry["page"].get("ocr_data_path") or "")
+        for entry in saved["pages"]
+    )
+
+class PageManifest:
+    # `settings` identifies everything else the results depend on (OCR, prompt, model,
+    # schema); a manifest written under other settings is not reused. `pages` = (first, last)
+    # limits this run to that range of a split PDF.
+    def __init__(self, directory, source_path, settings, pages=None):
+        self.source_path = os.path.abspath(source_path)
+        self.path = manifest_path(directory, source_path)
+        self.settings = settings
+        self.pages = pages
+        self.previous = {}      # fingerprint -> {"page": ..., "structured_data": ...} from the last run
+        self.fingerprints = {}  # page number -> fingerprint of the document (or range) as it is now
+        self.entries = {}       # page number -> entry written by this run
+        self.reused = []
+        self.saved = None       # the manifest as last written by save()
+        saved = read_manifest(self.path)
+        if saved.get("settings") == settings:
+            self.previous = {entry["fingerprint"]: entry for entry in saved.get("pages", [])}
+        self.file_digest = file_digest(source_path)
+        # An unchanged file needs no rendering to know its pages are unchanged
+        if self.previous and is_complete(saved, self.file_digest, settings):
+            self.page_count = saved["page_count"]
+            first_page, last_page = pages or (1, self.page_count)
+            self.fingerprints = {entry["page_number"]: entry["fingerprint"] for entry in saved["pages"]
+                                 if first_page <= entry["page_number"] <= last_page}
+        else:
+            self.page_count, self.fingerprints = page_fingerprints(source_path, pages)
+
+    # Function to return the page records of unchanged pages, keyed by page number, with their
+    # structured data attached as "checkpointed_result". Their OCR data files are copied into
+    # `annotated_folder` (renumbered if the page moved), so the pages can still be annotated.
+    def reusable(self, annotated_folder):
+        pages = {}
+        for page_number, fingerprint in self.fingerprints.items():
+            entry = self.previous.get(fingerprint)
+            if entry is None:
+                continue
+            page = dict(entry["page"])
+            try:
+                with open(page["ocr_data_path"], 'r', encoding='utf-8') as f:
+                    ocr_data = json.load(f)
+            except (OSError, ValueError):
+                continue  # The earlier job's files are gone; treat the page as changed
+            ocr_data.update({"source_path": self.source_path, "page_number": page_number})
+            # Named as extraction names them, so a page that moved can't clash with a page OCR'd now
+            stem = os.path.splitext(os.path.basename(self.source_path))[0]
+            if self.source_path.lower().endswith('.pdf'):
+                stem = f"{stem}_page_{page_number}"
+                page["file_name"] = f"page_{page_number}"
+            page["ocr_data_path"] = os.path.join(annotated_folder, stem + "_ocr.json")
+            atomic_write_json(page["ocr_data_path"], ocr_data)
+            page.update({"page_number": page_number, "source": os.path.basename(self.source_path), "annotated_image_path": ""})
+            if entry.get("structured_data") is not None:
+                page["checkpointed_result"] = entry["structured_data"]
+            pages[page_number] = page
+            self.reused.append(page_number)
+        return pages
+
+    # Function to pass pages through, recording each one's OCR record under its fingerprint
+    def track(self, pages):
+        for page in pages:
+            fingerprint = self.fingerprints.get(page["page_number"])
+            if fingerprint is not None:
+                record = {k: v for k, v in page.items() if k not in ("checkpointed_result", "stages")}
+                self.entries[page["page_number"]] = {
+                    "page_number": page["page_number"],
+                    "fingerprint": fingerprint,
+                    "file_digest": self.file_digest,
+                    "page": record,
+                    "structured_data": page.get("checkpointed_result")
+                }
+            yield page
+
+    def structured(self, page, structured_data):
+        entry = self.entries.get(page["page_number"])
+        if entry is not None:
+            entry["structured_data"] = structured_data
+
+    # Function to write the manifest for the document as it is now. A slice writes only its own
+    # pages and keeps the other slices' from the manifest on disk. Returns True when this save
+    # completed the manifest of a split document, i.e. the last of its slices has finished.
+    def save(self):
+        with save_lock(self.path):
+            entries = {}
+            completed_before = True
+            if self.pages:
+                saved = read_manifest(self.path)
+                completed_before = is_complete(saved, self.file_digest, self.settings)
+                if saved.get("settings") == self.settings:
+                    first_page, last_page = self.pages
+                    entries = {entry["page_number"]: entry for entry in saved.get("pages", [])
+                               if not first_page <= entry["page_number"] <= last_page and entry["page_number"] <= self.page_count}
+            entries.update(self.entries)
+            self.saved = {
+                "source_path": self.source_path,
+                "file_digest": self.file_digest,
+                "settings": self.settings,
+                "page_count": self.page_count,
+                "pages": [entries[number] for number in sorted(entries)]
+            }
+            atomic_write_json(self.path, self.saved)
+        return not completed_before and is_complete(self.saved, self.file_digest, self.settings)
+
+    def changed(self):
+        return sorted(set(self.fingerprints) - set(self.reused))
@@ -0,0 +1,177 @@
+# merging.py
+# Merges page-level extractions into invoices. Pages are grouped by normalized invoice
+# number and seller GSTIN; a page that names neither continues the invoice before it
+# in the same file (carry-over pages). Within an invoice, pages keep their order and
+# line items repeated from an earlier page are dropped; the totals are then checked
+# against the items and taxes for the whole batch at once (see amounts.py). Every step
+# is a dict/set lookup, so a batch of thousands of pages merges in linear time.
+import json
+import re
+
+from amounts import parse_amount
+
+# Header fields whose last value wins: totals are printed at the end of the invoice,
+# earlier pages only carry running subtotals
+LAST_VALUE_FIELDS = {
+    "invoiceTotalAmount", "totalAmountPreTax", "preTaxTotal", "totalTax", "roundOff",
+    "discount", "cgst", "sgst", "igst", "ugst", "tcs"
+}
+
+# Function to read the structured invoice out of a process_text result
+def parse_structured(structured_data):
+    if not isinstance(structured_data, dict):
+        return None
+    if "response_content" not in structured_data:
+        return structured_data
+    try:
+        invoice = json.loads(structured_data["response_content"])
+    except (TypeError, ValueError):
+        return None  # Failed extractions carry an error message instead of JSON
+    return invoice if isinstance(invoice, dict) else None
+
+def normalize_invoice_number(value):
+    return re.sub(r"[^A-Z0-9]", "", str(value or "").upper())
+
+def normalize_gstin(value):
+    return re.sub(r"\s", "", str(value or "").upper())
+
+# Function to read an amount that the LLM may have returned as "1,234.50", "₹ 1,23,456.5" or "1.234,50"
+def to_number(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        return parse_amount(value)
+    return None
+
+def item_key(item):
+    return (
+        re.sub(r"\W+", " ", str(item.get("description", ""))).strip().lower(),
+        to_number(item.get("quantity")),
+        to_number(item.get("pricePerUnit")),
+        to_number(item.get("amount"))
+    )
+
+class InvoiceGroup:
+    def __init__(self, key, number, gstin):
+        self.key = key
+        self.number = number
+        self.gstin = gstin
+        self.header = {}
+        self.items = []
+        self.hsn_codes = []
+        self.texts = []
+        self.pages = []
+        self.confidence = 0.0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.duplicate_items = 0
+        self._seen_items = set()
+        self._seen_hsn = set()
+
+    def add(self, result, invoice):
+        for field, value in invoice.items():
+            if field in ("items", "hsnOrSacCodesWithItemNames") or value in (None, "", [], {}):
+                continue
+            if field in LAST_VALUE_FIELDS or field not in self.header:
+                self.header[field] = value
+
+        # Items already listed on an earlier page are carry-overs; repeats within one page are real lines
+        page_keys = set()
+        for item in invoice.get("items") or []:
+            if not isinstance(item, dict):
+                continue
+            key = item_key(item)
+            if key in self._seen_items:
+                self.duplicate_items += 1
+                continue
+            page_keys.add(key)
+            self.items.append(item)
+        self._seen_items |= page_keys
+
+        for entry in invoice.get("hsnOrSacCodesWithItemNames") or []:
+            if not isinstance(entry, dict):
+                continue
+            key = (str(entry.get("itemName", "")).strip().lower(), str(entry.get("hsnOrSacCode", "")).strip())
+            if key not in self._seen_hsn:
+                self._seen_hsn.add(key)
+                self.hsn_codes.append(entry)
+
+        self.texts.append(result.get("extracted_text", ""))
+        self.pages.append({"source": result.get("source"), "page_number": result.get("page_number"),
+                           "file_name": result.get("file_name")})
+        self.confidence += result.get("avg_confidence", 0.0)
+        token_usage = (result.get("structured_data") or {}).get("token_usage", {})
+        self.prompt_tokens += token_usage.get("prompt_tokens", 0)
+        self.completion_tokens += token_usage.get("completion_tokens", 0)
+
+    def to_dict(self):
+        structured_data = dict(self.header)
+        structured_data["items"] = self.items
+        if self.hsn_codes:
+            structured_data["hsnOrSacCodesWithItemNames"] = self.hsn_codes
+        return {
+            "extracted_text": "\n".join(self.texts),
+            "structured_data": structured_data,
+            "avg_confidence": self.confidence / len(self.pages) if self.pages else 0.0,
+            "page_count": len(self.pages),
+            "pages": self.pages,
+            "token_usage": {"prompt_tokens": self.prompt_tokens, "completion_tokens": self.completion_tokens},
+            # Completed with the totals checks by amounts.normalize_invoices
+            "reconciliation": {"duplicate_items_dropped": self.duplicate_items}
+        }
+
+# Function to merge page results ({..page fields, "structured_data": process_text result})
+# into {invoice key: merged invoice}, in order of first appearance
+def merge_pages(extraction_results):
+    groups = {}        # (number, gstin) -> InvoiceGroup
+    by_number = {}     # number -> groups with that number, for pages that omit the GSTIN
+    last_group = {}    # source file -> group of its previous page, for carry-over pages
+    merged = []
+    keys = set()
+    unreadable = 0
+
+    for result in extraction_results:
+        invoice = parse_structured(result.get("structured_data"))
+        if invoice is None:
+            unreadable += 1
+            continue
+        source = result.get("source")
+        number = normalize_invoice_number(invoice.get("invoiceNumber"))
+        gstin = normalize_gstin(invoice.get("gst"))
+
+        group = None
+        if number:
+            group = groups.get((number, gstin))
+            if group is None:
+                candidates = by_number.get(number, [])
+                # A page missing the GSTIN (or the first page that had none) joins the only invoice with its number
+                matching = [g for g in candidates if not gstin or not g.gstin]
+                if len(matching) == 1:
+                    group = matching[0]
+                    if gstin and not group.gstin:
+                        del groups[(number, "")]
+                        group.gstin = gstin
+                        groups[(number, gstin)] = group
+        elif source in last_group:
+            group = last_group[source]
+
+        if group is None:
+            key = str(invoice.get("invoiceNumber") or f"{source} page {result.get('page_number')}")
+            # Two sellers can use the same invoice number
+            if key in keys:
+                key = f"{key} ({gstin or source})"
+            while key in keys:
+                key += "'"
+            keys.add(key)
+            group = InvoiceGroup(key, number, gstin)
+            merged.append(group)
+            if number:
+                groups[(number, gstin)] = group
+                by_number.setdefault(number, []).append(group)
+
+        group.add(result, invoice)
+        last_group[source] = group
+
+    return {group.key: group.to_dict() for group in merged}, unreadable
@@ -0,0 +1,263 @@
+# preprocess.py
+# Page preprocessing ahead of OCR. A small grayscale copy of each page is analysed once
+# for its ink bounding box, skew angle, orientation and text height; the full page is
+# then cropped to its content, deskewed and scaled to the target text height in a single
+# affine resample. OCR boxes are mapped back through the same matrix, so stored OCR data
+# and annotations keep referring to the original image. PDF pages are rasterized at a
+# DPI picked from a low-resolution probe instead of pdf2image's fixed default.
+import math
+import os
+
+import numpy as np
+from PIL import Image
+
+# PREPROCESS=0 sends pages to OCR exactly as decoded/rendered
+PREPROCESS = os.getenv("PREPROCESS", "1") != "0"
+CROP_MARGINS = os.getenv("PREPROCESS_CROP", "1") != "0"
+DESKEW = os.getenv("PREPROCESS_DESKEW", "1") != "0"
+# Height in pixels of a line of text (ink, ascender to descender) the page is scaled to.
+# Pages are only ever scaled down; text already at or below this is left alone
+TARGET_TEXT_HEIGHT = int(os.getenv("TARGET_TEXT_HEIGHT", "24"))
+# Pages whose text height can't be measured are capped at this many pixels on the long side
+MAX_IMAGE_SIDE = int(os.getenv("MAX_IMAGE_SIDE", "3500"))
+# Fixed PDF rasterization DPI; 0 picks it per page from a probe render
+PDF_DPI = int(os.getenv("PDF_DPI", "0"))
+PDF_DEFAULT_DPI = 200  # pdf2image's default, used when the probe finds no text
+PDF_MIN_DPI = 100
+PDF_MAX_DPI = 300
+PROBE_DPI = 72
+# Long side of the grayscale copy the page is analysed on, and the block size (in its
+# pixels) the local paper level is averaged over
+ANALYSIS_SIDE = 1000
+BACKGROUND_BLOCK = 24
+MAX_SKEW_DEGREES = 5.0
+# Skew below this is not worth a resample
+MIN_SKEW_DEGREES = 0.2
+# Text lines must profile this much sharper across rows than across columns for the
+# page to count as upright (and per-box angle classification to be skipped)
+UPRIGHT_RATIO = 2.0
+# A sharper profile across columns alone doesn't make a page sideways: column-aligned tables
+# profile sharply there too. The sideways profile must also look like lines of text — at least
+# this many, with heights and gaps this even (see line_irregularity) — and be more even than
+# the upright profile.
+MIN_TEXT_LINES = 3
+MAX_LINE_IRREGULARITY = 2.0
+# A crop has to remove at least this share of the page to be applied
+CROP_MIN_SAVING = 0.05
+# Scale factors this close to 1 are not worth a resample
+MIN_SCALE_CHANGE = 0.9
+# Ink pixels sampled for the skew search
+SKEW_SAMPLE_POINTS = 20000
+
+# Function to return the settings that change what OCR sees, for the OCR cache key
+def settings():
+    if not PREPROCESS:
+        return {"preprocess": False}
+    return {
+        "preprocess": True,
+        "crop": CROP_MARGINS,
+        "deskew": DESKEW,
+        "target_text_height": TARGET_TEXT_HEIGHT,
+        "max_side": MAX_IMAGE_SIDE
+    }
+
+# Function to build the downsampled grayscale copy analysed in place of the page; returns it and its scale
+def analysis_image(image):
+    gray = image.convert("L")
+    factor = max(1, int(max(gray.size) / ANALYSIS_SIDE))
+    if factor > 1:
+        gray = gray.reduce(factor)
+    return np.asarray(gray), 1.0 / factor
+
+# Function to mark the pixels darker than the paper around them. The paper level is taken
+# locally (block means), so a desk or shadow around a photographed page is not read as ink.
+def ink_mask(gray):
+    height, width = gray.shape
+    blocks = Image.fromarray(gray).reduce(BACKGROUND_BLOCK)
+    background = np.asarray(blocks.resize((width, height), Image.BILINEAR), dtype=np.float32)
+    return gray < np.minimum(background - 64, background * 0.75)
+
+# Function to histogram ink points by their distance across direction `angle` (degrees);
+# along the direction text lines run, the histogram alternates between lines and gaps
+def profile(xs, ys, angle):
+    theta = math.radians(angle)
+    distance = ys * math.cos(theta) - xs * math.sin(theta)
+    return np.bincount((distance - distance.min()).astype(np.int64))
+
+# Function to score a profile by the energy of its steps, which is highest when the
+# text lines fall into whole bins (independent of how far the ink extends)
+def sharpness(counts):
+    steps = np.diff(counts.astype(np.float64))
+    return float(np.dot(steps, steps))
+
+# Function to find the angle around `centre` (degrees) the text lines run along; returns (angle, sharpness)
+def best_angle(xs, ys, centre):
+    best = (centre, sharpness(profile(xs, ys, centre)))
+    step = 0.5
+    angles = np.arange(centre - MAX_SKEW_DEGREES, centre + MAX_SKEW_DEGREES + step / 2, step)
+    while step >= 0.1:
+        for angle in angles:
+            score = sharpness(profile(xs, ys, angle))
+            if score > best[1]:
+                best = (float(angle), score)
+        # Refine around the best coarse angle
+        angles = np.arange(best[0] - step, best[0] + step, step / 5)
+        step /= 5
+    return best
+
+# Function to split a row profile into its runs of ink (text lines) and the gaps between them;
+# returns (run heights, gap heights) in profile bins
+def line_runs(counts):
+    threshold = max(1.0, 0.05 * float(np.percentile(counts[counts > 0], 95)))
+    rows = np.concatenate(([False], counts >= threshold, [False]))
+    edges = np.flatnonzero(np.diff(rows.astype(np.int8)))
+    starts, ends = edges[::2], edges[1::2]
+    # Shorter runs are table rules and specks
+    keep = ends - starts >= 3
+    starts, ends = starts[keep], ends[keep]
+    return ends - starts, starts[1:] - ends[:-1]
+
+# Function to measure the typical height of a text line (in profile bins) from a row profile
+def line_height(counts):
+    if not counts.size or counts.max() == 0:
+        return None
+    runs, _ = line_runs(counts)
+    return float(np.median(runs)) if runs.size else None
+
+# Function to measure how evenly a profile's runs and gaps repeat: the interquartile ratio of
+# the run heights times that of the gaps, 1.0 for perfectly even lines. Infinite when the
+# profile has too few runs to be lines of text.
+def line_irregularity(counts):
+    if not counts.size or counts.max() == 0:
+        return math.inf
+    runs, gaps = line_runs(counts)
+    if runs.size < MIN_TEXT_LINES:
+        return math.inf
+
+    def spread(values):
+        low, high = np.percentile(values, [25, 75])
+        return float(high / max(low, 1.0))
+    return spread(runs) * spread(gaps)
+
+# Function to check the sideways angle independently of profile sharpness: its profile must
+# look like lines of text, and more so than the upright one
+def sideways_lines(xs, ys, angle, sideways_angle):
+    sideways = line_irregularity(profile(xs, ys, sideways_angle))
+    return sideways <= MAX_LINE_IRREGULARITY and sideways < line_irregularity(profile(xs, ys, angle))
+
+# Function to analyse a page: content box, skew and orientation, and text height, all in page pixels
+def analyze(image):
+    gray, scale = analysis_image(image)
+    mask = ink_mask(gray)
+    height, width = mask.shape
+    info = {"ink_box": None, "skew": 0.0, "upright": False, "text_height": None}
+
+    row_counts, col_counts = mask.sum(axis=1), mask.sum(axis=0)
+    rows, cols = np.flatnonzero(row_counts >= 2), np.flatnonzero(col_counts >= 2)
+    if not rows.size or not cols.size:
+        return info  # Blank page
+    info["ink_box"] = (cols[0] / scale, rows[0] / scale, (cols[-1] + 1) / scale, (rows[-1] + 1) / scale)
+
+    ys, xs = np.nonzero(mask)
+    stride = max(1, len(xs) // SKEW_SAMPLE_POINTS)
+    xs, ys = xs[::stride].astype(np.float64), ys[::stride].astype(np.float64)
+    angle, score = best_angle(xs, ys, 0.0)
+    # Text running down the page means it was scanned or photographed sideways; a slightly
+    # skewed borderless table also profiles sharply there, from its aligned columns
+    sideways_angle, sideways_score = best_angle(xs, ys, 90.0)
+    if sideways_score > score * UPRIGHT_RATIO and sideways_lines(xs, ys, angle, sideways_angle):
+        angle, score = sideways_angle, sideways_score
+    else:
+        info["upright"] = score >= sideways_score * UPRIGHT_RATIO
+    info["skew"] = angle
+
+    text_height = line_height(profile(xs, ys, angle))
+    if text_height:
+        # Profile bins are analysis pixels
+        info["text_height"] = text_height / scale
+    return info
+
+# Function to decide the crop box, rotation and scale for a page; returns None when it can go to OCR as is
+def plan(image, info):
+    width, height = image.size
+    box = (0.0, 0.0, float(width), float(height))
+    if CROP_MARGINS and info["ink_box"]:
+        pad = max(info["text_height"] or 0.0, 0.01 * max(width, height))
+        left, top, right, bottom = info["ink_box"]
+        cropped = (max(0.0, left - pad), max(0.0, top - pad), min(float(width), right + pad), min(float(height), bottom + pad))
+        if (cropped[2] - cropped[0]) * (cropped[3] - cropped[1]) <= (1 - CROP_MIN_SAVING) * width * height:
+            box = cropped
+
+    angle = info["skew"] if DESKEW else 0.0
+    if abs(angle) < MIN_SKEW_DEGREES:
+        angle = 0.0
+
+    theta = math.radians(angle)
+    box_width, box_height = box[2] - box[0], box[3] - box[1]
+    out_width = abs(box_width * math.cos(theta)) + abs(box_height * math.sin(theta))
+    out_height = abs(box_width * math.sin(theta)) + abs(box_height * math.cos(theta))
+
+    if info["text_height"]:
+        scale = min(1.0, TARGET_TEXT_HEIGHT / info["text_height"])
+    else:
+        scale = min(1.0, MAX_IMAGE_SIDE / max(out_width, out_height))
+    if scale > MIN_SCALE_CHANGE:
+        scale = 1.0
+
+    if box == (0.0, 0.0, float(width), float(height)) and angle == 0.0 and scale == 1.0:
+        return None
+    return {"box": box, "angle": angle, "scale": scale,
+            "size": (max(1, int(round(out_width * scale))), max(1, int(round(out_height * scale))))}
+
+# Function to build the affine matrix mapping a point of the prepared image back to the page:
+# the prepared image is the crop box rotated by `angle` about its centre, then scaled
+def page_matrix(steps):
+    left, top, right, bottom = steps["box"]
+    theta = math.radians(steps["angle"])
+    scale = steps["scale"]
+    a, b = math.cos(theta) / scale, -math.sin(theta) / scale
+    d, e = math.sin(theta) / scale, math.cos(theta) / scale
+    half_width, half_height = steps["size"][0] / 2, steps["size"][1] / 2
+    return (a, b, (left + right) / 2 - a * half_width - b * half_height,
+            d, e, (top + bottom) / 2 - d * half_width - e * half_height)
+
+# Function to crop, deskew and scale a page for OCR. Returns (image, matrix, info); matrix is
+# None when the page is passed through untouched, else it maps prepared pixels to page pixels.
+def prepare(image):
+    info = analyze(image)
+    steps = plan(image, info)
+    info["scale"] = steps["scale"] if steps else 1.0
+    info["cropped"] = bool(steps) and steps["box"] != (0.0, 0.0, float(image.size[0]), float(image.size[1]))
+    if steps is None:
+        return image, None, info
+    matrix = page_matrix(steps)
+
+    # A box filter first, so big reductions don't alias in the bilinear resample
+    source, factor = image, int(1 / steps["scale"])
+    if factor > 1:
+        source = image.reduce(factor)
+    prepared = source.transform(steps["size"], Image.AFFINE, [value / factor for value in matrix],
+                                resample=Image.BILINEAR, fillcolor="white")
+    return prepared, matrix, info
+
+# Function to map OCR boxes found on a prepared image back onto the page
+def map_boxes(boxes, matrix):
+    if matrix is None:
+        return boxes
+    a, b, c, d, e, f = matrix
+    return [[[a * x + b * y + c, d * x + e * y + f] for x, y in box] for box in boxes]
+
+# Function to pick the DPI to rasterize a PDF page at, so its text comes out near the target height
+def pdf_dpi(pdf_path, page_number):
+    if PDF_DPI:
+        return PDF_DPI
+    if not PREPROCESS:
+        return PDF_DEFAULT_DPI
+    from pdf2image import convert_from_path
+    probe = convert_from_path(pdf_path, dpi=PROBE_DPI, first_page=page_number, last_page=page_number, grayscale=True)[0]
+    text_height = analyze(probe)["text_height"]
+    if not text_height:
+        return PDF_DEFAULT_DPI
+    # Text height scales linearly with DPI; round so nearby pages share cache-friendly values
+    dpi = int(round(TARGET_TEXT_HEIGHT * PROBE_DPI / text_height / 10) * 10)
+    return max(PDF_MIN_DPI, min(PDF_MAX_DPI, dpi))
@@ -0,0 +1,179 @@
+# prompting.py
+# Compact prompt encoding for the structuring stage. The schema is sent as a terse
+# field list (or minified JSON) instead of the pretty-printed 5 KB schema, and the OCR
+# boxes are regrouped into layout-ordered lines with low-confidence noise dropped.
+# The reply format is enforced with the API's JSON mode rather than by instructions.
+import json
+import math
+import os
+import re
+
+from structuring import estimate_tokens
+
+# "fields" (terse field list), "minified" (compact JSON schema) or "full" (pretty-printed, as before)
+PROMPT_SCHEMA_MODE = os.getenv("PROMPT_SCHEMA_MODE", "fields")
+# OCR boxes recognised with less confidence than this are left out of the prompt
+OCR_MIN_CONFIDENCE = float(os.getenv("OCR_MIN_CONFIDENCE", "0.5"))
+# Longest OCR excerpt sent with a re-ask for fields that failed validation
+REASK_SNIPPET_CHARS = int(os.getenv("REASK_SNIPPET_CHARS", "1500"))
+# Words in field names too common to locate a field in the OCR text
+GENERIC_WORDS = {"the", "and", "total", "amount", "name", "number", "code", "with", "level"}
+# Passed as response_format so the model always answers with a JSON object
+RESPONSE_FORMAT = {"type": "json_object"}
+
+INSTRUCTIONS = (
+    "Extract the invoice details from the OCR text below (PaddleOCR, one line per layout row).\n"
+    "Reply with a single JSON object using these fields; omit fields that are not present.\n"
+)
+
+# The instructions the pipeline used to send, kept to measure what the compact prompt saves
+LEGACY_INSTRUCTIONS = "\n".join([
+    "You are an Invoice Extraction Specialist. Your task is to extract key details from the OCR text provided. We are using the PaddleOCR engine to perform extraction of text from image.",
+    "Handle potential ambiguities in the invoice format, such as multiple pages belonging to the same invoice, by ensuring that invoice details are correctly aggregated.",
+    "The OCR data has been extracted using the PaddleOCR engine. Match all particulars from the extracted OCR data with the provided JSON schema and return structured data.",
+    "The JSON schema specifies the particulars and data types for accurate comprehension of the extracted OCR data.",
+    "Respond only with the structured data in JSON format as per the schema. Do not include any explanations."
+]) + "\n\nUse the provided JSON Schema as a reference for the expected structure of the extracted information. The schema is as follows:\n"
+
+# Rendered schema text per schema object; the schema is loaded once, so this is built once
+_schema_text = {}
+
+# Function to describe the type of one schema property tersely, e.g. "number" or "[{a:string,...}]"
+def _field_type(prop):
+    kind = prop.get("type", "string")
+    if kind == "array":
+        items = prop.get("items", {})
+        if items.get("type") == "object":
+            inner = ",".join(f"{name}:{_field_type(sub)}" for name, sub in items.get("properties", {}).items())
+            return "[{" + inner + "}]"
+        return f"[{_field_type(items)}]"
+    if kind == "object":
+        inner = ",".join(f"{name}:{_field_type(sub)}" for name, sub in prop.get("properties", {}).items())
+        return "{" + inner + "}"
+    if prop.get("pattern") == r"^\d{2}/\d{2}/\d{4}$":
+        return "string dd/mm/yyyy"
+    if prop.get("format") == "date":
+        return "string yyyy-mm-dd"
+    return kind
+
+def field_line(name, prop):
+    description = prop.get("description", "").rstrip(".")
+    return f"{name}:{_field_type(prop)}" + (f" - {description}" if description else "")
+
+# Function to render a schema as one "name:type - description" line per top-level field
+def schema_field_list(schema):
+    return "\n".join(field_line(name, prop) for name, prop in schema.get("properties", {}).items())
+
+# Function to render the schema the way PROMPT_SCHEMA_MODE asks for
+def schema_text(schema, mode=None):
+    mode = mode or PROMPT_SCHEMA_MODE
+    key = (id(schema), mode)
+    cached = _schema_text.get(key)
+    if cached is not None and cached[0] is schema:
+        return cached[1]
+    if mode == "full":
+        text = json.dumps(schema, indent=2)
+    elif mode == "minified":
+        text = json.dumps(schema, separators=(",", ":"))
+    else:
+        text = schema_field_list(schema)
+    _schema_text[key] = (schema, text)
+    return text
+
+# Function to estimate how far a page's text is rotated (radians) from the top edges of its boxes
+def page_angle(boxes):
+    angles = sorted(math.atan2(box[1][1] - box[0][1], box[1][0] - box[0][0]) for box in boxes)
+    return angles[len(angles) // 2] if angles else 0.0
+
+# Function to order OCR boxes into text lines: top-to-bottom, left-to-right, with boxes whose
+# vertical centres fall within half a line height of each other merged into one line.
+# Boxes below `min_confidence` are dropped. Boxes are given in page coordinates, so on a
+# skewed or sideways page they are first turned back by the page's text angle.
+def layout_text(boxes, texts, scores, min_confidence=None):
+    min_confidence = OCR_MIN_CONFIDENCE if min_confidence is None else min_confidence
+    angle = page_angle(boxes)
+    if abs(angle) > math.radians(0.5):
+        cos, sin = math.cos(angle), math.sin(angle)
+        boxes = [[(x * cos + y * sin, y * cos - x * sin) for x, y in box] for box in boxes]
+    words = []
+    for box, text, score in zip(boxes, texts, scores):
+        if score < min_confidence or not text.strip():
+            continue
+        ys = [y for _, y in box]
+        top, bottom = min(ys), max(ys)
+        words.append((top, bottom, min(x for x, _ in box), text.strip()))
+    if not words:
+        return ""
+    words.sort()
+
+    lines = []
+    line, line_centre, line_height = [], None, None
+    for top, bottom, left, text in words:
+        centre = (top + bottom) / 2
+        height = max(bottom - top, 1.0)
+        if line and abs(centre - line_centre) <= max(line_height, height) / 2:
+            line.append((left, text))
+            continue
+        if line:
+            lines.append(line)
+        line, line_centre, line_height = [(left, text)], centre, height
+    lines.append(line)
+
+    return "\n".join(" ".join(text for _, text in sorted(line)) for line in lines)
+
+# Function to build the compact extraction prompt for one page of OCR text
+def compact_prompt(text, schema):
+    return INSTRUCTIONS + schema_text(schema) + "\n\nOCR text:\n" + text
+
+# Function to pick the OCR lines that mention a field (by the words of its name or the value
+# extracted for it), plus the line below, where values printed under their label end up
+def relevant_snippet(text, fields, data, max_chars=None):
+    max_chars = max_chars or REASK_SNIPPET_CHARS
+    lines = text.split("\n")
+    needles = set()
+    wants_items = False
+    for name in fields:
+        if name == "items":
+            wants_items = True
+        needles.update(word.lower() for word in re.findall(r"[a-z]+|[A-Z][a-z]*", name) if len(word) > 2)
+        value = data.get(name)
+        if isinstance(value, (str, int, float)) and not isinstance(value, bool) and len(str(value)) > 2:
+            needles.add(str(value).lower())
+    needles -= GENERIC_WORDS
+
+    picked = set()
+    for i, line in enumerate(lines):
+        lowered = line.lower()
+        # Item rows are the lines carrying several numbers
+        if any(needle in lowered for needle in needles) or (wants_items and len(re.findall(r"\d[\d,]*\.?\d*", line)) >= 2):
+            picked.update((i, i + 1))
+    snippet = "\n".join(lines[i] for i in sorted(picked) if i < len(lines))
+    return (snippet or text)[:max_chars]
+
+# Function to build the follow-up prompt asking only for the fields that failed validation
+def reask_prompt(text, data, errors, schema):
+    properties = schema.get("properties", {})
+    lines = []
+    for name, error in errors.items():
+        if name not in properties:
+            continue
+        value = data.get(name)
+        # Scalars are echoed so the model sees what was wrong; lists would cost too much
+        got = "" if value is None or isinstance(value, (list, dict)) else f"got {json.dumps(value)[:80]}: "
+        lines.append(f"{field_line(name, properties[name])} ({got}{error})")
+    return (
+        "These invoice fields have invalid values. Re-read the OCR excerpt and reply with a JSON object "
+        "containing only these fields, using null for fields that are not in the text:\n"
+        + "\n".join(lines) + "\n\nOCR excerpt:\n" + relevant_snippet(text, list(errors), data)
+    )
+
+# Function to estimate prompt tokens for the compact prompt and the prompt it replaces
+def prompt_savings(prompt_content, text, schema):
+    legacy = LEGACY_INSTRUCTIONS + schema_text(schema, "full") + "\n\nExtracted Text:\n" + " ".join(text.split("\n"))
+    compact_tokens = estimate_tokens(prompt_content)
+    legacy_tokens = estimate_tokens(legacy)
+    return {
+        "prompt_tokens_estimate": compact_tokens,
+        "legacy_prompt_tokens_estimate": legacy_tokens,
+        "tokens_saved": legacy_tokens - compact_tokens
+    }
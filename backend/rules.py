@@ -0,0 +1,202 @@
+# rules.py
+# Deterministic pre-extraction of strictly formatted invoice fields (GSTIN, PAN, IFSC,
+# IRN, invoice number and date) from the layout-ordered OCR lines, run before the LLM.
+# A field is only filled when the rules are confident (checksums, labels, a single
+# candidate); everything else is left for the LLM, which is then asked only for the
+# fields that are still missing. Per-field hit rates are kept for the metrics op.
+import re
+import threading
+import time
+from datetime import datetime
+
+GSTIN_RE = re.compile(r"\b\d{2}[A-Z]{5}\d{4}[A-Z][1-9A-Z]Z[0-9A-Z]\b")
+PAN_RE = re.compile(r"\b[A-Z]{5}\d{4}[A-Z]\b")
+IFSC_RE = re.compile(r"\b[A-Z]{4}0[A-Z0-9]{6}\b")
+IRN_RE = re.compile(r"\b[0-9a-f]{64}\b")
+DATE_RE = re.compile(r"\b(\d{1,2})[/.\-](\d{1,2})[/.\-](\d{4})\b|\b(\d{1,2})[\s\-]([A-Za-z]{3,9})[\s\-,]+(\d{4})\b")
+INVOICE_NUMBER_LABEL_RE = re.compile(r"\b(?:invoice|inv|bill)\s*(?:(?:no|number|num)\b|#)\.?\s*[:#\-]?\s*", re.I)
+INVOICE_NUMBER_VALUE_RE = re.compile(r"^[A-Z0-9][A-Z0-9/\-_.]{1,29}$", re.I)
+INVOICE_DATE_LABEL_RE = re.compile(r"\b(?:invoice|inv|bill)\s*date\b|\bdate\s+of\s+invoice\b|\bdated\b", re.I)
+SHIPPING_LABEL_RE = re.compile(r"\bship|\bconsignee\b|\bdeliver", re.I)
+PAN_LABEL_RE = re.compile(r"\bPAN\b", re.I)
+IRN_LABEL_RE = re.compile(r"\bIRN\b", re.I)
+
+GSTIN_CHARSET = "0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+
+_stats = {}
+_stats_lock = threading.Lock()
+_totals = {"pages": 0, "llm_calls_avoided": 0, "seconds": 0.0}
+# Narrowed schemas per (schema, resolved fields)
+_subsets = {}
+
+# Function to check a GSTIN's last character, a mod-36 checksum over the first 14
+def valid_gstin(gstin):
+    total = 0
+    for i, char in enumerate(gstin[:14]):
+        product = GSTIN_CHARSET.index(char) * (2 if i % 2 else 1)
+        total += product // 36 + product % 36
+    return GSTIN_CHARSET[(36 - total % 36) % 36] == gstin[14]
+
+# Function to read an Indian (day-first) date into the schema's dd/mm/yyyy form
+def normalize_date(match):
+    if match.group(1):
+        day, month, year = int(match.group(1)), int(match.group(2)), match.group(3)
+        candidate = f"{day:02d}/{month:02d}/{year}"
+        # Day first, strictly: "02/13/2024" is not a date here, not 13 February
+        try:
+            datetime.strptime(candidate, "%d/%m/%Y")
+        except ValueError:
+            return None
+        return candidate
+    for fmt in ("%d %b %Y", "%d %B %Y"):
+        try:
+            parsed = datetime.strptime(f"{int(match.group(4))} {match.group(5)} {match.group(6)}", fmt)
+            return parsed.strftime("%d/%m/%Y")
+        except ValueError:
+            continue
+    return None
+
+# Function to find the value that follows a label: the rest of its line, else the next line
+def value_after_label(lines, label_re):
+    for i, line in enumerate(lines):
+        match = label_re.search(line)
+        if not match:
+            continue
+        rest = line[match.end():].strip()
+        if rest:
+            yield rest
+        elif i + 1 < len(lines):
+            yield lines[i + 1].strip()
+
+def find_gstins(lines):
+    gst, shipping = [], []
+    for i, line in enumerate(lines):
+        for gstin in GSTIN_RE.findall(line):
+            if not valid_gstin(gstin):
+                continue
+            # A "Ship to"/"Consignee" label on the same or the preceding line marks the shipping GSTIN
+            context = line if i == 0 else lines[i - 1] + " " + line
+            target = shipping if SHIPPING_LABEL_RE.search(context) else gst
+            if gstin not in gst and gstin not in shipping:
+                target.append(gstin)
+    fields = {}
+    if len(gst) == 1:
+        fields["gst"] = gst[0]
+    if len(shipping) == 1:
+        fields["shippingGstin"] = shipping[0]
+    return fields
+
+def find_pan(lines):
+    for value in value_after_label(lines, PAN_LABEL_RE):
+        match = PAN_RE.search(value)
+        if match:
+            return match.group(0)
+    # Unlabelled, only when there is exactly one PAN-shaped token outside any GSTIN
+    candidates = {pan for line in lines for pan in PAN_RE.findall(GSTIN_RE.sub(" ", line))}
+    return candidates.pop() if len(candidates) == 1 else None
+
+def find_ifsc(lines):
+    candidates = {ifsc for line in lines for ifsc in IFSC_RE.findall(line)}
+    return candidates.pop() if len(candidates) == 1 else None
+
+def find_irn(lines):
+    # OCR often splits the 64-character hash into several boxes, so spaces are dropped
+    for value in value_after_label(lines, IRN_LABEL_RE):
+        match = IRN_RE.search(re.sub(r"[\s:]", "", value).lower())
+        if match:
+            return match.group(0)
+    candidates = {irn for line in lines for irn in IRN_RE.findall(line.lower())}
+    return candidates.pop() if len(candidates) == 1 else None
+
+def find_invoice_number(lines):
+    for value in value_after_label(lines, INVOICE_NUMBER_LABEL_RE):
+        token = value.split()[0].rstrip(".,;") if value.split() else ""
+        if INVOICE_NUMBER_VALUE_RE.match(token) and any(c.isdigit() for c in token) and not DATE_RE.match(token):
+            return token
+    return None
+
+def find_invoice_date(lines):
+    for value in value_after_label(lines, INVOICE_DATE_LABEL_RE):
+        match = DATE_RE.search(value)
+        if match:
+            return normalize_date(match)
+    return None
+
+# Rules and the schema fields they fill; each takes the OCR lines and returns a value
+# or None (a {field: value} dict when it fills more than one field)
+EXTRACTORS = [
+    (("gst", "shippingGstin"), find_gstins),
+    (("pan",), find_pan),
+    (("ifscCode",), find_ifsc),
+    (("irnNumber",), find_irn),
+    (("invoiceNumber",), find_invoice_number),
+    (("invoiceDate",), find_invoice_date)
+]
+
+def _count(field, hit, seconds):
+    with _stats_lock:
+        entry = _stats.setdefault(field, {"attempts": 0, "hits": 0, "seconds": 0.0})
+        entry["attempts"] += 1
+        entry["hits"] += 1 if hit else 0
+        entry["seconds"] += seconds
+
+# Function to fill the schema fields the rules can read confidently from layout-ordered OCR text
+def pre_extract(text, schema):
+    start = time.perf_counter()
+    properties = schema.get("properties", {})
+    lines = [line for line in text.split("\n") if line.strip()]
+    fields = {}
+    for names, extractor in EXTRACTORS:
+        wanted = [field for field in names if field in properties]
+        if not wanted:
+            continue
+        field_start = time.perf_counter()
+        value = extractor(lines)
+        found = value if len(names) > 1 else {names[0]: value}
+        seconds = time.perf_counter() - field_start
+        for field in wanted:
+            hit = bool(found.get(field))
+            _count(field, hit, seconds / len(wanted))
+            if hit:
+                fields[field] = found[field]
+    with _stats_lock:
+        _totals["pages"] += 1
+        _totals["seconds"] += time.perf_counter() - start
+    return fields
+
+# Function to note that a page needed no LLM call at all
+def count_avoided_call():
+    with _stats_lock:
+        _totals["llm_calls_avoided"] += 1
+
+# Function to return per-field hit rates and mean latency, plus the LLM calls avoided
+def stats():
+    with _stats_lock:
+        fields = {
+            field: {
+                "attempts": entry["attempts"],
+                "hits": entry["hits"],
+                "hit_rate": round(entry["hits"] / entry["attempts"], 4) if entry["attempts"] else 0.0,
+                "mean_ms": round(entry["seconds"] / entry["attempts"] * 1000, 3) if entry["attempts"] else 0.0
+            }
+            for field, entry in _stats.items()
+        }
+        return {**_totals, "seconds": round(_totals["seconds"], 4), "fields": fields}
+
+# Function to narrow a schema to the fields still unresolved; returns the same object
+# for the same field set, so rendered schema text is reused across pages
+def remaining_schema(schema, resolved):
+    if not resolved:
+        return schema
+    key = (id(schema), frozenset(resolved))
+    cached = _subsets.get(key)
+    if cached is not None and cached[0] is schema:
+        return cached[1]
+    subset = {
+        **schema,
+        "properties": {name: prop for name, prop in schema.get("properties", {}).items() if name not in resolved}
+    }
+    if "required" in schema:
+        subset["required"] = [name for name in schema["required"] if name not in resolved]
+    _subsets[key] = (schema, subset)
+    return subset
@@ -0,0 +1,107 @@
+// scheduler.js
+// Size-aware scheduling of extraction work across all requests. Every file is triaged
+// first (page count, text layer, estimated seconds; see triage.py) and the cheapest
+// waiting job runs next, so a batch of single-page images isn't held up behind a
+// 200-page PDF. Long PDFs are split into page ranges that are scheduled as jobs of their
+// own. A job's priority improves the longer it waits, so long jobs still get their turn
+// while short ones keep arriving.
+
+// Estimate used when a file could not be triaged
+const DEFAULT_JOB_SECONDS = 5;
+
+class SizeAwareScheduler {
+  // concurrency: jobs running at once (one per warm OCR engine).
+  // agingRate: seconds of estimated cost forgiven per second a job has waited.
+  constructor({ concurrency = 4, agingRate = 1 } = {}) {
+    this.concurrency = concurrency;
+    this.agingRate = agingRate;
+    this.waiting = [];
+    this.running = 0;
+    this.nextSeq = 1;
+    this.dispatchPending = false;
+  }
+
+  // Queue `run` (a function returning a promise) with its estimated cost; resolves to its result
+  submit(estimatedSeconds, run) {
+    return new Promise((resolve, reject) => {
+      this.waiting.push({
+        estimatedSeconds: Number.isFinite(estimatedSeconds) ? estimatedSeconds : DEFAULT_JOB_SECONDS,
+        queuedAt: Date.now(),
+        seq: this.nextSeq++,
+        run,
+        resolve,
+        reject,
+      });
+      // Dispatch once the caller has submitted everything it has at hand, so the files of a
+      // batch are ranked against each other rather than started in the order they were listed
+      if (!this.dispatchPending) {
+        this.dispatchPending = true;
+        setImmediate(() => {
+          this.dispatchPending = false;
+          this.dispatch();
+        });
+      }
+    });
+  }
+
+  // Lower runs sooner: the estimate, less what the job has earned by waiting
+  priority(job, now) {
+    return job.estimatedSeconds - this.agingRate * ((now - job.queuedAt) / 1000);
+  }
+
+  takeNext() {
+    const now = Date.now();
+    let best = 0;
+    for (let i = 1; i < this.waiting.length; i++) {
+      const difference = this.priority(this.waiting[i], now) - this.priority(this.waiting[best], now);
+      // Ties go to the job queued first
+      if (difference < 0 || (difference === 0 && this.waiting[i].seq < this.waiting[best].seq)) {
+        best = i;
+      }
+    }
+    return this.waiting.splice(best, 1)[0];
+  }
+
+  dispatch() {
+    while (this.running < this.concurrency && this.waiting.length > 0) {
+      const job = this.takeNext();
+      this.running += 1;
+      Promise.resolve()
+        .then(job.run)
+        .then(job.resolve, job.reject)
+        .finally(() => {
+          this.running -= 1;
+          this.dispatch();
+        });
+    }
+  }
+
+  stats() {
+    return { running: this.running, waiting: this.waiting.length };
+  }
+}
+
+// Split one triaged file into the page ranges it is processed as: PDFs longer than
+// `splitPages` become ranges of that many pages, everything else is one job. A file triage
+// found earlier results for (`reusable`) stays whole: the duplicate index only knows whole
+// documents, and handing back saved pages is quick anyway.
+// Returns [{ pages: [first, last] | null, estimatedSeconds }].
+const planJobs = (triage, splitPages) => {
+  if (!triage || triage.error) {
+    return [{ pages: null, estimatedSeconds: DEFAULT_JOB_SECONDS }];
+  }
+  if (triage.reusable) {
+    return [{ pages: null, estimatedSeconds: 0 }];
+  }
+  if (triage.kind !== 'pdf' || !splitPages || triage.pages <= splitPages) {
+    return [{ pages: null, estimatedSeconds: triage.estimated_seconds }];
+  }
+  const jobs = [];
+  for (let first = 1; first <= triage.pages; first += splitPages) {
+    const last = Math.min(first + splitPages - 1, triage.pages);
+    jobs.push({ pages: [first, last], estimatedSeconds: triage.page_seconds * (last - first + 1) });
+  }
+  return jobs;
+};
+
+module.exports = { SizeAwareScheduler, planJobs, DEFAULT_JOB_SECONDS };
@@ -0,0 +1,136 @@
+# structuring.py
+# Concurrent LLM structuring stage: many page extractions in flight at once,
+# bounded by a concurrency cap plus request-rate and token-rate budgets, with
+# exponential backoff (full jitter) on 429s, 5xx responses and timeouts.
+import asyncio
+import os
+import random
+import threading
+import time
+
+# Rough token estimate (~4 characters per token for English/OCR text)
+def estimate_tokens(text):
+    return max(1, len(text) // 4)
+
+class RateLimiter:
+    # Token bucket that hands out reservations instead of blocking, so it can be
+    # shared by event loops running in different threads of the --serve worker.
+    def __init__(self, rate_per_minute):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(rate_per_minute)
+        self.available = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.available = min(self.capacity, self.available + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # Function to reserve `amount` units and return how long the caller must wait
+    def reserve(self, amount):
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            # Oversized requests are clamped so they can still run once the bucket is full
+            amount = min(amount, self.capacity)
+            self.available -= amount
+            if self.available >= 0:
+                return 0.0
+            return -self.available / self.rate
+
+    # Function to return (or charge extra) units once the real usage is known
+    def adjust(self, delta):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.available = min(self.capacity, self.available - delta)
+
+    async def acquire(self, amount=1):
+        delay = self.reserve(amount)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+# Limits shared by every structuring run in this process
+_request_limiter = RateLimiter(int(os.getenv("LLM_RPM", "500")))
+_token_limiter = RateLimiter(int(os.getenv("LLM_TPM", "160000")))
+
+class RetriesExhaustedError(Exception):
+    pass
+
+class AsyncStructurer:
+    def __init__(self, api_key=None, model='gpt-3.5-turbo-0125', max_concurrency=None,
+                 max_retries=None, timeout=None, base_delay=0.5, max_delay=30.0,
+                 expected_completion_tokens=1000, client=None):
+        self.model = model
+        self.max_concurrency = max_concurrency or int(os.getenv("LLM_CONCURRENCY", "8"))
+        self.max_retries = max_retries if max_retries is not None else int(os.getenv("LLM_MAX_RETRIES", "5"))
+        self.timeout = timeout or float(os.getenv("LLM_TIMEOUT", "60"))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.expected_completion_tokens = expected_completion_tokens
+        self.retries = 0
+        # Retries are ours, so the SDK's own retry loop is switched off.
+        # OPENAI_BASE_URL is honoured by the SDK, which lets tests point at stub_openai.py.
+        # The SDK is imported here rather than at module level, so importing this module stays cheap.
+        if client is None:
+            from openai import AsyncOpenAI
+            client = AsyncOpenAI(api_key=api_key, timeout=self.timeout, max_retries=0)
+        self.client = client
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    # Function to compute the backoff delay for a given attempt, honouring Retry-After
+    def backoff_delay(self, attempt, error):
+        retry_after = None
+        response = getattr(error, "response", None)
+        if response is not None:
+            try:
+                retry_after = float(response.headers.get("retry-after"))
+            except (TypeError, ValueError):
+                retry_after = None
+        ceiling = min(self.max_delay, self.base_delay * (2 ** attempt))
+        delay = random.uniform(0, ceiling)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    # Function to send one chat completion, returning (message_content, usage)
+    async def complete(self, prompt_content, max_tokens=4096, response_format=None):
+        from openai import APIConnectionError, APIStatusError, APITimeoutError, RateLimitError
+        estimated = estimate_tokens(prompt_content) + self.expected_completion_tokens
+        request = {
+            "model": self.model,
+            "messages": [{"role": "user", "content": prompt_content}],
+            "max_tokens": max_tokens,
+            "temperature": 0.0
+        }
+        if response_format:
+            request["response_format"] = response_format
+
+        attempt = 0
+        while True:
+            await _request_limiter.acquire(1)
+            await _token_limiter.acquire(estimated)
+            try:
+                async with self._semaphore:
+                    response = await self.client.chat.completions.create(**request)
+            except (RateLimitError, APITimeoutError, APIConnectionError) as e:
+                error = e
+            except APIStatusError as e:
+                if e.status_code < 500:
+                    raise
+                error = e
+            else:
+                usage = response.usage
+                # Settle the token reservation against what the API actually billed
+                _token_limiter.adjust(usage.prompt_tokens + usage.completion_tokens - estimated)
+                return response.choices[0].message.content, usage
+
+            # A rejected attempt is not billed, so hand its token reservation back
+            _token_limiter.adjust(-estimated)
+            if attempt >= self.max_retries:
+                raise RetriesExhaustedError(f"Giving up after {attempt + 1} attempts: {error}") from error
+            self.retries += 1
+            await asyncio.sleep(self.backoff_delay(attempt, error))
+            attempt += 1
+
+    async def close(self):
+        await self.client.close()
@@ -0,0 +1,158 @@
+# stub_openai.py
+# Local stand-in for the OpenAI chat completions endpoint, for exercising the
+# structuring stage offline. Latency, jitter and error rates are configurable.
+#
+# Usage: python stub_openai.py [--port 8765] [--latency 0.8] [--jitter 0.2]
+#                              [--rate-limit-rate 0.1] [--error-rate 0.05] [--seed 0]
+# then run d2.py with OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=stub
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Function to build a deterministic invoice for a prompt so repeated runs match
+def stub_invoice(prompt_content):
+    digest = hashlib.sha256(prompt_content.encode('utf-8')).hexdigest()
+    amount = int(digest[:6], 16) % 100000 / 100
+    return {
+        "invoiceNumber": f"STUB-{digest[:8].upper()}",
+        "invoiceDate": "01/04/2024",
+        "buyerName": "Stub Buyer Pvt Ltd",
+        "sellerName": "Stub Seller Pvt Ltd",
+        "shippingAddress": "1 Stub Road, Pune",
+        "currency": "INR",
+        "totalAmountPreTax": amount,
+        "invoiceTotalAmount": round(amount * 1.18, 2),
+        "paymentDueDate": "2024-04-30",
+        "items": [
+            {
+                "description": "Stub item",
+                "quantity": 1,
+                "unitOfMeasurement": "Nos",
+                "pricePerUnit": amount,
+                "amount": amount
+            }
+        ]
+    }
+
+class StubConfig:
+    def __init__(self, latency=0.8, jitter=0.2, rate_limit_rate=0.0, error_rate=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit_rate = rate_limit_rate
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.rate_limited = 0
+        self.errors = 0
+
+    # Function to decide the fate of one request: (delay, status)
+    def draw(self):
+        with self.lock:
+            self.requests += 1
+            delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+            roll = self.random.random()
+            if roll < self.rate_limit_rate:
+                self.rate_limited += 1
+                return delay / 10, 429
+            if roll < self.rate_limit_rate + self.error_rate:
+                self.errors += 1
+                return delay, 500
+            return delay, 200
+
+def make_handler(config):
+    class StubHandler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, payload, headers=None):
+            body = json.dumps(payload).encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.rstrip('/') == "/stats":
+                self.send_json(200, {
+                    "requests": config.requests,
+                    "rate_limited": config.rate_limited,
+                    "errors": config.errors
+                })
+            else:
+                self.send_json(404, {"error": {"message": "Not found"}})
+
+        def do_POST(self):
+            if not self.path.rstrip('/').endswith("/chat/completions"):
+                self.send_json(404, {"error": {"message": "Not found"}})
+                return
+
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            delay, status = config.draw()
+            time.sleep(delay)
+
+            if status == 429:
+                self.send_json(429, {"error": {"message": "Rate limit reached", "type": "rate_limit_error"}},
+                               headers={"Retry-After": "0.05"})
+                return
+            if status != 200:
+                self.send_json(status, {"error": {"message": "Stub server error", "type": "server_error"}})
+                return
+
+            prompt_content = "".join(m.get("content", "") for m in request.get("messages", []))
+            content = json.dumps(stub_invoice(prompt_content))
+            prompt_tokens = max(1, len(prompt_content) // 4)
+            completion_tokens = max(1, len(content) // 4)
+            self.send_json(200, {
+                "id": "chatcmpl-stub",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "stub"),
+                "choices": [{
+                    "index": 0,
+                    "message": {"role": "assistant", "content": content},
+                    "finish_reason": "stop"
+                }],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens
+                }
+            })
+
+    return StubHandler
+
+# Function to start the stub on a background thread; returns (server, base_url)
+def start_stub_server(port=0, **config):
+    server = ThreadingHTTPServer(("127.0.0.1", port), make_handler(StubConfig(**config)))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}/v1"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Stub OpenAI chat completions server")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.8, help="mean response latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.2, help="uniform +/- jitter in seconds")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 500")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(StubConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        rate_limit_rate=args.rate_limit_rate,
+        error_rate=args.error_rate,
+        seed=args.seed
+    )))
+    print(f"Stub OpenAI server listening on http://127.0.0.1:{args.port}/v1", flush=True)
+    server.serve_forever()
@@ -0,0 +1,118 @@
+# textlayer.py
+# Fast path for born-digital PDFs: the words of a page are read straight from its text
+# layer, with their positions, instead of rasterizing the page and running PaddleOCR on
+# it. The result has the same shape as OCR output — one box per text line (four corners,
+# page coordinates in PDF points), its text and a score (1.0; the text is exact) — so the
+# rest of the pipeline can't tell which backend read a page.
+#
+# poppler's pdftotext (installed with pdf2image) is used when it is on the PATH, pdfminer.six
+# otherwise. Scanned pages, and pages whose fonts don't map to Unicode, read as None and are
+# left to OCR.
+import importlib.util
+import os
+import re
+import shutil
+import subprocess
+import xml.etree.ElementTree as ET
+from functools import lru_cache
+
+# A page needs this many letters and digits in its text layer to skip OCR
+TEXT_LAYER_MIN_CHARS = int(os.getenv("TEXT_LAYER_MIN_CHARS", "50"))
+# Share of unmapped glyphs (U+FFFD, "(cid:12)", private-use characters) above which the text layer is ignored
+TEXT_LAYER_MAX_GARBAGE = float(os.getenv("TEXT_LAYER_MAX_GARBAGE", "0.05"))
+PDFTOTEXT_TIMEOUT = 30
+
+GARBAGE = re.compile(r"\(cid:\d+\)|[\ufffd\ue000-\uf8ff]")
+
+# Function to name the reader this process will use; None when neither is installed
+@lru_cache(maxsize=1)
+def reader():
+    if shutil.which("pdftotext"):
+        return "pdftotext"
+    # Optional; only needed without poppler, and imported when first used
+    if importlib.util.find_spec("pdfminer") is not None:
+        return "pdfminer"
+    return None
+
+# Function to strip the XHTML namespace pdftotext puts on every element
+def local_name(element):
+    return element.tag.rsplit("}", 1)[-1]
+
+def line_box(left, top, right, bottom):
+    return [[left, top], [right, top], [right, bottom], [left, bottom]]
+
+# Function to read a page's text lines with pdftotext; returns (width, height, [(box, text), ...])
+def pdftotext_lines(pdf_path, page_number):
+    result = subprocess.run(
+        ["pdftotext", "-bbox-layout", "-enc", "UTF-8", "-f", str(page_number), "-l", str(page_number), pdf_path, "-"],
+        capture_output=True, timeout=PDFTOTEXT_TIMEOUT, check=True
+    )
+    # Control characters in the PDF's strings would make the XHTML unparseable
+    root = ET.fromstring(re.sub(rb"[\x00-\x08\x0b\x0c\x0e-\x1f]", b"", result.stdout))
+    page = next(element for element in root.iter() if local_name(element) == "page")
+    lines = []
+    for line in page.iter():
+        if local_name(line) != "line":
+            continue
+        words = [word.text for word in line if word.text]
+        if words:
+            lines.append((line_box(float(line.get("xMin")), float(line.get("yMin")),
+                                   float(line.get("xMax")), float(line.get("yMax"))), " ".join(words)))
+    return float(page.get("width")), float(page.get("height")), lines
+
+# Function to read a page's text lines with pdfminer; same result as pdftotext_lines
+def pdfminer_lines(pdf_path, page_number):
+    from pdfminer.high_level import extract_pages
+    from pdfminer.layout import LTTextContainer, LTTextLine
+    page = next(extract_pages(pdf_path, page_numbers=[page_number - 1]))
+    height = page.height
+    lines = []
+
+    def collect(container):
+        for element in container:
+            if isinstance(element, LTTextLine):
+                text = element.get_text().strip()
+                if text:
+                    # PDF space counts y up from the bottom; OCR boxes count down from the top
+                    lines.append((line_box(element.x0, height - element.y1, element.x1, height - element.y0), text))
+            elif isinstance(element, LTTextContainer):
+                collect(element)
+
+    collect(page)
+    return page.width, height, lines
+
+# Function to decide whether extracted text is real text rather than a scan's stray
+# annotations or glyphs without a Unicode mapping
+def usable(texts):
+    text = "".join(texts)
+    characters = sum(1 for char in text if char.isalnum())
+    if characters < TEXT_LAYER_MIN_CHARS:
+        return False
+    garbage = sum(len(match) for match in GARBAGE.findall(text))
+    return garbage <= TEXT_LAYER_MAX_GARBAGE * len(text)
+
+# Function to read one PDF page from its text layer. Returns {"boxes", "texts", "scores",
+# "width", "height", "reader"} in the shape of OCR output, or None when the page has to be OCR'd.
+def read_page(pdf_path, page_number):
+    name = reader()
+    if name is None:
+        return None
+    try:
+        if name == "pdftotext":
+            width, height, lines = pdftotext_lines(pdf_path, page_number)
+        else:
+            width, height, lines = pdfminer_lines(pdf_path, page_number)
+    except Exception as e:
+        print(f"Text layer unreadable for page {page_number} of {pdf_path}: {e}")
+        return None
+    texts = [text for _, text in lines]
+    if not usable(texts):
+        return None
+    return {
+        "boxes": [box for box, _ in lines],
+        "texts": texts,
+        "scores": [1.0] * len(texts),
+        "width": width,
+        "height": height,
+        "reader": name
+    }
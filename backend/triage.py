@@ -0,0 +1,81 @@
+# triage.py
+# Cheap look at an uploaded file before any work is scheduled for it: page count and page
+# size from the PDF's metadata (pdfinfo) or the image's header, file size, and whether the
+# PDF has a text layer. Nothing is rasterized or decoded. From these an estimate of the
+# seconds the file will take is made, which the server's scheduler uses to run short files
+# first and to split long documents into page ranges (see scheduler.js).
+import os
+import re
+
+from PIL import Image
+
+import textlayer
+
+# Rough seconds per page: OCR of a page of REFERENCE_MEGAPIXELS (an A4 page at 200 DPI),
+# a page read from its text layer, and structuring a page with the LLM
+OCR_PAGE_SECONDS = float(os.getenv("TRIAGE_OCR_PAGE_SECONDS", "2.0"))
+TEXT_LAYER_PAGE_SECONDS = float(os.getenv("TRIAGE_TEXT_LAYER_PAGE_SECONDS", "0.05"))
+LLM_PAGE_SECONDS = float(os.getenv("TRIAGE_LLM_PAGE_SECONDS", "3.0"))
+REFERENCE_MEGAPIXELS = 3.9
+# Pages are scaled to a target text height before OCR, so pixel count only moves the cost this far
+MIN_SIZE_FACTOR = 0.5
+MAX_SIZE_FACTOR = 2.0
+# Resolution PDF page sizes are converted to pixels at for the estimate
+ESTIMATE_DPI = 200
+
+PAGE_SIZE = re.compile(r"([\d.]+)\s*x\s*([\d.]+)\s*pts")
+
+# Function to read a PDF's page count and first page size (in points) from its metadata
+def pdf_metadata(pdf_path):
+    from pdf2image import pdfinfo_from_path
+    info = pdfinfo_from_path(pdf_path)
+    match = PAGE_SIZE.search(info.get("Page size", ""))
+    width, height = (float(match.group(1)), float(match.group(2))) if match else (None, None)
+    return int(info["Pages"]), width, height
+
+# Function to read an image's pixel size from its header; the pixels are not decoded
+def image_metadata(image_path):
+    with Image.open(image_path) as image:
+        return image.size, image.format
+
+# Function to estimate the seconds one page takes to OCR, from its size in pixels
+def ocr_page_seconds(width, height):
+    if not width or not height:
+        return OCR_PAGE_SECONDS
+    factor = width * height / 1e6 / REFERENCE_MEGAPIXELS
+    return OCR_PAGE_SECONDS * min(MAX_SIZE_FACTOR, max(MIN_SIZE_FACTOR, factor))
+
+# Function to triage one file. `backend` is d2's OCR_BACKEND (whether text layers are used)
+# and `llm` whether pages will be structured by the LLM. Returns {"file", "kind", "size_bytes",
+# "pages", "width", "height", "text_layer", "page_seconds", "estimated_seconds"}.
+def triage_file(file_path, backend="auto", llm=True):
+    result = {
+        "file": os.path.basename(file_path),
+        "size_bytes": os.path.getsize(file_path),
+        "text_layer": False
+    }
+    if file_path.lower().endswith('.pdf'):
+        pages, width, height = pdf_metadata(file_path)
+        result.update({"kind": "pdf", "pages": pages})
+        # Points to pixels at the resolution pages are typically rendered at
+        if width and height:
+            width, height = int(width * ESTIMATE_DPI / 72), int(height * ESTIMATE_DPI / 72)
+        # The first page stands in for the document; a born-digital PDF has text on every page
+        if backend != "paddleocr" and pages:
+            result["text_layer"] = textlayer.read_page(file_path, 1) is not None
+    else:
+        (width, height), image_format = image_metadata(file_path)
+        result.update({"kind": (image_format or "image").lower(), "pages": 1})
+    result["width"], result["height"] = width, height
+
+    if result["text_layer"]:
+        page_seconds = TEXT_LAYER_PAGE_SECONDS
+    elif backend == "textlayer":
+        page_seconds = 0.0
+    else:
+        page_seconds = ocr_page_seconds(width, height)
+    if llm:
+        page_seconds += LLM_PAGE_SECONDS
+    result["page_seconds"] = round(page_seconds, 3)
+    result["estimated_seconds"] = round(page_seconds * result["pages"], 3)
+    return result
@@ -0,0 +1,181 @@
+# validation.py
+# Checks every LLM extraction against invoice_schema.json. The schema is compiled once
+# into per-field check functions (type, pattern, date format, required keys, array
+# items), values that are only mis-formatted (amounts as strings, ISO vs dd/mm/yyyy
+# dates) are coerced first, and whatever still fails is reported per field so the
+# caller can re-ask for just those fields. Per-field failure rates are kept for metrics.
+import re
+import threading
+from datetime import datetime
+
+from merging import to_number
+from rules import DATE_RE, normalize_date
+
+# Error of a required field (or item field) that has no value
+MISSING = "missing"
+
+TYPE_CHECKS = {
+    "string": lambda v: isinstance(v, str),
+    "number": lambda v: isinstance(v, (int, float)) and not isinstance(v, bool),
+    "integer": lambda v: isinstance(v, int) and not isinstance(v, bool),
+    "boolean": lambda v: isinstance(v, bool),
+    "array": lambda v: isinstance(v, list),
+    "object": lambda v: isinstance(v, dict)
+}
+
+# Compiled validators per schema object
+_compiled = {}
+_stats = {}
+_stats_lock = threading.Lock()
+
+def _valid_iso_date(value):
+    try:
+        datetime.strptime(value, "%Y-%m-%d")
+        return True
+    except ValueError:
+        return False
+
+# Function to compile one schema node into a check that returns an error message or None
+def _compile(node):
+    checks = []
+    kind = node.get("type")
+    if kind in TYPE_CHECKS:
+        type_check = TYPE_CHECKS[kind]
+        checks.append(lambda v: None if type_check(v) else f"expected {kind}, got {type(v).__name__}")
+    if "pattern" in node:
+        pattern = re.compile(node["pattern"])
+        checks.append(lambda v: None if not isinstance(v, str) or pattern.search(v) else f"does not match {node['pattern']}")
+    if node.get("format") == "date":
+        checks.append(lambda v: None if not isinstance(v, str) or _valid_iso_date(v) else "not a yyyy-mm-dd date")
+    if kind == "array" and "items" in node:
+        item_check = _compile(node["items"])
+
+        def check_items(v):
+            if not isinstance(v, list):
+                return None
+            first_missing = None
+            for i, item in enumerate(v):
+                error = item_check(item)
+                # An invalid item is reported ahead of one that only leaves a field out
+                if error and not is_missing(error):
+                    return f"item {i}: {error}"
+                if error and first_missing is None:
+                    first_missing = f"item {i}: {error}"
+            return first_missing
+        checks.append(check_items)
+    if kind == "object" and ("properties" in node or "required" in node):
+        property_checks = {name: _compile(prop) for name, prop in node.get("properties", {}).items()}
+        required = node.get("required", [])
+
+        def check_object(v):
+            if not isinstance(v, dict):
+                return None
+            for name, check in property_checks.items():
+                if v.get(name) is not None:
+                    error = check(v[name])
+                    if error:
+                        return f"{name} {error}"
+            for name in required:
+                if v.get(name) is None:
+                    return f"{name} is {MISSING}"
+            return None
+        checks.append(check_object)
+
+    def check(value):
+        for step in checks:
+            error = step(value)
+            if error:
+                return error
+        return None
+    return check
+
+# Function to return the compiled top-level field checks for a schema, building them once
+def compiled(schema):
+    cached = _compiled.get(id(schema))
+    if cached is not None and cached[0] is schema:
+        return cached[1]
+    checks = {name: _compile(prop) for name, prop in schema.get("properties", {}).items()}
+    _compiled[id(schema)] = (schema, checks)
+    return checks
+
+# Function to validate a structured invoice; returns {field: error} for every failing field
+def validate(data, schema):
+    checks = compiled(schema)
+    errors = {}
+    for name in schema.get("required", []):
+        if data.get(name) is None:
+            errors[name] = MISSING
+    for name, value in data.items():
+        check = checks.get(name)
+        if check is not None and value is not None:
+            error = check(value)
+            if error:
+                errors[name] = error
+    return errors
+
+# Function to tell a required field that was left out from a value that is wrong; the
+# prompt tells the model to omit what the page doesn't show, so asking again can't supply it
+def is_missing(error):
+    return error == MISSING or error.endswith(" is " + MISSING)
+
+# Function to pick the errors worth a re-ask: values that are present but invalid
+def reaskable(errors):
+    return {name: error for name, error in errors.items() if not is_missing(error)}
+
+# Function to fix values that are right but mis-formatted, so they don't cost a re-ask
+def _coerce_value(value, node):
+    kind = node.get("type")
+    if value is None:
+        return None
+    if kind == "number" and isinstance(value, str):
+        number = to_number(value)
+        return value if number is None else number
+    if kind == "string" and isinstance(value, (int, float)) and not isinstance(value, bool):
+        return str(value)
+    if kind == "string" and isinstance(value, str) and (node.get("pattern") or node.get("format") == "date"):
+        iso = re.fullmatch(r"\s*(\d{4})-(\d{1,2})-(\d{1,2})\s*", value)
+        if iso:
+            day_first = f"{int(iso.group(3)):02d}/{int(iso.group(2)):02d}/{iso.group(1)}"
+        else:
+            match = DATE_RE.search(value)
+            day_first = normalize_date(match) if match else None
+        if not day_first:
+            return value
+        if node.get("format") == "date":
+            day, month, year = day_first.split("/")
+            return f"{year}-{month}-{day}"
+        if node.get("pattern") == r"^\d{2}/\d{2}/\d{4}$":
+            return day_first
+        return value
+    if kind == "array" and isinstance(value, list) and "items" in node:
+        return [_coerce_value(item, node["items"]) for item in value]
+    if kind == "object" and isinstance(value, dict):
+        properties = node.get("properties", {})
+        return {k: _coerce_value(v, properties[k]) if k in properties else v for k, v in value.items() if v is not None}
+    return value
+
+def coerce(data, schema):
+    properties = schema.get("properties", {})
+    return {
+        name: _coerce_value(value, properties[name]) if name in properties else value
+        for name, value in data.items() if value is not None
+    }
+
+# Function to count one validated response: which fields failed first, and which still fail after the re-ask
+def count(schema, failed, still_failing):
+    with _stats_lock:
+        for name in schema.get("properties", {}):
+            entry = _stats.setdefault(name, {"checked": 0, "failed": 0, "fixed_by_reask": 0})
+            entry["checked"] += 1
+            if name in failed:
+                entry["failed"] += 1
+                if name not in still_failing:
+                    entry["fixed_by_reask"] += 1
+
+# Function to return per-field failure rates for the metrics op
+def stats():
+    with _stats_lock:
+        return {
+            name: {**entry, "failure_rate": round(entry["failed"] / entry["checked"], 4) if entry["checked"] else 0.0}
+            for name, entry in _stats.items()
+        }
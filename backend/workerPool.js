@@ -0,0 +1,104 @@
+// workerPool.js
+const { spawn } = require('child_process');
+const readline = require('readline');
+
+// Long-lived `python d2.py --serve` process holding a pool of warm OCR engines.
+// Requests and responses are exchanged as JSON lines tagged with an id.
+class ExtractionWorker {
+  constructor({ workers = 4, python = 'python', restartDelayMs = 1000 } = {}) {
+    this.workers = workers;
+    this.python = python;
+    this.restartDelayMs = restartDelayMs;
+    this.nextId = 1;
+    this.pending = new Map();
+    this.process = null;
+    this.stopped = false;
+  }
+
+  start() {
+    if (this.process) {
+      return;
+    }
+
+    const pythonProcess = spawn(this.python, ['d2.py', '--serve', '--workers', String(this.workers)], {
+      cwd: __dirname,
+    });
+    this.process = pythonProcess;
+
+    const lines = readline.createInterface({ input: pythonProcess.stdout });
+    lines.on('line', (line) => this.handleLine(line));
+
+    pythonProcess.stderr.on('data', (data) => {
+      console.error(`Extraction worker stderr: ${data.toString()}`);
+    });
+
+    pythonProcess.on('close', (code) => {
+      console.error(`Extraction worker exited with code ${code}`);
+      this.process = null;
+
+      // Fail everything in flight; callers decide whether to retry
+      for (const { reject } of this.pending.values()) {
+        reject({ error: 'Extraction worker exited', details: `exit code ${code}` });
+      }
+      this.pending.clear();
+
+      if (!this.stopped) {
+        setTimeout(() => this.start(), this.restartDelayMs);
+      }
+    });
+  }
+
+  handleLine(line) {
+    let message;
+    try {
+      message = JSON.parse(line);
+    } catch (error) {
+      console.error('Unparseable extraction worker output:', line);
+      return;
+    }
+
+    if (message.event === 'ready') {
+      console.log(`Extraction worker ready with ${message.workers} OCR engine(s)`);
+      return;
+    }
+
+    const entry = this.pending.get(message.id);
+    if (!entry) {
+      return;
+    }
+
+    // Pipeline events (page-started, ocr-done, llm-done, page-result, ...) precede the reply
+    if (message.event) {
+      if (entry.onEvent) {
+        entry.onEvent(message);
+      }
+      return;
+    }
+    this.pending.delete(message.id);
+
+    if (message.ok) {
+      entry.resolve(message.result);
+    } else {
+      entry.reject({ error: message.error, details: message.traceback });
+    }
+  }
+
+  request(payload, onEvent = null) {
+    this.start();
+    const id = this.nextId++;
+    return new Promise((resolve, reject) => {
+      this.pending.set(id, { resolve, reject, onEvent });
+      this.process.stdin.write(JSON.stringify({ ...payload, id }) + '\n');
+    });
+  }
+
+  stop() {
+    this.stopped = true;
+    if (this.process) {
+      this.process.stdin.write(JSON.stringify({ op: 'shutdown' }) + '\n');
+      this.process.stdin.end();
+    }
+  }
+}
+
+module.exports = { ExtractionWorker };
@@ -0,0 +1,109 @@
+# workspace.py
+# Per-job scratch directories, so concurrent extractions never share a path, plus
+# atomic writes for the artifacts they leave behind and retention-based cleanup.
+#
+# Layout: <INVOICY_WORK_DIR>/<job_id>/{pages,annotated,prompts}/ and job.json
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+WORK_ROOT = os.getenv("INVOICY_WORK_DIR", "work")
+JOB_RETENTION_SECONDS = float(os.getenv("JOB_RETENTION_HOURS", "24")) * 3600
+# Jobs that never finished (crashed workers) are reclaimed after this long
+STALE_JOB_SECONDS = float(os.getenv("STALE_JOB_HOURS", "48")) * 3600
+CLEANUP_INTERVAL_SECONDS = 600
+
+_last_cleanup = 0.0
+_cleanup_lock = threading.Lock()
+
+# Function to write a file atomically: readers see the old content or the new, never half
+def atomic_write(path, data):
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data.encode('utf-8') if isinstance(data, str) else data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def atomic_write_json(path, value):
+    atomic_write(path, json.dumps(value))
+
+# Function to make sure a job ID can't escape the work root
+def validate_job_id(job_id):
+    job_id = str(job_id)
+    if not job_id or os.path.basename(job_id) != job_id or job_id in ('.', '..'):
+        raise ValueError(f"Invalid job id: {job_id!r}")
+    return job_id
+
+class JobWorkspace:
+    def __init__(self, job_id=None, root=None):
+        self.job_id = validate_job_id(job_id) if job_id else uuid.uuid4().hex
+        self.root = os.path.join(root or WORK_ROOT, self.job_id)
+        self.pages = os.path.join(self.root, "pages")
+        self.annotated = os.path.join(self.root, "annotated")
+        self.prompts = os.path.join(self.root, "prompts")
+        for directory in (self.pages, self.annotated, self.prompts):
+            os.makedirs(directory, exist_ok=True)
+        atomic_write_json(self.path("job.json"), {"job_id": self.job_id, "started": time.time(), "finished": None})
+
+    def path(self, *parts):
+        return os.path.join(self.root, *parts)
+
+    # Function to record the job as finished, with its outputs, so cleanup can age it out
+    def finish(self, outputs=None, error=None):
+        if outputs is not None:
+            atomic_write_json(self.path("result.json"), outputs)
+        with open(self.path("job.json"), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        meta.update({"finished": time.time(), "error": error})
+        atomic_write_json(self.path("job.json"), meta)
+
+# Function to delete finished jobs older than the retention period and stale unfinished ones
+def cleanup_jobs(root=None, retention_seconds=None, stale_seconds=None):
+    root = root or WORK_ROOT
+    retention_seconds = JOB_RETENTION_SECONDS if retention_seconds is None else retention_seconds
+    stale_seconds = STALE_JOB_SECONDS if stale_seconds is None else stale_seconds
+    now = time.time()
+    removed = []
+    if not os.path.isdir(root):
+        return removed
+
+    for job_id in os.listdir(root):
+        job_root = os.path.join(root, job_id)
+        # The job queue's database lives alongside the job directories
+        if not os.path.isdir(job_root):
+            continue
+        try:
+            with open(os.path.join(job_root, "job.json"), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            meta = {}
+        try:
+            if meta.get("finished"):
+                expired = now - meta["finished"] > retention_seconds
+            else:
+                expired = now - os.path.getmtime(job_root) > stale_seconds
+        except OSError:
+            continue
+        if expired:
+            shutil.rmtree(job_root, ignore_errors=True)
+            removed.append(job_id)
+    return removed
+
+# Function to run cleanup at most once per interval; cheap to call on every job
+def maybe_cleanup_jobs():
+    global _last_cleanup
+    with _cleanup_lock:
+        if time.time() - _last_cleanup < CLEANUP_INTERVAL_SECONDS:
+            return []
+        _last_cleanup = time.time()
+    return cleanup_jobs()
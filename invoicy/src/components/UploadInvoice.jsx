@@ -45,6 +45,21 @@ const BulkProcessingToggle = ({ bulkMode, setBulkMode }) => {
   );
 };
 
+// Page results in file then page order
+const orderedResults = (pageResults) => Object.values(pageResults)
+  .sort((a, b) => a.fileIndex - b.fileIndex || a.page - b.page);
+
+// Invoice number and total of one page result, read the way Invoice.jsx reads them
+const pageSummary = (output) => {
+  const content = output.structured_data ? output.structured_data.response_content : output.response_content;
+  try {
+    const data = JSON.parse(content);
+    return { invoiceNumber: data.invoiceNumber, total: data.invoiceTotalAmount };
+  } catch (error) {
+    return { error: content };
+  }
+};
+
 function UploadInvoice() {
   const [files, setFiles] = useState([]);
   const [previewFiles, setPreviewFiles] = useState([]);
@@ -53,6 +68,7 @@ function UploadInvoice() {
   const [processingStep, setProcessingStep] = useState(null);
   const [selectedFileIndex, setSelectedFileIndex] = useState(null);
   const [duplicateWarning, setDuplicateWarning] = useState(null);
+  const [pageResults, setPageResults] = useState({});
   const navigate = useNavigate();
 
   useEffect(() => {
@@ -121,40 +137,57 @@ function UploadInvoice() {
 
   // console.log(files);
 
-  const handleProcess = async () => {
+  const handleProcess = () => {
     if (files.length === 0) return;
-  
+
     setProcessing(true);
+    setProcessingStep('Extracting information');
     console.log('Processing started...');
-  
-    try {
-      // setProcessingStep('Extracting information');
-      // await new Promise(resolve => setTimeout(resolve, 30000));
-  
-      // setProcessingStep('Collating information');
-      // await new Promise(resolve => setTimeout(resolve, 30000));
-  
-      setProcessingStep('Ready to present');
-  
-      const fileNames = files.map(file => file.name);
-      const response = await axios.post('http://127.0.0.1:5000/processInvoice', { fileNames }, {
-        headers: { 'Content-Type': 'application/json' },
-        withCredentials: true,
-      });
-  
-      console.log("files given", previewFiles);
-  
-      const processedData = response.data;
+
+    const fileNames = files.map(file => file.name);
+    const query = fileNames.map(name => `fileNames=${encodeURIComponent(name)}`).join('&');
+    const events = new EventSource(`http://127.0.0.1:5000/processInvoice/events?${query}`, { withCredentials: true });
+
+    // Page results arrive as each page finishes and are listed straight away
+    const collected = {};
+    setPageResults({});
+
+    events.addEventListener('progress', (event) => {
+      const { step } = JSON.parse(event.data);
+      setProcessingStep(step);
+    });
+
+    events.addEventListener('page-result', (event) => {
+      const { fileName, page, output } = JSON.parse(event.data);
+      const result = { fileName, fileIndex: fileNames.indexOf(fileName), page, output };
+      collected[`${result.fileIndex}:${page}`] = result;
+      setPageResults(prevResults => ({ ...prevResults, [`${result.fileIndex}:${page}`]: result }));
+      console.log(`Page ${page} of ${fileName} ready`);
+    });
+
+    events.addEventListener('file-error', (event) => {
+      console.error('Error processing file:', JSON.parse(event.data));
+    });
+
+    events.addEventListener('complete', () => {
+      events.close();
+      const processedData = orderedResults(collected).map(result => result.output);
       console.log('Processing responses:', processedData);
-  
+
+      setProcessingStep('Ready to present');
+      setProcessing(false);
+      console.log('Processing ended.');
       navigate('/invoice', { state: { invoiceData: processedData, previewFiles: previewFiles } });
-    } catch (error) {
+    });
+
+    events.onerror = (error) => {
+      // EventSource reconnects on its own after errors; stop it so the batch isn't resubmitted
       console.error('Error processing files:', error);
+      events.close();
       setProcessingStep(null);
-    } finally {
       setProcessing(false);
       console.log('Processing ended.');
-    }
+    };
   };
 
   return (
@@ -229,6 +262,21 @@ function UploadInvoice() {
                         }}
                       ></div>
                     </div>
+                    {Object.keys(pageResults).length > 0 && (
+                      <ul className="mt-4 text-sm text-left text-gray-700">
+                        {orderedResults(pageResults).map(({ fileName, fileIndex, page, output }) => {
+                          const summary = pageSummary(output);
+                          return (
+                            <li key={`${fileIndex}:${page}`} className="flex justify-between py-1 border-b border-gray-200">
+                              <span>{fileName}, page {page}</span>
+                              <span className={summary.error ? 'text-red-600' : ''}>
+                                {summary.error ? 'Failed' : `${summary.invoiceNumber || '-'} · ${summary.total ?? '-'}`}
+                              </span>
+                            </li>
+                          );
+                        })}
+                      </ul>
+                    )}
                   </div>
                 )}
               </div>